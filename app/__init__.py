@@ -1,24 +1,50 @@
 from flask import Flask
 from flask.ext.login import LoginManager
-from flask.ext.migrate import Migrate, MigrateCommand
-from flask.ext.script import Manager, Server
 from flask.ext.sqlalchemy import SQLAlchemy
+from werkzeug.utils import import_string
 
 
-# instantiate app
-app = Flask(__name__)
-# load configuration settings
-app.config.from_object('config')
-# initialize database
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+# Extensions are created unbound and attached to an application in
+# create_app, so importing the package does no setup work.
+db = SQLAlchemy()
 # initialize LoginManager
 login_manager = LoginManager()
-login_manager.login_view = 'login'
-login_manager.init_app(app)
-# initialize manager
-manager = Manager(app)
-manager.add_command('db', MigrateCommand)
-manager.add_command('runserver', Server(threaded=True))
-
-from app import views, models
+login_manager.login_view = 'main.login'
+
+
+def create_app(config='config'):
+    ''' Application factory.
+
+        Blueprints listed in the BLUEPRINTS setting are only imported
+        here, so code that merely imports the package (migrations,
+        manager commands) does not pay for loading every view.'''
+
+    # instantiate app
+    app = Flask(__name__)
+    # load configuration settings
+    app.config.from_object(config)
+    # initialize extensions
+    db.init_app(app)
+    login_manager.init_app(app)
+    from app.scanlog import scan_log
+    scan_log.init_app(app)
+    from app.jobs import jobs
+    jobs.init_app(app)
+    from app.assets import assets
+    assets.init_app(app)
+    from app.maintenance import maintenance_scheduler
+    maintenance_scheduler.init_app(app)
+    from app.snapshots import reader
+    reader.init_app(app)
+    # register blueprints
+    for blueprint in app.config['BLUEPRINTS']:
+        app.register_blueprint(import_string(blueprint))
+
+    @app.before_first_request
+    def load_reference_data():
+        ''' Preload static reference tables before serving requests.'''
+
+        from app.registry import game_modes
+        game_modes.load()
+
+    return app
@@ -0,0 +1,138 @@
+''' Game usage analytics.
+
+    Scan events are folded into hourly rollups (ScanRollup) in the same
+    transaction that writes them, so reports only aggregate the rollups
+    and stay fast no matter how many scans have been logged.'''
+
+from flask.ext.script import Manager
+from sqlalchemy import and_, case, func
+
+from app import db
+from .models import Device, Question, ScanEvent, ScanRollup
+from .snapshots import read_session
+
+
+def hour_of(date):
+    ''' Truncate datetime to the start of its hour.'''
+
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+def aggregate_events(events):
+    ''' Sum scan events (keyed by column name, as queued by app.scanlog)
+        into rollup counts keyed by (hour, game, device, question).'''
+
+    totals = {}
+    for event in events:
+        key = (hour_of(event['Date']), event['GameID'],
+               event['DeviceID'], event['QuestionID'])
+        counts = totals.setdefault(key, [0, 0, 0, 0])
+        counts[0] += 1
+        counts[1] += int(event['Valid'])
+        counts[2] += int(event['FirstTry'])
+        counts[3] += int(event['FirstTry'] and event['Valid'])
+    return totals
+
+
+def update_rollups(connection, events):
+    ''' Add scan events to hourly rollups using connection.'''
+
+    table = ScanRollup.__table__
+    for key, counts in aggregate_events(events).items():
+        hour, game_id, device_id, question_id = key
+        # Comparisons with None compile to IS NULL
+        update = table.update().where(and_(
+                    table.c.Hour == hour,
+                    table.c.GameID == game_id,
+                    table.c.DeviceID == device_id,
+                    table.c.QuestionID == question_id)).values(
+                    Scans=table.c.Scans + counts[0],
+                    ValidScans=table.c.ValidScans + counts[1],
+                    FirstTries=table.c.FirstTries + counts[2],
+                    FirstTrySuccesses=table.c.FirstTrySuccesses + counts[3])
+        if connection.execute(update).rowcount == 0:
+            connection.execute(table.insert().values(
+                    Hour=hour,
+                    GameID=game_id,
+                    DeviceID=device_id,
+                    QuestionID=question_id,
+                    Scans=counts[0],
+                    ValidScans=counts[1],
+                    FirstTries=counts[2],
+                    FirstTrySuccesses=counts[3]))
+
+
+def rebuild_rollups():
+    ''' Recompute all rollups from scan_events.'''
+
+    # Same text format SQLAlchemy uses to store DateTime in SQLite
+    hour = func.strftime('%Y-%m-%d %H:00:00.000000', ScanEvent.date)
+    first_try_success = case([(and_(ScanEvent.first_try, ScanEvent.valid), 1)], else_=0)
+    rollups = db.session.query(
+                hour,
+                ScanEvent.game,
+                ScanEvent.device,
+                ScanEvent.question,
+                func.count(ScanEvent.id),
+                func.sum(case([(ScanEvent.valid, 1)], else_=0)),
+                func.sum(case([(ScanEvent.first_try, 1)], else_=0)),
+                func.sum(first_try_success)).group_by(
+                hour, ScanEvent.game, ScanEvent.device, ScanEvent.question)
+
+    ScanRollup.query.delete()
+    db.session.execute(ScanRollup.__table__.insert().from_select(
+                ['Hour', 'GameID', 'DeviceID', 'QuestionID',
+                 'Scans', 'ValidScans', 'FirstTries', 'FirstTrySuccesses'],
+                rollups.selectable))
+    db.session.commit()
+    return ScanRollup.query.count()
+
+
+def device_scan_counts(game_id):
+    ''' Return (device name, valid scans) for devices of a game, most
+        scanned first.'''
+
+    scans = func.sum(ScanRollup.valid_scans)
+    return read_session.query(Device.name, scans).join(
+                ScanRollup, ScanRollup.device == Device.id).filter(
+                ScanRollup.game == game_id).group_by(
+                Device.id, Device.name).order_by(scans.desc()).all()
+
+
+def question_success_rates(game_id):
+    ''' Return (question, first tries, first try successes, success rate)
+        for questions of a challenge game.'''
+
+    rates = []
+    rows = read_session.query(
+                Question.question,
+                func.sum(ScanRollup.first_tries),
+                func.sum(ScanRollup.first_try_successes)).join(
+                ScanRollup, ScanRollup.question == Question.id).filter(
+                ScanRollup.game == game_id).group_by(
+                Question.id, Question.question).order_by(Question.id)
+    for question, first_tries, successes in rows:
+        rate = float(successes) / first_tries if first_tries else 0.0
+        rates.append((question, first_tries, successes, rate))
+    return rates
+
+
+def busiest_hours(game_id, limit=5):
+    ''' Return (hour of day, scans) for the busiest hours of a game.'''
+
+    hour = func.strftime('%H', ScanRollup.hour)
+    scans = func.sum(ScanRollup.scans)
+    rows = read_session.query(hour, scans).filter(
+                ScanRollup.game == game_id).group_by(
+                hour).order_by(scans.desc()).limit(limit)
+    return [(int(hour_of_day), total) for hour_of_day, total in rows]
+
+
+AnalyticsCommand = Manager(usage='Maintain scan analytics')
+
+
+@AnalyticsCommand.command
+def rebuild():
+    ''' Recompute hourly scan rollups from the scan event log.'''
+
+    print('Rebuilt %d hourly rollups.' % rebuild_rollups())
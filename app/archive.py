@@ -0,0 +1,120 @@
+''' Archival of old member visits.
+
+    Visits older than VISIT_ARCHIVE_DAYS are rolled up into daily counts
+    per member (MemberVisitRollup), copied to member_visits_archive and
+    removed from member_visits, keeping the hot table and its indexes
+    small. Reports in app.reports combine both sources.'''
+
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from flask.ext.script import Manager
+from sqlalchemy import func
+
+from app import db
+from .models import ArchivedMemberVisit, MemberVisit, MemberVisitRollup
+from .versions import bump
+
+
+def archive_cutoff(days=None):
+    ''' Return midnight of the first day that is kept in member_visits.'''
+
+    if days is None:
+        days = current_app.config['VISIT_ARCHIVE_DAYS']
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=days)
+
+
+def archive_visits(cutoff, batch_size=None):
+    ''' Move visits dated before cutoff out of member_visits.
+
+        Visits are processed in batches of ascending id, each batch in a
+        single transaction, so an interrupted run can simply be resumed.
+        Returns number of visits archived.'''
+
+    if batch_size is None:
+        batch_size = current_app.config['VISIT_ARCHIVE_BATCH']
+
+    archived = 0
+    while True:
+        # Find largest id in this batch to bound the batch by id range
+        boundary = db.session.query(MemberVisit.id).filter(
+                        MemberVisit.date < cutoff).order_by(
+                        MemberVisit.id).offset(batch_size - 1).limit(1).scalar()
+        if boundary is None:
+            boundary = db.session.query(func.max(MemberVisit.id)).filter(
+                            MemberVisit.date < cutoff).scalar()
+        if boundary is None:
+            break
+        batch = MemberVisit.query.filter(
+                    MemberVisit.date < cutoff).filter(
+                    MemberVisit.id <= boundary)
+        archived += move_to_archive(batch)
+        db.session.commit()
+
+    return archived
+
+
+def move_to_archive(visits):
+    ''' Roll up the visits selected by query visits, copy them to
+        member_visits_archive and delete them, in the caller's
+        transaction. Returns number of visits moved.'''
+
+    # Roll visits up into daily counts per member
+    day = func.date(MemberVisit.date)
+    counts = visits.with_entities(
+                MemberVisit.member, day, func.count(MemberVisit.id)).group_by(
+                MemberVisit.member, day)
+    for member_id, visit_day, count in counts.all():
+        add_to_rollup(member_id, parse_day(visit_day), count)
+
+    # Copy raw rows to archive table and remove them from hot table
+    columns = visits.with_entities(
+                MemberVisit.id, MemberVisit.member, MemberVisit.date, MemberVisit.repeats)
+    db.session.execute(ArchivedMemberVisit.__table__.insert().from_select(
+                ['id', 'MemberID', 'Date', 'Repeats'], columns.statement))
+    return visits.delete(synchronize_session=False)
+
+
+def add_to_rollup(member_id, day, visits):
+    ''' Add visits to a member's rollup for the given day.'''
+
+    rollup = MemberVisitRollup.query.filter(
+                MemberVisitRollup.member == member_id).filter(
+                MemberVisitRollup.day == day).first()
+    if rollup:
+        rollup.visits += visits
+    else:
+        db.session.add(MemberVisitRollup(member=member_id, day=day, visits=visits))
+
+
+def parse_day(value):
+    ''' SQLite date() returns text, convert it to a date.'''
+
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def delete_member_history(member_id):
+    ''' Delete archived visits and rollups of a member, and bump the
+        member_visits version since cached report counts include them.'''
+
+    ArchivedMemberVisit.query.filter(
+            ArchivedMemberVisit.member == member_id).delete(synchronize_session=False)
+    MemberVisitRollup.query.filter(
+            MemberVisitRollup.member == member_id).delete(synchronize_session=False)
+    bump(db.session.connection(), MemberVisit.__tablename__)
+
+
+ArchiveCommand = Manager(usage='Archive old member visits')
+
+
+@ArchiveCommand.option('-d', '--days', dest='days', type=int, default=None,
+                       help='Keep visits from the last DAYS days (default: VISIT_ARCHIVE_DAYS)')
+def run(days):
+    ''' Roll up and archive visits older than the archive horizon.'''
+
+    cutoff = archive_cutoff(days)
+    archived = archive_visits(cutoff)
+    print('Archived %d visits dated before %s.' % (archived, cutoff.strftime('%m/%d/%Y')))
@@ -0,0 +1,226 @@
+''' Bundled static assets.
+
+    Pages would otherwise load jQuery, jQuery UI, Bootstrap,
+    ResponsiveVoice, their own scripts and the style sheets as separate
+    files, revalidating each on every navigation. `run.py assets build`
+    concatenates and minifies each bundle of BUNDLES into ASSET_FOLDER as
+
+        <name>.<content hash>.<ext>      minified bundle
+        <name>.<content hash>.<ext>.gz   gzip compressed copy, unless larger
+        manifest.json                    bundle name -> file name
+
+    Templates include bundles with asset_urls(). Once built, that is the
+    single hashed file, served by /assets with the gzip copy when the
+    browser accepts it and cached for a year as immutable, since any
+    change gives a new name. Until built, it is the source files.
+
+    Bundles are minified with rjsmin and rcssmin. Without them scripts
+    only lose indentation and blank lines, and style sheets comments and
+    whitespace; the build then says so.'''
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+
+from flask import current_app, url_for
+from flask.ext.script import Manager
+
+
+# Bundle name -> source files, relative to the static folder
+BUNDLES = (
+    ('base.css', ('css/jquery-ui.css', 'css/theme.css')),
+    ('base.js', ('js/jquery-1.12.2.min.js', 'js/jquery-ui.js', 'js/bootstrap.js',
+                 'js/responsevoice.js')),
+    ('learning.js', ('js/learning.js', 'js/scan_stream.js')),
+    ('challenge.js', ('js/challenge.js', 'js/scan_stream.js')),
+    ('members.js', ('js/scan_stream.js',)),
+    ('member_live.js', ('js/member_live.js',)),
+    ('member_metrics.js', ('js/member_metrics.js',)),
+    ('edit.js', ('js/edit.js',)),
+)
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def missing_minifiers():
+    ''' Return names of the minifier modules that are not installed.'''
+
+    missing = []
+    for module in ('rjsmin', 'rcssmin'):
+        try:
+            __import__(module)
+        except ImportError:
+            missing.append(module)
+    return missing
+
+
+def minify_js(source):
+    try:
+        from rjsmin import jsmin
+    except ImportError:
+        lines = (line.strip() for line in source.splitlines())
+        return '\n'.join(line for line in lines if line)
+    return jsmin(source)
+
+
+def minify_css(source):
+    try:
+        from rcssmin import cssmin
+    except ImportError:
+        source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+        source = re.sub(r'\s+', ' ', source)
+        return re.sub(r'\s*([{};,])\s*', r'\1', source).strip()
+    return cssmin(source)
+
+
+def rebase_urls(source, path, static_folder, static_url_path):
+    ''' Rewrite relative url()s of a style sheet at path so they resolve
+        from a bundle served by /assets.'''
+
+    def rebase(match):
+        quote, url = match.groups()
+        if url.startswith(('data:', '/', '#')) or '://' in url:
+            return match.group(0)
+        target = os.path.normpath(os.path.join(os.path.dirname(path), url))
+        # Relative, so it also resolves under a script root
+        rebased = '..%s/%s' % (static_url_path, os.path.relpath(target, static_folder))
+        return 'url(%s%s%s)' % (quote, rebased.replace(os.sep, '/'), quote)
+
+    return CSS_URL.sub(rebase, source)
+
+
+def build_bundle(name, sources, static_folder, static_url_path):
+    ''' Return minified contents of a bundle as bytes.'''
+
+    parts = []
+    for source in sources:
+        path = os.path.join(static_folder, source)
+        with io.open(path, encoding='utf-8') as asset:
+            content = asset.read()
+        if name.endswith('.css'):
+            parts.append(minify_css(rebase_urls(content, path, static_folder, static_url_path)))
+        else:
+            parts.append(minify_js(content))
+    # A separating semicolon keeps a script without a final one from
+    # running into the next
+    separator = u'\n' if name.endswith('.css') else u'\n;\n'
+    return separator.join(parts).encode('utf-8')
+
+
+def hashed_name(name, content):
+    stem, extension = os.path.splitext(name)
+    digest = hashlib.sha1(content).hexdigest()[:HASH_LENGTH]
+    return '%s.%s%s' % (stem, digest, extension)
+
+
+def write_file(path, content):
+    partial = path + '.partial'
+    with open(partial, 'wb') as output:
+        output.write(content)
+    os.rename(partial, path)
+
+
+def gzip_bytes(content):
+    buffer = io.BytesIO()
+    # No file name or time in the header, so builds are reproducible
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buffer, compresslevel=9, mtime=0) as compressed:
+        compressed.write(content)
+    return buffer.getvalue()
+
+
+def build_assets(static_folder, static_url_path, output):
+    ''' Write every bundle, its gzip copy and the manifest to output and
+        delete files of earlier builds. Returns dict of bundle name to
+        (file name, size, compressed size).'''
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    manifest = {}
+    built = {}
+    for name, sources in BUNDLES:
+        content = build_bundle(name, sources, static_folder, static_url_path)
+        filename = hashed_name(name, content)
+        compressed = gzip_bytes(content)
+        write_file(os.path.join(output, filename), content)
+        # Tiny bundles grow when compressed and are always sent as they are
+        if len(compressed) < len(content):
+            write_file(os.path.join(output, filename + '.gz'), compressed)
+        manifest[name] = filename
+        built[name] = (filename, len(content), min(len(compressed), len(content)))
+    # Written last, so pages never refer to a bundle not yet written
+    write_file(os.path.join(output, MANIFEST),
+               json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+    current = set(manifest.values())
+    current.update(filename + '.gz' for filename in manifest.values())
+    current.add(MANIFEST)
+    for filename in os.listdir(output):
+        if filename not in current:
+            os.remove(os.path.join(output, filename))
+    return built
+
+
+class Assets(object):
+    ''' Template lookups of bundles in the manifest of ASSET_FOLDER.'''
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # folder -> (manifest modification time, manifest)
+        self._manifests = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.add_template_global(self.asset_urls)
+
+    def manifest(self):
+        ''' Return the current manifest, or an empty one if not built.'''
+
+        folder = current_app.config['ASSET_FOLDER']
+        try:
+            modified = os.stat(os.path.join(folder, MANIFEST)).st_mtime
+        except OSError:
+            return {}
+        loaded = self._manifests.get(folder)
+        if loaded is None or loaded[0] != modified:
+            with self._lock:
+                with open(os.path.join(folder, MANIFEST), 'rb') as manifest:
+                    loaded = (modified, json.loads(manifest.read().decode('utf-8')))
+                self._manifests[folder] = loaded
+        return loaded[1]
+
+    def asset_urls(self, name):
+        ''' Return list of URLs to include for bundle name.'''
+
+        filename = self.manifest().get(name)
+        if filename:
+            return [url_for('main.asset', filename=filename)]
+        return [url_for('static', filename=source) for source in dict(BUNDLES)[name]]
+
+
+assets = Assets()
+
+
+AssetCommand = Manager(usage='Build bundled static assets')
+
+
+@AssetCommand.command
+def build():
+    ''' Bundle, minify and compress static assets for serving.'''
+
+    output = current_app.config['ASSET_FOLDER']
+    built = build_assets(current_app.static_folder, current_app.static_url_path, output)
+    for name, (filename, size, compressed) in sorted(built.items()):
+        print('%-18s %-34s %8d bytes, %7d gzipped' % (name, filename, size, compressed))
+    print('Wrote %s.' % os.path.join(output, MANIFEST))
+    missing = missing_minifiers()
+    if missing:
+        print('Warning: %s not installed, so bundles were only stripped of whitespace '
+              'and comments; install requirements/requirements.txt to minify them.'
+              % ' and '.join(missing))
@@ -0,0 +1,356 @@
+''' Benchmarks run against a throwaway database.
+
+    Each benchmark builds a temporary SQLite database populated with
+    synthetic data, so it can be run on a kiosk without touching the
+    real discovery_rfid.db.'''
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no allocation tracing; only latency is reported
+    tracemalloc = None
+
+from flask import current_app
+from flask.ext.script import Manager
+from sqlalchemy import func
+
+from app import create_app, db
+from .models import Device, Game, game_device_link, Member, MemberVisit, ReplicationConflict, ReplicationPeer
+from .rows import device_rows, game_rows, member_rows
+
+
+@contextmanager
+def scratch_app(**overrides):
+    ''' Yield an app context bound to an empty temporary database, with
+        settings overridden by keyword arguments.'''
+
+    directory = tempfile.mkdtemp()
+    settings = dict(current_app.config)
+    settings['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    settings['TAG_TABLE_PATH'] = os.path.join(directory, 'tag_table.bin')
+    settings.update(overrides)
+    app = create_app(type('BenchmarkConfig', (object,), settings))
+    try:
+        with app.app_context():
+            # Sessions are bound to the app that was current when created
+            db.session.remove()
+            db.create_all()
+            yield app
+            db.session.remove()
+    finally:
+        shutil.rmtree(directory)
+
+
+def populate(members, games, devices_per_game):
+    ''' Insert synthetic members, games and devices with executemany.'''
+
+    now = datetime.now()
+    db.session.execute(Member.__table__.insert(), [
+                dict(FirstName='First%d' % i, LastName='Member%d' % i,
+                     CardNumber='%010d' % i, VisitCount=i % 50,
+                     FirstVisit=now, LastVisit=now)
+                for i in range(members)])
+    db.session.execute(Game.__table__.insert(), [
+                dict(id=i + 1, Title='Game %d' % i, Description='Synthetic game', Mode=1)
+                for i in range(games)])
+    db.session.execute(Device.__table__.insert(), [
+                dict(id=i + 1, Name='Device %d' % i, Description='Synthetic device ' * 20,
+                     Tag='%010d' % i, FileLocation='device%d.png' % i)
+                for i in range(games * devices_per_game)])
+    db.session.execute(game_device_link.insert(), [
+                dict(game_id=i // devices_per_game + 1, device_id=i + 1)
+                for i in range(games * devices_per_game)])
+    db.session.commit()
+
+
+def measure(func, repeat):
+    ''' Return mean milliseconds per call of func and peak KiB allocated
+        while its result is held (None without tracemalloc).'''
+
+    elapsed = 0.0
+    for i in range(repeat):
+        # Each request starts with an empty session
+        db.session.expunge_all()
+        start = time.time()
+        func()
+        elapsed += time.time() - start
+
+    peak = None
+    if tracemalloc is not None:
+        db.session.expunge_all()
+        tracemalloc.start()
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+        del result
+    return elapsed * 1000 / repeat, peak
+
+
+def compare_rows(members, games, devices_per_game, repeat):
+    ''' Compare ORM instances with column rows for list page queries.
+
+        Returns list of (page, orm ms, rows ms, orm KiB, rows KiB).'''
+
+    cases = [
+        ('manage_members search',
+         lambda: Member.query.filter(Member.member_last_name.ilike('%Member%')).order_by(
+                    Member.member_last_name, Member.member_first_name).all(),
+         lambda: member_rows('Member')),
+        ('games list',
+         lambda: Game.query.filter(Game.game_mode == 1).order_by(Game.title).all(),
+         lambda: game_rows(1)),
+        ('edit_game devices',
+         lambda: Device.query.join(Game.devices).filter(Game.id == 1).all(),
+         lambda: device_rows(1)),
+    ]
+    results = []
+    with scratch_app():
+        populate(members, games, devices_per_game)
+        for page, orm, rows in cases:
+            orm_ms, orm_kib = measure(orm, repeat)
+            rows_ms, rows_kib = measure(rows, repeat)
+            results.append((page, orm_ms, rows_ms, orm_kib, rows_kib))
+    return results
+
+
+def add_visits(count, days):
+    ''' Insert count synthetic visits of the members spread over the last
+        days days.'''
+
+    members = db.session.query(func.count(Member.id)).scalar()
+    now = datetime.now()
+    for first in range(0, count, 10000):
+        db.session.execute(MemberVisit.__table__.insert(), [
+                    dict(MemberID=i % members + 1,
+                         Date=now - timedelta(seconds=(count - i) * days * 86400.0 / count))
+                    for i in range(first, min(first + 10000, count))])
+        db.session.commit()
+
+
+def check_ins_during_reports(app, members, seconds, interval):
+    ''' Check members in every interval seconds, first alone and then
+        while visit exports run back to back. Returns dict of check-in
+        latencies in milliseconds per phase, and exports completed.'''
+
+    from .export import export_stream
+    from .loadtest import percentile
+    from .membership import record_visit
+    from .snapshots import read_session
+
+    latencies = dict(idle=[], reporting=[])
+    phase = ['idle']
+    stop = threading.Event()
+
+    def check_in():
+        # Kiosk requests get their own app context and session
+        with app.app_context():
+            number = 0
+            while not stop.is_set():
+                member = Member.query.get(number % members + 1)
+                start = time.time()
+                record_visit(member, datetime.now())
+                db.session.commit()
+                latencies[phase[0]].append((time.time() - start) * 1000)
+                number += 1
+                db.session.remove()
+                stop.wait(interval)
+
+    kiosk = threading.Thread(target=check_in)
+    kiosk.start()
+    try:
+        time.sleep(seconds)
+        phase[0] = 'reporting'
+        start, end = datetime(2000, 1, 1), datetime.now() + timedelta(days=1)
+        exports = 0
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            for chunk in export_stream('visits', start, end):
+                pass
+            # Each export reads its own snapshot, as each request does
+            read_session.remove()
+            exports += 1
+    finally:
+        stop.set()
+        kiosk.join()
+
+    results = dict(exports=exports)
+    for name, values in latencies.items():
+        values.sort()
+        results[name] = dict(check_ins=len(values),
+                             p50_ms=percentile(values, 0.50),
+                             p95_ms=percentile(values, 0.95),
+                             p99_ms=percentile(values, 0.99),
+                             max_ms=values[-1] if values else None)
+    return results
+
+
+def serve(app):
+    ''' Serve app on a free local port from a thread. Returns the server
+        and its URL.'''
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def replicate_to_central(members, visits, conflicts, batch_size):
+    ''' Push the members and visits of a satellite to a central node
+        served over HTTP, each with its own temporary database, and push
+        them all again as if every acknowledgement had been lost.
+
+        The central node already has the first conflicts cards, registered
+        to other names. Returns dict of the push results, seconds taken
+        and the central node's counts.'''
+
+    from .replication import push_changes, seed_changes
+
+    token = 'benchmark-token'
+    results = {}
+    with scratch_app(REPLICATION_TOKEN=token) as central:
+        db.session.execute(Member.__table__.insert(), [
+                    dict(FirstName='Other%d' % i, LastName='Member%d' % i,
+                         CardNumber='%010d' % i, VisitCount=0)
+                    for i in range(conflicts)])
+        db.session.commit()
+        server, url = serve(central)
+        try:
+            with scratch_app(REPLICATION_CENTRAL=url, REPLICATION_TOKEN=token,
+                             REPLICATION_NODE='satellite', REPLICATION_LOG=True):
+                populate(members, 1, 1)
+                add_visits(visits, 30)
+                results['logged'] = seed_changes()
+                start = time.time()
+                results['push'] = push_changes(url, token, 'satellite', batch_size)
+                results['seconds'] = time.time() - start
+                ReplicationPeer.query.update(dict(sent=0))
+                db.session.commit()
+                start = time.time()
+                results['resend'] = push_changes(url, token, 'satellite', batch_size)
+                results['resend_seconds'] = time.time() - start
+        finally:
+            server.shutdown()
+        results['members'] = Member.query.count()
+        results['visits'] = MemberVisit.query.count()
+        results['conflicts'] = ReplicationConflict.query.count()
+    return results
+
+
+BenchmarkCommand = Manager(usage='Run benchmarks against a temporary database')
+
+
+@BenchmarkCommand.option('-m', '--members', dest='members', type=int, default=20000)
+@BenchmarkCommand.option('-g', '--games', dest='games', type=int, default=50)
+@BenchmarkCommand.option('-d', '--devices', dest='devices', type=int, default=200,
+                         help='Devices per game')
+@BenchmarkCommand.option('-r', '--repeat', dest='repeat', type=int, default=5)
+def rows(members, games, devices, repeat):
+    ''' Compare latency and memory of ORM instances and column rows.'''
+
+    print('%-24s %10s %10s %12s %12s' % ('page', 'orm ms', 'rows ms', 'orm KiB', 'rows KiB'))
+    for page, orm_ms, rows_ms, orm_kib, rows_kib in compare_rows(members, games, devices, repeat):
+        if orm_kib is None:
+            print('%-24s %10.1f %10.1f %12s %12s' % (page, orm_ms, rows_ms, 'n/a', 'n/a'))
+        else:
+            print('%-24s %10.1f %10.1f %12.0f %12.0f' % (page, orm_ms, rows_ms, orm_kib, rows_kib))
+    if tracemalloc is None:
+        # The process' peak RSS only grows, so it can not tell the
+        # memory of one query from another's
+        print('Memory was not measured: it needs tracemalloc, available from Python 3.4.')
+
+
+@BenchmarkCommand.option('-k', '--kiosks', dest='kiosks', type=int, default=10)
+@BenchmarkCommand.option('-t', '--duration', dest='duration', type=float, default=30.0,
+                         help='Seconds to run')
+@BenchmarkCommand.option('--think', dest='think', type=float, default=1.0,
+                         help='Mean seconds a kiosk waits between actions')
+@BenchmarkCommand.option('-m', '--members', dest='members', type=int, default=5000)
+@BenchmarkCommand.option('-g', '--games', dest='games', type=int, default=20)
+@BenchmarkCommand.option('-d', '--devices', dest='devices', type=int, default=30,
+                         help='Devices per game')
+@BenchmarkCommand.option('--media', dest='media', type=int, default=64,
+                         help='KiB per media file')
+@BenchmarkCommand.option('--seed', dest='seed', type=int, default=0)
+@BenchmarkCommand.option('-o', '--output', dest='output', default=None,
+                         help='Also write the JSON report to this file')
+def load(kiosks, duration, think, members, games, devices, media, seed, output):
+    ''' Simulate kiosks against a local server and report latency
+        percentiles per endpoint as JSON.'''
+
+    from app.loadtest import run_load
+
+    result = run_load(kiosks, duration, think, members, games, devices, media, seed)
+    result.update(think=think, seed=seed)
+    report = json.dumps(result, indent=2, sort_keys=True)
+    print(report)
+    if output:
+        with open(output, 'w') as results:
+            results.write(report + '\n')
+
+
+@BenchmarkCommand.option('-m', '--members', dest='members', type=int, default=5000)
+@BenchmarkCommand.option('-v', '--visits', dest='visits', type=int, default=200000)
+@BenchmarkCommand.option('-t', '--duration', dest='duration', type=float, default=10.0,
+                         help='Seconds to check in without and then with reports running')
+@BenchmarkCommand.option('-i', '--interval', dest='interval', type=float, default=0.05,
+                         help='Seconds between check-ins')
+@BenchmarkCommand.option('-j', '--journal-mode', dest='journal_mode', default=None,
+                         help='SQLite journal mode (default: SQLITE_JOURNAL_MODE)')
+def snapshot(members, visits, duration, interval, journal_mode):
+    ''' Compare check-in latency with and without visit exports running.'''
+
+    if journal_mode is None:
+        journal_mode = current_app.config['SQLITE_JOURNAL_MODE']
+    with scratch_app(SQLITE_JOURNAL_MODE=journal_mode) as app:
+        populate(members, 1, 1)
+        add_visits(visits, 365)
+        db.session.remove()
+        results = check_ins_during_reports(app, members, duration, interval)
+    print('Journal mode %s, %d exports of %d visits while reporting.' % (
+                journal_mode, results['exports'], visits))
+    print('%-10s %10s %10s %10s %10s %10s' % ('phase', 'check-ins', 'p50 ms', 'p95 ms',
+                                              'p99 ms', 'max ms'))
+    for name in ('idle', 'reporting'):
+        phase = results[name]
+        print('%-10s %10d %10.1f %10.1f %10.1f %10.1f' % (
+                    name, phase['check_ins'], phase['p50_ms'] or 0, phase['p95_ms'] or 0,
+                    phase['p99_ms'] or 0, phase['max_ms'] or 0))
+
+
+@BenchmarkCommand.option('-m', '--members', dest='members', type=int, default=5000)
+@BenchmarkCommand.option('-v', '--visits', dest='visits', type=int, default=50000)
+@BenchmarkCommand.option('-c', '--conflicts', dest='conflicts', type=int, default=50,
+                         help='Cards the central node has registered to other names')
+@BenchmarkCommand.option('-b', '--batch', dest='batch_size', type=int, default=None,
+                         help='Changes per batch (default: REPLICATION_BATCH)')
+def replication(members, visits, conflicts, batch_size):
+    ''' Replicate a satellite's members and visits to a local central node.'''
+
+    results = replicate_to_central(members, visits, conflicts,
+                                   batch_size or current_app.config['REPLICATION_BATCH'])
+    for name in ('push', 'resend'):
+        push = results[name]
+        seconds = results['seconds' if name == 'push' else 'resend_seconds']
+        print('%-7s %d changes in %d batches, %.2f s (%.0f changes/s): %d applied, '
+              '%d skipped, %d conflicts; %d of %d JSON bytes sent.' % (
+                    name, push['changes'], push['batches'], seconds,
+                    push['changes'] / seconds if seconds else 0, push['applied'],
+                    push['skipped'], push['conflicts'], push['sent_bytes'], push['json_bytes']))
+    print('Central node: %d members, %d visits, %d conflicts recorded.' % (
+                results['members'], results['visits'], results['conflicts']))
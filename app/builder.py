@@ -0,0 +1,279 @@
+''' Build a game from a zip archive of media and a manifest.
+
+    The archive holds the media files and either manifest.json
+
+        {"devices": [{"name": .., "description": .., "tag": .., "file": ..}],
+         "questions": [{"question": .., "answers": [tag, ..]}]}
+
+    or devices.csv (name, description, tag, file columns) with an optional
+    questions.csv (question, answers columns, answer tags separated by
+    semicolons). Answers name devices by tag, either from the manifest or
+    already in the game. The manifest is validated before anything is
+    written, including that no two media files and no uploaded media share
+    a name; media are then extracted by a pool of threads and all rows
+    are written in one transaction. Extracted media are removed again if
+    either step fails.'''
+
+import csv
+import json
+import os
+import posixpath
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from app import db
+from .models import Device, game_device_link, Question, question_answer_link
+from .roster import normalize, text_lines
+from .rows import device_rows
+from .utils import allowed_file
+
+
+# Longest name or tag that fits its column
+MAX_LENGTH = 50
+
+
+def csv_records(data):
+    ''' Return rows of CSV data as dicts keyed by normalized header.'''
+
+    reader = csv.reader(text_lines(data.splitlines()))
+    header = [normalize(name) for name in next(reader, [])]
+    records = []
+    for row in reader:
+        if not any(row):
+            continue
+        values = [value.decode('utf-8') if isinstance(value, bytes) else value
+                  for value in row]
+        records.append(dict(zip(header, values)))
+    return records
+
+
+def find_entry(names, filename):
+    ''' Return archive entry named filename, at the top level or in any
+        folder, or None.'''
+
+    if filename in names:
+        return filename
+    for name in names:
+        if posixpath.basename(name) == filename:
+            return name
+    return None
+
+
+def read_manifest(archive):
+    ''' Return (devices, questions) lists of dicts described by the
+        archive's manifest. Raises ValueError if there is none.'''
+
+    names = archive.namelist()
+    manifest = find_entry(names, 'manifest.json')
+    if manifest:
+        try:
+            content = json.loads(archive.read(manifest).decode('utf-8'))
+        except ValueError as e:
+            raise ValueError('manifest.json is not valid JSON: %s' % e)
+        if not isinstance(content, dict):
+            raise ValueError('manifest.json must hold an object.')
+        return content.get('devices') or [], content.get('questions') or []
+
+    devices_csv = find_entry(names, 'devices.csv')
+    if not devices_csv:
+        raise ValueError('Archive has no manifest.json or devices.csv.')
+    devices = csv_records(archive.read(devices_csv))
+    questions = []
+    questions_csv = find_entry(names, 'questions.csv')
+    if questions_csv:
+        for record in csv_records(archive.read(questions_csv)):
+            answers = record.get('answers') or ''
+            questions.append(dict(question=record.get('question'),
+                                  answers=[tag for tag in answers.split(';') if tag.strip()]))
+    return devices, questions
+
+
+def text_field(record, field):
+    ''' Return field of manifest record as stripped text.'''
+
+    value = record.get(field)
+    if value is None:
+        return u''
+    if not isinstance(value, type(u'')):
+        value = u'%s' % value
+    return value.strip()
+
+
+def plan_game(archive, game_id):
+    ''' Validate the manifest against the archive, the game and the
+        upload folder.
+
+        Returns (devices, questions, media) where devices are dicts of
+        Device columns, questions are (text, answer tags) and media maps
+        archive entries to upload filenames. Raises ValueError describing the first problem.'''
+
+    devices, questions = read_manifest(archive)
+    if not devices and not questions:
+        raise ValueError('Manifest lists no devices or questions.')
+    names = archive.namelist()
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    tags = set(device.rfid_tag for device in device_rows(game_id))
+    planned = []
+    media = {}
+    # Lower case upload filename -> archive entry, as some file systems
+    # ignore case
+    uploads = {}
+    for number, record in enumerate(devices, 1):
+        if not isinstance(record, dict):
+            raise ValueError('Device %d is not an object.' % number)
+        name = text_field(record, 'name')
+        description = text_field(record, 'description')
+        tag = text_field(record, 'tag')
+        filename = text_field(record, 'file')
+        if not name or not description or not tag or not filename:
+            raise ValueError('Device %d needs a name, description, tag and file.' % number)
+        if len(name) > MAX_LENGTH or len(tag) > MAX_LENGTH:
+            raise ValueError('Device %d name or tag is longer than %d characters.' % (
+                        number, MAX_LENGTH))
+        if tag in tags:
+            raise ValueError('Device %d tag %s is already used in this game.' % (number, tag))
+        tags.add(tag)
+        entry = find_entry(names, filename)
+        if entry is None:
+            raise ValueError('Device %d file %s is not in the archive.' % (number, filename))
+        upload = secure_filename(posixpath.basename(entry))
+        if not allowed_file(upload):
+            raise ValueError('Device %d file %s is not an allowed type.' % (number, filename))
+        if uploads.setdefault(upload.lower(), entry) != entry:
+            raise ValueError('Device %d file %s has the same name as %s.' % (
+                        number, filename, uploads[upload.lower()]))
+        if entry not in media and os.path.exists(os.path.join(upload_folder, upload)):
+            raise ValueError('Device %d file %s would replace uploaded media %s.' % (
+                        number, filename, upload))
+        media[entry] = upload
+        planned.append(dict(Name=name, Description=description, Tag=tag,
+                            FileLocation=upload))
+
+    planned_questions = []
+    for number, record in enumerate(questions, 1):
+        if not isinstance(record, dict):
+            raise ValueError('Question %d is not an object.' % number)
+        text = text_field(record, 'question')
+        answers = record.get('answers') or []
+        if not isinstance(answers, list):
+            answers = (u'%s' % answers).split(';')
+        answers = [u'%s' % tag for tag in answers]
+        answers = [tag.strip() for tag in answers if tag.strip()]
+        if not text or not answers:
+            raise ValueError('Question %d needs text and at least one answer.' % number)
+        unknown = [tag for tag in answers if tag not in tags]
+        if unknown:
+            raise ValueError('Question %d answer tag %s is not a device of this game.' % (
+                        number, unknown[0]))
+        planned_questions.append((text, answers))
+    return planned, planned_questions, media
+
+
+def extract_media(path, entry, upload_folder, filename):
+    ''' Extract one archive entry into the upload folder.
+
+        Each call opens its own handle on the archive so calls can run in
+        parallel. The file is written under a temporary name and renamed,
+        so a kiosk never serves a partial file.'''
+
+    destination = os.path.join(upload_folder, filename)
+    partial = destination + '.partial'
+    try:
+        with zipfile.ZipFile(path) as archive:
+            with archive.open(entry) as source:
+                with open(partial, 'wb') as target:
+                    while True:
+                        chunk = source.read(64 * 1024)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.rename(partial, destination)
+    return destination
+
+
+def remove_extracted(upload_folder, filenames):
+    ''' Remove media extracted by a failed build.'''
+
+    for filename in filenames:
+        destination = os.path.join(upload_folder, filename)
+        if os.path.exists(destination):
+            os.remove(destination)
+
+
+def write_rows(game_id, devices, questions):
+    ''' Insert devices, questions and their links in one transaction.'''
+
+    ids = dict((device.rfid_tag, device.id) for device in device_rows(game_id))
+    try:
+        records = [Device(name=device['Name'], description=device['Description'],
+                          rfid_tag=device['Tag'], file_loc=device['FileLocation'])
+                   for device in devices]
+        db.session.add_all(records)
+        # Flush assigns ids to link, without committing
+        db.session.flush()
+        for record in records:
+            ids[record.rfid_tag] = record.id
+        if records:
+            db.session.execute(game_device_link.insert(), [
+                        dict(game_id=game_id, device_id=record.id) for record in records])
+
+        records = [Question(question=text, game=game_id) for text, answers in questions]
+        db.session.add_all(records)
+        db.session.flush()
+        links = [dict(question_id=record.id, device_id=ids[tag])
+                 for record, (text, answers) in zip(records, questions)
+                 for tag in answers]
+        if links:
+            db.session.execute(question_answer_link.insert(), links)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def build_game(game_id, path, workers=None):
+    ''' Add the devices, media and questions of a zip archive to a game.
+
+        Returns dict of devices, questions and media counts and seconds.
+        Raises ValueError if the archive or its manifest is invalid or its
+        media can not be extracted, in which case nothing has been
+        written.'''
+
+    start = time.time()
+    try:
+        with zipfile.ZipFile(path) as archive:
+            devices, questions, media = plan_game(archive, game_id)
+    except zipfile.BadZipfile:
+        raise ValueError('File is not a zip archive.')
+
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    workers = workers or current_app.config['GAME_IMPORT_WORKERS']
+    pool = ThreadPool(max(1, min(workers, len(media) or 1)))
+    try:
+        try:
+            pool.map(lambda item: extract_media(path, item[0], upload_folder, item[1]),
+                     list(media.items()))
+        finally:
+            pool.close()
+            pool.join()
+    except (zipfile.BadZipfile, zlib.error, IOError, OSError) as e:
+        # Planning checked that no media had these names, so any are ours
+        remove_extracted(upload_folder, media.values())
+        raise ValueError('Could not extract media: %s' % e)
+
+    try:
+        write_rows(game_id, devices, questions)
+    except Exception:
+        remove_extracted(upload_folder, media.values())
+        raise
+    return dict(devices=len(devices), questions=len(questions), media=len(media),
+                seconds=time.time() - start)
@@ -0,0 +1,126 @@
+''' Answer bundles for validating challenge scans on the kiosk.
+
+    A bundle holds the answers of each question of a challenge game as
+    salted SHA-256 hashes of the RFID tags, each with what to display, so
+    challenge.js can check a scan without a round trip. The bundle
+    version is a hash of its contents and is signed into a token which
+    the kiosk sends back when reporting scans; a changed version tells
+    the kiosk its bundle is stale.
+
+    Reported scans are checked against the game's answers again on the
+    server. answer_cache keeps each game's answers and bundle version for
+    CHALLENGE_ANSWER_CACHE_SECONDS, so reports do not build the bundle.'''
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from app import db
+from .models import Device, Question, question_answer_link
+from .utils import device_payload
+
+
+def bundle_salt(game_id):
+    ''' Return salt used to hash answer tags of a game.'''
+
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    message = ('challenge:%d' % game_id).encode('utf-8')
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+def hash_tag(salt, tag):
+    ''' Hash tag the same way challenge.js does.'''
+
+    return hashlib.sha256((salt + tag).encode('utf-8')).hexdigest()
+
+
+def serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='challenge-bundle')
+
+
+def answer_rows(game_id):
+    ''' Return (question id, device) for every answer of a game.'''
+
+    return db.session.query(Question.id, Device).join(
+                question_answer_link,
+                question_answer_link.c.question_id == Question.id).join(
+                Device, Device.id == question_answer_link.c.device_id).filter(
+                Question.game == game_id).order_by(Question.id, Device.id).all()
+
+
+def build_bundle(game_id, rows=None):
+    ''' Return answer bundle of a challenge game, given its answer_rows()
+        if already queried.'''
+
+    if rows is None:
+        rows = answer_rows(game_id)
+    salt = bundle_salt(game_id)
+    questions = {}
+    for question_id, device in rows:
+        # Devices sharing a tag resolve to the answering device with the
+        # lowest id, as in validate_challenge_tag
+        answers = questions.setdefault(str(question_id), {})
+        answers.setdefault(hash_tag(salt, device.rfid_tag or ''), device_payload(device))
+    # Every question is listed, even without answers
+    for (question_id,) in db.session.query(Question.id).filter(Question.game == game_id):
+        questions.setdefault(str(question_id), {})
+
+    content = json.dumps(questions, sort_keys=True)
+    version = hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+    return dict(game_id=game_id,
+                version=version,
+                token=serializer().dumps([game_id, version]),
+                salt=salt,
+                max_age=current_app.config['CHALLENGE_BUNDLE_MAX_AGE'],
+                questions=questions)
+
+
+def read_token(token):
+    ''' Return (game id, version) signed into token, or None if the
+        token was not issued by this server.'''
+
+    try:
+        game_id, version = serializer().loads(token)
+    except (BadSignature, TypeError, ValueError):
+        return None
+    return game_id, version
+
+
+class AnswerCache(object):
+    ''' Recently used answers and bundle version of challenge games.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # game id -> (expiry time, answers)
+        self._games = {}
+
+    def clear(self):
+        with self._lock:
+            self._games.clear()
+
+    def answers(self, game_id):
+        ''' Return dict with the bundle version of a game and its answers
+            as question id -> {tag: device id}, including every question.'''
+
+        now = time.time()
+        with self._lock:
+            cached = self._games.get(game_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        rows = answer_rows(game_id)
+        bundle = build_bundle(game_id, rows)
+        questions = dict((int(question_id), {}) for question_id in bundle['questions'])
+        for question_id, device in rows:
+            questions[question_id].setdefault(device.rfid_tag or '', device.id)
+        answers = dict(version=bundle['version'], questions=questions)
+        with self._lock:
+            self._games[game_id] = (now + current_app.config['CHALLENGE_ANSWER_CACHE_SECONDS'], answers)
+        return answers
+
+
+answer_cache = AnswerCache()
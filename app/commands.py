@@ -0,0 +1,100 @@
+''' Manager commands for run.py.'''
+
+import sys
+
+from flask.ext.script import Manager, Server
+from werkzeug.utils import import_string
+
+from app import create_app, db
+
+
+# Subcommand -> manager, imported only when that subcommand is run
+COMMANDS = {
+    'analytics': 'app.analytics:AnalyticsCommand',
+    'archive': 'app.archive:ArchiveCommand',
+    'assets': 'app.assets:AssetCommand',
+    'benchmark': 'app.benchmarks:BenchmarkCommand',
+    'export': 'app.export:ExportCommand',
+    'jobs': 'app.jobs:JobCommand',
+    'maintenance': 'app.maintenance:MaintenanceCommand',
+    'members': 'app.membership:MemberCommand',
+    'narration': 'app.narration:NarrationCommand',
+    'replication': 'app.replication:ReplicationCommand',
+    'tags': 'app.tagtable:TagTableCommand',
+}
+# Subcommands defined here or by Flask-Script
+BUILT_IN_COMMANDS = ('db', 'profile_imports', 'runserver', 'shell')
+
+
+def requested_command():
+    ''' Return the subcommand run.py was given, or None.'''
+
+    return sys.argv[1] if len(sys.argv) > 1 else None
+
+
+def migrations_requested():
+    ''' Return True if the db (migration) command is being run.'''
+
+    return requested_command() == 'db'
+
+
+def migration_app():
+    ''' Build application with only the database and models, for the db
+        command, without importing or registering any blueprint.'''
+
+    from flask import Flask
+    from flask.ext.migrate import Migrate
+    # Models are imported for autogenerated migrations
+    from app import models
+
+    app = Flask('app')
+    app.config.from_object('config')
+    db.init_app(app)
+    Migrate(app, db)
+    return app
+
+
+def make_app():
+    ''' Build application for manager commands.'''
+
+    # Flask-Migrate pulls in alembic, so it is only set up for db commands
+    if migrations_requested():
+        return migration_app()
+    return create_app()
+
+
+def add_commands(manager, command):
+    ''' Register the managers of COMMANDS needed to run command: only its
+        own, or all of them when usage is to be listed.'''
+
+    listing = command not in COMMANDS and command not in BUILT_IN_COMMANDS
+    for name, path in sorted(COMMANDS.items()):
+        if listing or name == command:
+            manager.add_command(name, import_string(path))
+
+
+# initialize manager
+manager = Manager(make_app)
+manager.add_command('runserver', Server(threaded=True))
+add_commands(manager, requested_command())
+if migrations_requested():
+    from flask.ext.migrate import MigrateCommand
+    manager.add_command('db', MigrateCommand)
+
+
+@manager.option('-m', '--module', dest='module', default='app.commands',
+                help='Module to import (default: app.commands)')
+@manager.option('-n', '--limit', dest='limit', default=20, type=int,
+                help='Number of modules to report (default: 20)')
+def profile_imports(module, limit):
+    ''' Report startup time and slowest imports in a fresh interpreter.'''
+
+    from app.profiling import profile_imports as run_profile
+
+    report = run_profile(module, limit)
+    print('Import of %s: %.1f ms' % (module, report['import_ms']))
+    print('create_app(): %.1f ms' % report['create_app_ms'])
+    print('')
+    print('%10s  %s' % ('ms', 'module'))
+    for name, elapsed in report['modules']:
+        print('%10.1f  %s' % (elapsed, name))
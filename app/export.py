@@ -0,0 +1,148 @@
+''' Streaming CSV export of visits and daily visit totals.
+
+    Rows are read with streamed, batched queries and written one CSV line
+    at a time by generators, optionally through a gzip compressor, so an
+    export of any size uses constant memory in both the web view and the
+    manager command.'''
+
+import csv
+import sys
+import zlib
+from datetime import datetime, timedelta
+from itertools import chain
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from flask import current_app
+from flask.ext.script import Manager
+
+from .models import ArchivedMemberVisit, Member, MemberVisit
+from .reports import metrics_cache
+from .snapshots import read_session
+
+
+VISIT_HEADER = ('visit_id', 'date', 'member_id', 'first_name', 'last_name', 'card_number')
+DAILY_HEADER = ('date', 'visits')
+
+
+def report_range(start_date, end_date):
+    ''' Parse mm/dd/yyyy start and end dates into [start, end).
+
+        Start defaults to DEPLOY_DATE and end (inclusive) to today.
+        Raises ValueError on malformed or reversed dates.'''
+
+    if start_date:
+        start = datetime.strptime(start_date, '%m/%d/%Y')
+    else:
+        start = datetime.strptime(current_app.config['DEPLOY_DATE'], '%m/%d/%Y')
+    if end_date:
+        end = datetime.strptime(end_date, '%m/%d/%Y')
+    else:
+        end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    end += timedelta(days=1)
+    if end <= start:
+        raise ValueError('End date must not be earlier than start date.')
+    return start, end
+
+
+def visit_rows(start, end, batch_size=1000):
+    ''' Yield visits in [start, end) joined with their member, oldest
+        first. Archived visits, which are all older, come first.'''
+
+    for model in (ArchivedMemberVisit, MemberVisit):
+        query = read_session.query(
+                    model.id, model.date, Member.id, Member.member_first_name,
+                    Member.member_last_name, Member.card_number).join(
+                    Member, Member.id == model.member).filter(
+                    model.date >= start).filter(
+                    model.date < end).order_by(model.date, model.id)
+        for row in query.execution_options(stream_results=True).yield_per(batch_size):
+            yield row
+
+
+def daily_rows(start, end):
+    ''' Yield (date, visits) for every day in [start, end).'''
+
+    counts = metrics_cache.daily_visits(start, end)
+    day = start.date()
+    while day < end.date():
+        yield day, counts.get(day, 0)
+        day += timedelta(days=1)
+
+
+def csv_value(value):
+    ''' Convert value for the csv module of either Python version.'''
+
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    # Python 2 csv only writes byte strings
+    if not isinstance(value, str) and hasattr(value, 'encode'):
+        return value.encode('utf-8')
+    return value
+
+
+def csv_lines(header, rows):
+    ''' Yield header and rows as UTF-8 encoded CSV lines.'''
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for row in chain([header], rows):
+        writer.writerow([csv_value(value) for value in row])
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        yield line if isinstance(line, bytes) else line.encode('utf-8')
+
+
+def gzipped(chunks, level=6):
+    ''' Compress a stream of byte chunks into a gzip stream.'''
+
+    # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(report, start, end, compress=False):
+    ''' Return generator of the named report ("visits" or "daily").'''
+
+    if report == 'visits':
+        lines = csv_lines(VISIT_HEADER, visit_rows(start, end))
+    elif report == 'daily':
+        lines = csv_lines(DAILY_HEADER, daily_rows(start, end))
+    else:
+        raise ValueError('Unknown report %s.' % report)
+    return gzipped(lines) if compress else lines
+
+
+ExportCommand = Manager(usage='Export membership reports as CSV')
+
+
+@ExportCommand.option('report', choices=['visits', 'daily'])
+@ExportCommand.option('-s', '--start', dest='start_date', default=None,
+                      help='First day (mm/dd/yyyy, default: DEPLOY_DATE)')
+@ExportCommand.option('-e', '--end', dest='end_date', default=None,
+                      help='Last day (mm/dd/yyyy, default: today)')
+@ExportCommand.option('-o', '--output', dest='output', default='-',
+                      help='Output file, gzip compressed if it ends in .gz (default: stdout)')
+def report(report, start_date, end_date, output):
+    ''' Write visits or daily visit totals for a date range as CSV.'''
+
+    start, end = report_range(start_date, end_date)
+    compress = output.endswith('.gz')
+    if output == '-':
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+    else:
+        out = open(output, 'wb')
+    try:
+        for chunk in export_stream(report, start, end, compress):
+            out.write(chunk)
+    finally:
+        if output != '-':
+            out.close()
@@ -0,0 +1,67 @@
+''' Member visit history with keyset pagination.
+
+    Pages are ordered newest first by (date, id) and continue from a
+    cursor holding the last visit shown, so every page is a range scan
+    on the (MemberID, Date) index however far back it is. History runs
+    through member_visits into member_visits_archive, whose visits are
+    all older.'''
+
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from app import db
+from .models import ArchivedMemberVisit, MemberVisit
+
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(date, visit_id):
+    ''' Return cursor continuing after the visit with given date and id.'''
+
+    return '%s-%d' % (date.strftime(CURSOR_FORMAT), visit_id)
+
+
+def decode_cursor(cursor):
+    ''' Return (date, id) of cursor. Raises ValueError if malformed.'''
+
+    date, visit_id = cursor.split('-')
+    return datetime.strptime(date, CURSOR_FORMAT), int(visit_id)
+
+
+def visit_page(member_id, cursor=None, limit=50):
+    ''' Return up to limit (id, date) visits of a member older than
+        cursor, newest first, and the cursor of the next page or None.'''
+
+    visits = []
+    for model in (MemberVisit, ArchivedMemberVisit):
+        query = db.session.query(model.id, model.date).filter(model.member == member_id)
+        if cursor:
+            date, visit_id = decode_cursor(cursor)
+            query = query.filter(or_(
+                        model.date < date,
+                        and_(model.date == date, model.id < visit_id)))
+        # One extra row tells whether there is a next page
+        visits.extend(query.order_by(
+                    model.date.desc(), model.id.desc()).limit(limit + 1 - len(visits)))
+        if len(visits) > limit:
+            break
+
+    next_cursor = None
+    if len(visits) > limit:
+        visits = visits[:limit]
+        next_cursor = encode_cursor(visits[-1].date, visits[-1].id)
+    return visits, next_cursor
+
+
+def iter_visits(member_id, cursor=None, page_size=500):
+    ''' Yield every visit of a member older than cursor, newest first,
+        loading one page at a time.'''
+
+    while True:
+        visits, cursor = visit_page(member_id, cursor, page_size)
+        for visit in visits:
+            yield visit
+        if cursor is None:
+            break
@@ -0,0 +1,247 @@
+''' Scan ingest from scanner stations.
+
+    scanner.py posts scan events (station, tag, timestamp) to the ingest
+    endpoint, authenticated with the shared INGEST_TOKEN. Events are
+    relayed to the kiosk pages of their station over server-sent events,
+    which validate them exactly like a typed tag.
+
+    Kiosk pages open the stream with stream_token(INGEST_TOKEN), which
+    the server renders into the page, so only pages it served can take
+    scans.
+
+    scanner.py deletes scans from its journal once acknowledged, so only
+    scans a page has confirmed taking are acknowledged: each relayed
+    scan carries a receipt id the page posts back. The ingest request
+    waits up to INGEST_DELIVERY_TIMEOUT seconds for that,
+    e.g. while a page is loading; scans still waiting then are left to
+    scanner.py to post again. Scans older than INGEST_MAX_AGE are
+    acknowledged as expired, since a page would act on them as if just
+    made.'''
+
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Longest station name or tag accepted, matching the tag column
+MAX_LENGTH = 50
+
+
+def authorized(header, token):
+    ''' Return whether an Authorization header carries token.'''
+
+    if not token or not header.startswith('Bearer '):
+        return False
+    supplied = header[len('Bearer '):].strip()
+    # Constant time, so the token can not be guessed byte by byte
+    return hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8'))
+
+
+def stream_token(token):
+    ''' Return token kiosk pages open the scan stream with, derived from
+        the ingest token so the page never holds that, or '' if ingest
+        is not configured.'''
+
+    if not token:
+        return ''
+    return hmac.new(token.encode('utf-8'), b'scan stream', hashlib.sha256).hexdigest()
+
+
+def stream_authorized(supplied, token):
+    ''' Return whether supplied is the stream_token() of token.'''
+
+    expected = stream_token(token)
+    if not expected or not supplied:
+        return False
+    return hmac.compare_digest(supplied.encode('utf-8'), expected.encode('utf-8'))
+
+
+def parse_events(payload, limit):
+    ''' Return list of (station, tag, timestamp) dicts from an ingest
+        request, which holds one event, a list of events or an object
+        with an "events" list. Raises ValueError if malformed.'''
+
+    if isinstance(payload, dict) and 'events' in payload:
+        payload = payload['events']
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list) or not payload:
+        raise ValueError('Expected a scan event or a list of scan events.')
+    if len(payload) > limit:
+        raise ValueError('At most %d scan events per request.' % limit)
+
+    events = []
+    now = time.time()
+    for number, event in enumerate(payload, 1):
+        if not isinstance(event, dict):
+            raise ValueError('Event %d is not an object.' % number)
+        station = event.get('station')
+        tag = event.get('tag')
+        if not station or not tag:
+            raise ValueError('Event %d needs a station and a tag.' % number)
+        station = u'%s' % station
+        tag = u'%s' % tag
+        if len(station) > MAX_LENGTH or len(tag) > MAX_LENGTH:
+            raise ValueError('Event %d station or tag is too long.' % number)
+        try:
+            timestamp = float(event.get('timestamp', now))
+        except (TypeError, ValueError):
+            raise ValueError('Event %d timestamp is not a number.' % number)
+        events.append(dict(station=station, tag=tag, timestamp=timestamp))
+    return events
+
+
+class ScanHub(object):
+    ''' Relay of ingested scans to the kiosk pages of each station.
+
+        Each relayed scan carries a receipt id. Its threading.Event is set
+        when the page confirms it took the scan.'''
+
+    def __init__(self, subscriber_queue_size=100):
+        self.subscriber_queue_size = subscriber_queue_size
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        # station -> list of (event, receipt id) waiting for a page
+        self._waiting = {}
+        # receipt id -> threading.Event of scans being published
+        self._receipts = {}
+        self.received = 0
+        self.relayed = 0
+        self.expired = 0
+        self.dropped = 0
+        self.unacknowledged = 0
+
+    def _receipt(self):
+        ''' Return (id, event) of a new receipt. Caller holds the lock.'''
+
+        receipt_id = uuid.uuid4().hex
+        receipt = self._receipts[receipt_id] = threading.Event()
+        return receipt_id, receipt
+
+    def publish(self, events, timeout, max_age):
+        ''' Relay events to pages of their station and wait up to timeout
+            seconds for a page to confirm them.
+
+            Returns dict of accepted, the number of leading events
+            delivered or expired, which may be acknowledged, and the
+            number of them that expired.'''
+
+        oldest = time.time() - max_age
+        receipts = []
+        receipt_ids = []
+        with self._lock:
+            self.received += len(events)
+            for event in events:
+                if event['timestamp'] < oldest:
+                    self.expired += 1
+                    receipts.append(None)
+                    continue
+                subscribers = self._subscribers.get(event['station'])
+                if not subscribers:
+                    receipt_id, receipt = self._receipt()
+                    receipt_ids.append(receipt_id)
+                    self._waiting.setdefault(event['station'], []).append((event, receipt_id))
+                    receipts.append([receipt])
+                    continue
+                receipts.append([])
+                for subscriber in subscribers:
+                    receipt_id, receipt = self._receipt()
+                    receipt_ids.append(receipt_id)
+                    try:
+                        subscriber.put_nowait((event, receipt_id))
+                        receipts[-1].append(receipt)
+                    except queue.Full:
+                        # Page is not reading its stream
+                        self.dropped += 1
+
+        deadline = time.time() + timeout
+        accepted = expired = 0
+        for event_receipts in receipts:
+            if event_receipts is None:
+                accepted += 1
+                expired += 1
+                continue
+            # Written out by any page of the station
+            while event_receipts and not any(receipt.is_set() for receipt in event_receipts):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                event_receipts[0].wait(min(remaining, 0.05))
+            if not any(receipt.is_set() for receipt in event_receipts):
+                break
+            accepted += 1
+
+        # Scans no page took are posted again rather than held
+        published = set(id(event) for event in events)
+        with self._lock:
+            for station in set(event['station'] for event in events):
+                waiting = [(event, receipt_id) for event, receipt_id in self._waiting.get(station, [])
+                           if id(event) not in published]
+                if waiting:
+                    self._waiting[station] = waiting
+                else:
+                    self._waiting.pop(station, None)
+            # Later confirmations of these scans are ignored
+            for receipt_id in receipt_ids:
+                self._receipts.pop(receipt_id, None)
+            self.unacknowledged += len(events) - accepted
+        return dict(accepted=accepted, expired=expired)
+
+    def confirm(self, receipt_id):
+        ''' Mark the scan with receipt_id as taken by a page. Returns False
+            if it is unknown or no longer waited for.'''
+
+        with self._lock:
+            receipt = self._receipts.get(receipt_id)
+            if receipt is None:
+                return False
+            if not receipt.is_set():
+                receipt.set()
+                self.relayed += 1
+            return True
+
+    def subscribe(self, station):
+        ''' Return a queue receiving (event, receipt id) of scans of
+            station, starting with scans waiting for a page.'''
+
+        subscriber = queue.Queue(self.subscriber_queue_size)
+        with self._lock:
+            for waiting in self._waiting.pop(station, []):
+                try:
+                    subscriber.put_nowait(waiting)
+                except queue.Full:
+                    self.dropped += 1
+            self._subscribers.setdefault(station, []).append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, station, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(station, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self._subscribers.pop(station, None)
+
+    def stats(self):
+        ''' Return dict of event counters and connected stations.
+
+            Scans counted as dropped or unacknowledged are posted again
+            by scanner.py; expired ones are not.'''
+
+        with self._lock:
+            return dict(received=self.received,
+                        relayed=self.relayed,
+                        expired=self.expired,
+                        dropped=self.dropped,
+                        unacknowledged=self.unacknowledged,
+                        stations=sorted(self._subscribers))
+
+
+scan_hub = ScanHub()
@@ -0,0 +1,298 @@
+''' Background jobs for slow admin tasks.
+
+    Views submit a job by task name and keyword arguments instead of
+    doing slow work (deleting media, importing game archives) on the
+    request thread. Jobs are stored in the jobs table and run by a small,
+    fixed pool of worker threads, so however many are submitted they
+    never take more than JOB_WORKERS threads from the server. Failed jobs
+    are retried with a growing delay up to their maximum attempts; jobs
+    left queued by a restart are picked up again. A running job holds a
+    lease of JOB_LEASE seconds which its worker keeps renewing, so only
+    jobs whose process died are run again, never ones that are just slow.
+    Status is available from the /jobs views.'''
+
+import json
+import os
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from flask import current_app
+from flask.ext.script import Manager
+from sqlalchemy import or_
+
+from app import db
+from .models import Job
+
+
+class JobWorkers(object):
+    ''' Worker threads running the jobs of one app.'''
+
+    def __init__(self, app, tasks):
+        self.app = app
+        self.tasks = tasks
+        self.workers = app.config['JOB_WORKERS']
+        self.poll_interval = app.config['JOB_POLL_INTERVAL']
+        self.retry_delay = app.config['JOB_RETRY_DELAY']
+        self.lease = app.config['JOB_LEASE']
+        self.wakeups = queue.Queue(app.config['JOB_QUEUE_SIZE'])
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def wake(self, job_id):
+        self.start()
+        try:
+            self.wakeups.put_nowait(job_id)
+        except queue.Full:
+            # Workers are busy and will find the job when they next look
+            pass
+
+    def start(self):
+        if self._workers:
+            return
+        with self._lock:
+            if not self._workers:
+                for number in range(self.workers):
+                    worker = threading.Thread(target=self._run, name='job-worker-%d' % number)
+                    worker.daemon = True
+                    worker.start()
+                    self._workers.append(worker)
+
+    def _claim(self):
+        ''' Mark the oldest due job running and return it, or None.
+
+            The update only succeeds for a job still queued, so workers
+            of several server processes never run the same job.'''
+
+        now = datetime.now()
+        # Jobs whose lease ran out were left by a process that died
+        db.session.query(Job).filter(
+                    Job.status == 'running').filter(
+                    or_(Job.lease_until == None, Job.lease_until < now)).update(
+                    dict(status='queued', run_after=now), synchronize_session=False)
+        db.session.commit()
+        candidates = db.session.query(Job.id).filter(
+                    Job.status == 'queued').filter(
+                    Job.run_after <= now).order_by(Job.run_after, Job.id).limit(self.workers * 2)
+        for (job_id,) in candidates.all():
+            claimed = db.session.query(Job).filter(
+                        Job.id == job_id).filter(
+                        Job.status == 'queued').update(
+                        dict(status='running', started=now, attempts=Job.attempts + 1,
+                             lease_until=now + timedelta(seconds=self.lease)),
+                        synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return db.session.query(Job).get(job_id)
+        return None
+
+    def _renew_lease(self, job_id, done):
+        ''' Renew the lease of a running job until done is set.'''
+
+        jobs_table = Job.__table__
+        while not done.wait(self.lease / 3.0):
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as connection:
+                        connection.execute(jobs_table.update().where(
+                                    jobs_table.c.id == job_id).where(
+                                    jobs_table.c.Status == 'running').values(
+                                    LeaseUntil=datetime.now() + timedelta(seconds=self.lease)))
+            except Exception:
+                self.app.logger.exception('Could not renew lease of job %d', job_id)
+
+    def _execute(self, job):
+        ''' Run a claimed job, renewing its lease meanwhile, and record its
+            outcome.'''
+
+        done = threading.Event()
+        renewer = threading.Thread(target=self._renew_lease, args=(job.id, done),
+                                   name='job-lease-%d' % job.id)
+        renewer.daemon = True
+        renewer.start()
+        try:
+            result = self.tasks[job.name](**json.loads(job.arguments))
+        except Exception:
+            db.session.rollback()
+            job.error = traceback.format_exc()
+            if job.attempts < job.max_attempts:
+                # Wait longer after each failed attempt
+                job.status = 'queued'
+                job.run_after = datetime.now() + timedelta(
+                            seconds=self.retry_delay * 2 ** (job.attempts - 1))
+            else:
+                job.status = 'failed'
+                job.finished = datetime.now()
+            self.app.logger.exception('Job %d (%s) failed', job.id, job.name)
+        else:
+            job.status = 'done'
+            job.result = json.dumps(result)
+            job.error = None
+            job.finished = datetime.now()
+        finally:
+            done.set()
+            renewer.join()
+        db.session.commit()
+
+    def run_pending(self):
+        ''' Run due jobs from the calling thread, in an app context, until
+            none are left. Returns number of jobs run.'''
+
+        count = 0
+        while True:
+            job = self._claim()
+            if job is None:
+                return count
+            self._execute(job)
+            count += 1
+
+    def _run(self):
+        while True:
+            try:
+                self.wakeups.get(timeout=self.poll_interval)
+            except queue.Empty:
+                # Look for retries and jobs submitted by other processes
+                pass
+            try:
+                with self.app.app_context():
+                    self.run_pending()
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception('Job worker failed')
+
+
+class JobRunner(object):
+    ''' Registry of tasks, and the JobWorkers of each app.
+
+        Each app gets its own workers, so jobs of one app are never run
+        against another app's database when a process creates several
+        (benchmarks, tests).'''
+
+    def __init__(self, app=None):
+        self.tasks = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        workers = app.extensions['jobs'] = JobWorkers(app, self.tasks)
+        # Workers start with the server, not with manager commands
+        app.before_first_request(workers.start)
+
+    def task(self, name):
+        ''' Decorator registering a function as the task called name. It
+            is called with the job's arguments and returns a JSON
+            serializable result.'''
+
+        def register(func):
+            self.tasks[name] = func
+            return func
+        return register
+
+    def submit(self, name, max_attempts=None, **arguments):
+        ''' Store a job running task name with arguments and wake a worker
+            of the current app. Commits the session. Returns the job.'''
+
+        if name not in self.tasks:
+            raise ValueError('Unknown task %s.' % name)
+        if max_attempts is None:
+            max_attempts = current_app.config['JOB_MAX_ATTEMPTS']
+        now = datetime.now()
+        job = Job(name=name, arguments=json.dumps(arguments), status='queued',
+                  attempts=0, max_attempts=max_attempts, created=now, run_after=now)
+        db.session.add(job)
+        db.session.commit()
+        current_app.extensions['jobs'].wake(job.id)
+        return job
+
+    def run_pending(self):
+        ''' Run due jobs of the current app from the calling thread until
+            none are left. Returns number of jobs run.'''
+
+        return current_app.extensions['jobs'].run_pending()
+
+
+def job_status(job):
+    ''' Return JSON serializable dict describing a job.'''
+
+    def timestamp(date):
+        return date.isoformat() if date else None
+
+    return dict(id=job.id,
+                name=job.name,
+                status=job.status,
+                attempts=job.attempts,
+                max_attempts=job.max_attempts,
+                result=json.loads(job.result) if job.result else None,
+                error=job.error.strip().splitlines()[-1] if job.error else None,
+                created=timestamp(job.created),
+                started=timestamp(job.started),
+                finished=timestamp(job.finished))
+
+
+jobs = JobRunner()
+
+
+@jobs.task('remove_media')
+def remove_media(filenames):
+    ''' Delete media files from the upload folder. Files already gone are
+        reported, not treated as errors.'''
+
+    folder = current_app.config['UPLOAD_FOLDER']
+    removed, missing = [], []
+    for filename in filenames:
+        try:
+            os.remove(os.path.join(folder, filename))
+        except OSError:
+            missing.append(filename)
+        else:
+            removed.append(filename)
+    return dict(removed=removed, missing=missing)
+
+
+@jobs.task('build_game')
+def build_game_job(game_id, path):
+    ''' Add devices and questions from a saved zip archive to a game, then
+        delete the archive.'''
+
+    from .builder import build_game
+    from .models import game_device_link
+    from .narration import queue_narration
+    from .tagtable import tag_table
+
+    try:
+        result = build_game(game_id, path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    tag_table.rebuild()
+    device_ids = db.session.query(game_device_link.c.device_id).filter(
+                game_device_link.c.game_id == game_id)
+    queue_narration([device_id for (device_id,) in device_ids])
+    return result
+
+
+JobCommand = Manager(usage='Run and inspect background jobs')
+
+
+@JobCommand.command
+def run():
+    ''' Run due jobs now, e.g. ones left queued while the server was down.'''
+
+    print('Ran %d jobs.' % jobs.run_pending())
+
+
+@JobCommand.option('-n', '--limit', dest='limit', default=20, type=int,
+                   help='Number of jobs to list (default: 20)')
+def recent(limit):
+    ''' List the most recent jobs.'''
+
+    for job in Job.query.order_by(Job.id.desc()).limit(limit):
+        status = job_status(job)
+        print('%6d  %-12s  %-7s  %d/%d  %s' % (status['id'], status['name'], status['status'],
+                                             status['attempts'], status['max_attempts'],
+                                             status['error'] or status['result'] or ''))
@@ -0,0 +1,112 @@
+''' Live attendance counters for the admin dashboard.
+
+    Counters for today and the current hour are kept in memory and
+    updated by the members() check-in view, so watching attendance does
+    not query the database. Subscribers (the dashboard's event stream)
+    receive every check-in as it happens.'''
+
+import threading
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from app import db
+from .models import MemberVisit
+
+
+class CheckInMonitor(object):
+    ''' Running check-in counters with publish/subscribe of check-ins.'''
+
+    def __init__(self, subscriber_queue_size=100):
+        self.subscriber_queue_size = subscriber_queue_size
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._seeded = False
+        self._day = None
+        self._hour = None
+        self.today = 0
+        self.this_hour = 0
+        self.members_today = set()
+
+    def _roll(self, now):
+        ''' Reset counters when the day or hour changes.'''
+
+        if now.date() != self._day:
+            self._day = now.date()
+            self.today = 0
+            self.members_today = set()
+        if now.hour != self._hour:
+            self._hour = now.hour
+            self.this_hour = 0
+
+    def _seed(self, now):
+        ''' Load today's counts once, so a restart does not zero them.'''
+
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        rows = db.session.query(MemberVisit.member, MemberVisit.date).filter(
+                    MemberVisit.date >= midnight)
+        self._roll(now)
+        for member_id, date in rows:
+            self.today += 1
+            self.members_today.add(member_id)
+            if date >= hour:
+                self.this_hour += 1
+        self._seeded = True
+
+    def _counters(self):
+        return dict(today=self.today,
+                    this_hour=self.this_hour,
+                    unique_members=len(self.members_today))
+
+    def snapshot(self):
+        ''' Return current counters.'''
+
+        now = datetime.now()
+        with self._lock:
+            if not self._seeded:
+                self._seed(now)
+            self._roll(now)
+            return self._counters()
+
+    def record(self, member, date):
+        ''' Count a check-in and publish it to subscribers.'''
+
+        with self._lock:
+            if not self._seeded:
+                # Seeding reads the check-in being recorded, if committed
+                self._seed(date)
+            else:
+                self._roll(date)
+                self.today += 1
+                self.this_hour += 1
+                self.members_today.add(member.id)
+            event = dict(name='%s %s' % (member.member_first_name, member.member_last_name),
+                         time=date.strftime('%H:%M:%S'),
+                         counters=self._counters())
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Slow subscriber, it will catch up from later counters
+                pass
+
+    def subscribe(self):
+        ''' Return a queue receiving every check-in.'''
+
+        subscriber = queue.Queue(self.subscriber_queue_size)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+
+check_ins = CheckInMonitor()
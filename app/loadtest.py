@@ -0,0 +1,376 @@
+''' Load test of many kiosks against a locally started server.
+
+    A server is started in its own process on a free local port, so
+    kiosk threads do not compete with it for the interpreter lock, backed
+    by a throwaway database of synthetic games, questions, devices, media
+    and members. Each simulated kiosk is a thread with its own session
+    cookie (the development server speaks HTTP/1.0, so every request opens
+    a connection) that repeatedly waits a random think time and then does
+    one of:
+
+        learning scan   validate a tag in a learning game, then fetch
+                        its media if valid
+        challenge scan  validate a tag for the current question, then
+                        fetch its media if valid
+        navigation      move to the next or previous challenge question
+                        and load the question page
+        check-in        scan a membership card at the members page
+
+    Like pages on browsers with crypto.subtle, half the kiosks fetch the
+    answer bundle when opening a challenge game, validate challenge scans
+    with it and report them every REPORT_INTERVAL seconds; the others
+    validate each challenge scan on the server.
+
+    Latency of every request is recorded by endpoint and reported with
+    throughput and error rates as JSON, so runs of different releases
+    can be compared.'''
+
+import hashlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode
+except ImportError:
+    from httplib import HTTPConnection
+    from urllib import urlencode
+
+from werkzeug.serving import make_server
+
+from app import create_app, db
+from .benchmarks import populate, scratch_app
+from .models import Device, Game, game_device_link, GameMode, Question, question_answer_link
+
+
+# Relative frequency of kiosk actions
+ACTIONS = (('learning scan', 40), ('challenge scan', 25), ('navigation', 15), ('check-in', 20))
+# Share of scans that are of a tag in the game
+VALID_SCANS = 0.8
+QUESTIONS_PER_GAME = 5
+# Share of kiosks validating challenge scans with the answer bundle
+BUNDLE_KIOSKS = 0.5
+# Seconds between reports of scans validated with the bundle, as on the page
+REPORT_INTERVAL = 5
+
+
+def percentile(ordered, fraction):
+    ''' Return nearest-rank percentile of sorted values.'''
+
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def prepare(members, games, devices_per_game, media_kib, static_folder):
+    ''' Populate the scratch database and media files.
+
+        Odd games are learning games, even games challenge games with
+        QUESTIONS_PER_GAME questions of two answers each. Returns dict of
+        learning and challenge game ids to their device tags and, for
+        challenge games, question ids to answer tags, plus member card
+        numbers.'''
+
+    db.session.add_all([GameMode(id=1, mode='learning'), GameMode(id=2, mode='challenge')])
+    db.session.commit()
+    populate(members, games, devices_per_game)
+    db.session.execute(Game.__table__.update().where(Game.id % 2 == 0).values(Mode=2))
+
+    tags = {}
+    for game_id, tag in db.session.query(game_device_link.c.game_id, Device.rfid_tag).join(
+                Device, Device.id == game_device_link.c.device_id):
+        tags.setdefault(game_id, []).append(tag)
+    ids = dict((tag, device_id) for device_id, tag in db.session.query(Device.id, Device.rfid_tag))
+
+    questions = {}
+    links = []
+    for game_id in range(2, games + 1, 2):
+        questions[game_id] = {}
+        for number in range(QUESTIONS_PER_GAME):
+            question = Question(question='Question %d' % number, game=game_id)
+            db.session.add(question)
+            db.session.flush()
+            answers = tags[game_id][number * 2:number * 2 + 2]
+            questions[game_id][question.id] = answers
+            links.extend(dict(question_id=question.id, device_id=ids[tag]) for tag in answers)
+    if links:
+        db.session.execute(question_answer_link.insert(), links)
+    db.session.commit()
+
+    # Devices of populate() point at device<i>.png
+    media = os.path.join(static_folder, 'media')
+    os.makedirs(media)
+    content = os.urandom(media_kib * 1024)
+    for device_id in ids.values():
+        with open(os.path.join(media, 'device%d.png' % (device_id - 1)), 'wb') as image:
+            image.write(content)
+
+    return dict(learning=dict((game_id, tags[game_id]) for game_id in tags if game_id % 2),
+                challenge=questions,
+                challenge_tags=dict((game_id, tags[game_id]) for game_id in questions),
+                cards=['%010d' % i for i in range(members)])
+
+
+class Kiosk(threading.Thread):
+    ''' Simulated kiosk repeating a random mix of actions until stopped.'''
+
+    def __init__(self, port, plan, think, stop, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.connection = HTTPConnection('127.0.0.1', port, timeout=30)
+        self.plan = plan
+        self.think = think
+        self.stop = stop
+        self.random = random.Random(seed)
+        self.cookie = None
+        # endpoint -> list of (seconds, ok)
+        self.samples = {}
+        self.challenge = None
+        # Answer bundle of the open challenge game, if validating with one
+        self.uses_bundle = self.random.random() < BUNDLE_KIOSKS
+        self.bundle = None
+        self.pending = []
+        self.reported = time.time()
+
+    def request(self, endpoint, method, path, body=None, data=None):
+        ''' Make one request, recording its latency under endpoint. body
+            is sent as form fields, data as JSON. Returns (status,
+            content), status None if it failed.'''
+
+        headers = {}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            body = urlencode(body)
+        elif data is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(data)
+        start = time.time()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            content = response.read()
+            status = response.status
+            cookie = response.getheader('Set-Cookie')
+            if cookie:
+                self.cookie = cookie.split(';', 1)[0]
+        except Exception:
+            self.connection.close()
+            status, content = None, None
+        ok = status is not None and status < 400
+        self.samples.setdefault(endpoint, []).append((time.time() - start, ok))
+        return status, content
+
+    def scan(self, endpoint, path, params):
+        ''' Validate a scan and fetch its media if it is valid.'''
+
+        status, content = self.request(endpoint, 'GET', path + '?' + urlencode(params))
+        if status == 200:
+            result = json.loads(content.decode('utf-8'))
+            if result.get('valid') == 'true':
+                self.request('media', 'GET', result['file_loc'])
+
+    def pick_tag(self, tags):
+        if self.random.random() < VALID_SCANS:
+            return self.random.choice(tags)
+        return 'X%09d' % self.random.randint(0, 10 ** 9)
+
+    def learning_scan(self):
+        game_id = self.random.choice(list(self.plan['learning']))
+        self.scan('validate learning', '/_validate_learning_tag',
+                  dict(game_id=game_id, tag=self.pick_tag(self.plan['learning'][game_id])))
+
+    def open_challenge(self):
+        ''' Start a random challenge game at its first question.'''
+
+        self.report_scans()
+        self.challenge = [self.random.choice(list(self.plan['challenge'])), 0]
+        self.request('challenge page', 'GET', '/games/challenge/%d' % self.challenge[0])
+        if self.uses_bundle:
+            self.load_bundle()
+
+    def load_bundle(self):
+        self.bundle = None
+        status, content = self.request('challenge bundle', 'GET', '/_challenge_bundle?' +
+                                       urlencode(dict(game_id=self.challenge[0])))
+        if status == 200:
+            self.bundle = json.loads(content.decode('utf-8'))
+
+    def validate_locally(self, question_id, tag):
+        ''' Validate a scan with the bundle as challenge.js does, fetch
+            its media if valid and queue it for reporting.'''
+
+        digest = hashlib.sha256((self.bundle['salt'] + tag).encode('utf-8')).hexdigest()
+        answers = self.bundle['questions'][str(question_id)]
+        if digest in answers:
+            self.request('media', 'GET', answers[digest]['file_loc'])
+        self.pending.append(dict(question_id=question_id, tag=tag, first_try=False))
+
+    def report_scans(self):
+        ''' Report scans validated with the bundle, fetching a new bundle
+            if the server says it is stale.'''
+
+        self.reported = time.time()
+        if not self.pending or self.bundle is None:
+            return
+        scans, self.pending = self.pending, []
+        status, content = self.request('report challenge scans', 'POST', '/_report_challenge_scans',
+                                       data=dict(token=self.bundle['token'], scans=scans))
+        if status == 200 and json.loads(content.decode('utf-8')).get('stale'):
+            self.load_bundle()
+
+    def challenge_scan(self):
+        if self.challenge is None:
+            self.open_challenge()
+        game_id, number = self.challenge
+        questions = sorted(self.plan['challenge'][game_id])
+        question_id = questions[number]
+        if self.random.random() < VALID_SCANS:
+            tag = self.random.choice(self.plan['challenge'][game_id][question_id])
+        else:
+            tag = self.pick_tag(self.plan['challenge_tags'][game_id])
+        if self.bundle is not None:
+            self.validate_locally(question_id, tag)
+        else:
+            self.scan('validate challenge', '/_validate_challenge_tag',
+                      dict(game_id=game_id, question_id=question_id, tag=tag))
+
+    def navigate(self):
+        if self.challenge is None:
+            self.open_challenge()
+        game_id, number = self.challenge
+        # Stay within the questions, as the page's buttons do
+        if number == 0 or (number < QUESTIONS_PER_GAME - 1 and self.random.random() < 0.7):
+            button, number = 'next_question', number + 1
+        else:
+            button, number = 'previous_question', number - 1
+        self.challenge[1] = number
+        self.request('challenge navigation', 'POST', '/games/challenge/%d' % game_id,
+                     {button: button})
+        self.request('challenge page', 'GET', '/games/challenge/%d' % game_id)
+
+    def check_in(self):
+        self.request('check-in', 'POST', '/members',
+                     dict(member_tag=self.random.choice(self.plan['cards'])))
+
+    def run(self):
+        actions = dict(zip((name for name, weight in ACTIONS),
+                           (self.learning_scan, self.challenge_scan, self.navigate, self.check_in)))
+        choices = [name for name, weight in ACTIONS for i in range(weight)]
+        while not self.stop.is_set():
+            if self.think:
+                # Exponential think times give bursts as well as lulls
+                if self.stop.wait(self.random.expovariate(1.0 / self.think)):
+                    break
+            actions[self.random.choice(choices)]()
+            if time.time() - self.reported >= REPORT_INTERVAL:
+                self.report_scans()
+        self.report_scans()
+        self.connection.close()
+
+
+def report(kiosks, elapsed):
+    ''' Return dict of overall and per endpoint results of kiosks.'''
+
+    samples = {}
+    for kiosk in kiosks:
+        for endpoint, results in kiosk.samples.items():
+            samples.setdefault(endpoint, []).extend(results)
+
+    endpoints = {}
+    total = errors = 0
+    for endpoint, results in sorted(samples.items()):
+        latencies = sorted(seconds * 1000 for seconds, ok in results)
+        failed = len([ok for seconds, ok in results if not ok])
+        total += len(results)
+        errors += failed
+        endpoints[endpoint] = dict(requests=len(results),
+                                   errors=failed,
+                                   error_rate=float(failed) / len(results),
+                                   throughput_rps=len(results) / elapsed,
+                                   mean_ms=sum(latencies) / len(latencies),
+                                   p50_ms=percentile(latencies, 0.50),
+                                   p95_ms=percentile(latencies, 0.95),
+                                   p99_ms=percentile(latencies, 0.99))
+    return dict(kiosks=len(kiosks),
+                seconds=elapsed,
+                requests=total,
+                errors=errors,
+                error_rate=float(errors) / total if total else 0.0,
+                throughput_rps=total / elapsed,
+                endpoints=endpoints)
+
+
+def serve(settings):
+    ''' Serve an app with settings overriding config.py until killed,
+        after printing the port it listens on.'''
+
+    import config
+
+    # Request logging of the server would swamp the report
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    overrides = dict((name, getattr(config, name)) for name in dir(config) if name.isupper())
+    overrides.update(settings)
+    static_folder = overrides.pop('STATIC_FOLDER')
+    app = create_app(type('LoadTestConfig', (object,), overrides))
+    app.static_folder = static_folder
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    print(server.server_port)
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+def start_server(settings):
+    ''' Start serve(settings) in a new process. Returns the process and
+        the port it listens on.'''
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-m', 'app.loadtest', json.dumps(settings)],
+                               cwd=root, stdout=subprocess.PIPE)
+    port = process.stdout.readline().strip()
+    if not port:
+        process.wait()
+        raise RuntimeError('Load test server exited with status %s.' % process.returncode)
+    return process, int(port)
+
+
+def run_load(kiosks, duration, think, members, games, devices_per_game, media_kib, seed):
+    ''' Serve a scratch database and run kiosks against it for duration
+        seconds. Returns the report() of the run.'''
+
+    with scratch_app() as app:
+        static_folder = os.path.join(os.path.dirname(app.config['TAG_TABLE_PATH']), 'static')
+        plan = prepare(members, games, devices_per_game, media_kib, static_folder)
+        db.session.remove()
+
+        server, port = start_server(dict(SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'],
+                                         TAG_TABLE_PATH=app.config['TAG_TABLE_PATH'],
+                                         STATIC_FOLDER=static_folder))
+        try:
+            stop = threading.Event()
+            simulated = [Kiosk(port, plan, think, stop, seed + number)
+                         for number in range(kiosks)]
+            start = time.time()
+            for kiosk in simulated:
+                kiosk.start()
+            time.sleep(duration)
+            stop.set()
+            for kiosk in simulated:
+                kiosk.join()
+            elapsed = time.time() - start
+        finally:
+            server.terminate()
+            server.wait()
+    return report(simulated, elapsed)
+
+
+if __name__ == '__main__':
+    serve(json.loads(sys.argv[1]))
@@ -0,0 +1,405 @@
+''' Online backups and maintenance of the SQLite database.
+
+    Everything here runs while the server is serving kiosks, so no step
+    holds a lock for more than a few milliseconds:
+
+        backup    copies the database with SQLite's backup API,
+                  BACKUP_STEP_PAGES pages at a time with a pause between
+                  steps; each step only holds a shared lock. Without the
+                  API (Python before 3.7) it uses VACUUM INTO, one read
+                  transaction that never blocks writers in WAL mode
+        analyze   refreshes query planner statistics, reading at most
+                  ANALYSIS_LIMIT rows per index; skipped where SQLite
+                  can not limit it
+        vacuum    returns free pages to the file system in short
+                  transactions of VACUUM_STEP_PAGES pages, once the
+                  database uses incremental auto vacuum
+        report    file size, free pages and fragmentation
+
+    With MAINTENANCE_SCHEDULE set, the server queues a maintenance job
+    doing all of them once a day during MAINTENANCE_HOURS.'''
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+from flask.ext.script import Manager
+
+from app import db
+from .jobs import jobs
+from .models import Job
+
+
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+# SQLite releases adding VACUUM INTO and PRAGMA analysis_limit
+VACUUM_INTO_VERSION = (3, 27, 0)
+ANALYSIS_LIMIT_VERSION = (3, 32, 0)
+
+
+def backup_method():
+    ''' Return how backups are made with this Python and SQLite, or None
+        if they can not be made online.'''
+
+    if hasattr(sqlite3.Connection, 'backup'):
+        return 'backup api'
+    if sqlite3.sqlite_version_info >= VACUUM_INTO_VERSION:
+        return 'vacuum into'
+    return None
+
+
+def database_path():
+    ''' Return path of the application's SQLite database file.'''
+
+    url = db.engine.url
+    if url.drivername != 'sqlite' or not url.database or url.database == ':memory:':
+        raise ValueError('Maintenance needs an SQLite database file.')
+    return url.database
+
+
+def connect(path):
+    # Wait briefly for a kiosk's transaction rather than failing
+    connection = sqlite3.connect(path, timeout=5)
+    connection.isolation_level = None
+    return connection
+
+
+def pragma(connection, name):
+    return connection.execute('PRAGMA %s' % name).fetchone()[0]
+
+
+def database_report(path):
+    ''' Return dict describing size and fragmentation of a database.'''
+
+    connection = connect(path)
+    try:
+        page_size = pragma(connection, 'page_size')
+        pages = pragma(connection, 'page_count')
+        free = pragma(connection, 'freelist_count')
+        auto_vacuum = pragma(connection, 'auto_vacuum')
+        journal_mode = pragma(connection, 'journal_mode')
+    finally:
+        connection.close()
+    wal = path + '-wal'
+    return dict(path=path,
+                file_bytes=os.path.getsize(path),
+                wal_bytes=os.path.getsize(wal) if os.path.exists(wal) else 0,
+                page_size=page_size,
+                pages=pages,
+                free_pages=free,
+                free_bytes=free * page_size,
+                fragmentation=float(free) / pages if pages else 0.0,
+                auto_vacuum=AUTO_VACUUM_MODES.get(auto_vacuum, auto_vacuum),
+                journal_mode=journal_mode)
+
+
+def copy_with_backup_api(source, partial, step_pages, step_sleep, max_restarts):
+    ''' Copy source into the file partial in steps. Returns dict of steps
+        taken and restarts. Raises RuntimeError once writes by other
+        connections have restarted the copy more than max_restarts times.'''
+
+    progress = dict(steps=0, restarts=0, remaining=None)
+
+    def step(status, remaining, total):
+        if progress['remaining'] is not None and remaining > progress['remaining']:
+            progress['restarts'] += 1
+            # Raising aborts the copy
+            if progress['restarts'] > max_restarts:
+                raise RuntimeError('Backup gave up after %d restarts caused by writes; '
+                                   'run it when the kiosks are quieter.' % max_restarts)
+        progress['remaining'] = remaining
+        progress['steps'] += 1
+
+    target = sqlite3.connect(partial)
+    try:
+        source.backup(target, pages=step_pages, progress=step, sleep=step_sleep)
+    finally:
+        target.close()
+    return dict(steps=progress['steps'], restarts=progress['restarts'])
+
+
+def backup_database(path, folder, step_pages, step_sleep, keep, max_restarts):
+    ''' Copy the database at path into a new timestamped file in folder,
+        keeping the newest keep backups. Returns dict with the backup's
+        path, size, method, steps taken, restarts and seconds.
+
+        With the backup API, a write by another connection during the
+        copy makes SQLite restart it; after max_restarts restarts the
+        backup fails. VACUUM INTO copies one snapshot in a single step.'''
+
+    method = backup_method()
+    if method is None:
+        raise RuntimeError('Online backups need Python 3.7 or later, or SQLite %s or later.' %
+                           '.'.join(str(part) for part in VACUUM_INTO_VERSION))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    target_path = os.path.join(folder, '%s-%s.db' % (stem, datetime.now().strftime('%Y%m%d-%H%M%S')))
+    partial = target_path + '.partial'
+
+    start = time.time()
+    source = connect(path)
+    try:
+        if method == 'backup api':
+            progress = copy_with_backup_api(source, partial, step_pages, step_sleep, max_restarts)
+        else:
+            source.execute('VACUUM INTO ?', (partial,))
+            progress = dict(steps=1, restarts=0)
+        target = sqlite3.connect(partial)
+        try:
+            if target.execute('PRAGMA quick_check').fetchone()[0] != 'ok':
+                raise RuntimeError('Backup %s failed its integrity check.' % partial)
+        finally:
+            target.close()
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        source.close()
+    os.rename(partial, target_path)
+
+    backups = sorted(filename for filename in os.listdir(folder)
+                     if filename.startswith(stem + '-') and filename.endswith('.db'))
+    if keep > 0:
+        for filename in backups[:-keep]:
+            os.remove(os.path.join(folder, filename))
+
+    return dict(path=target_path,
+                bytes=os.path.getsize(target_path),
+                method=method,
+                steps=progress['steps'],
+                restarts=progress['restarts'],
+                seconds=time.time() - start)
+
+
+def analyze_database(path, limit):
+    ''' Refresh query planner statistics, reading at most limit rows of
+        each index. Returns seconds taken, or None if this SQLite can not
+        limit the rows read.'''
+
+    # Older releases ignore the limit and would read every index in full
+    if sqlite3.sqlite_version_info < ANALYSIS_LIMIT_VERSION:
+        return None
+    start = time.time()
+    connection = connect(path)
+    try:
+        connection.execute('PRAGMA analysis_limit = %d' % limit)
+        connection.execute('ANALYZE')
+    finally:
+        connection.close()
+    return time.time() - start
+
+
+def vacuum_database(path, step_pages, step_sleep, budget):
+    ''' Release free pages step_pages at a time, for at most budget
+        seconds. Returns dict of pages released and pages still free, or
+        None if the database does not use incremental auto vacuum.'''
+
+    connection = connect(path)
+    try:
+        if pragma(connection, 'auto_vacuum') != 2:
+            return None
+        before = pragma(connection, 'freelist_count')
+        deadline = time.time() + budget
+        free = before
+        while free and time.time() < deadline:
+            # Each step is its own short write transaction. execute()
+            # only steps the pragma once, freeing a single page
+            connection.executescript('PRAGMA incremental_vacuum(%d);' % step_pages)
+            free = pragma(connection, 'freelist_count')
+            time.sleep(step_sleep)
+    finally:
+        connection.close()
+    return dict(released=before - free, free_pages=free)
+
+
+def enable_incremental_vacuum(path):
+    ''' Switch the database to incremental auto vacuum. This rewrites the
+        whole file, locking it throughout, so run it with the server
+        stopped.'''
+
+    connection = connect(path)
+    try:
+        connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        connection.execute('VACUUM')
+    finally:
+        connection.close()
+
+
+def run_maintenance():
+    ''' Back up, analyze and vacuum the application's database. Returns
+        dict of the results and the database report afterwards; backup is
+        None if online backups are not available, and analyze_seconds
+        None if analyzing was skipped.
+
+        Raises RuntimeError if the backup fails, before anything else is
+        done.'''
+
+    config = current_app.config
+    path = database_path()
+    backup = None
+    if backup_method() is not None:
+        backup = backup_database(path, config['BACKUP_FOLDER'], config['BACKUP_STEP_PAGES'],
+                                 config['MAINTENANCE_STEP_SLEEP'], config['BACKUP_KEEP'],
+                                 config['BACKUP_MAX_RESTARTS'])
+    else:
+        # Analyzing and vacuuming still work
+        current_app.logger.warning('Maintenance skipped the backup: it needs Python 3.7 '
+                                   'or later, or a newer SQLite.')
+    analyzed = analyze_database(path, config['ANALYSIS_LIMIT'])
+    if analyzed is None:
+        current_app.logger.warning('Maintenance skipped analyzing: SQLite %s can not limit it.',
+                                   sqlite3.sqlite_version)
+    vacuumed = vacuum_database(path, config['VACUUM_STEP_PAGES'],
+                               config['MAINTENANCE_STEP_SLEEP'], config['VACUUM_BUDGET'])
+    return dict(backup=backup,
+                analyze_seconds=analyzed,
+                vacuum=vacuumed,
+                report=database_report(path))
+
+
+@jobs.task('maintenance')
+def maintenance_job():
+    return run_maintenance()
+
+
+class MaintenanceScheduler(object):
+    ''' Thread queueing a maintenance job once a day in quiet hours.'''
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        if app.config['MAINTENANCE_SCHEDULE']:
+            app.before_first_request(self._start)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='maintenance-scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def due(self, now):
+        ''' Return whether maintenance should be queued at now.'''
+
+        start, end = self.app.config['MAINTENANCE_HOURS']
+        if not start <= now.hour < end:
+            return False
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        # Another server process may have queued it already
+        return Job.query.filter(Job.name == 'maintenance').filter(
+                    Job.created >= midnight).first() is None
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    if self.due(datetime.now()):
+                        jobs.submit('maintenance', max_attempts=1)
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception('Maintenance scheduler failed')
+            time.sleep(self.app.config['MAINTENANCE_CHECK_INTERVAL'])
+
+
+maintenance_scheduler = MaintenanceScheduler()
+
+
+MaintenanceCommand = Manager(usage='Back up and maintain the database while it is in use')
+
+
+def print_report(report):
+    print('%s: %.1f MiB (%d pages of %d bytes), WAL %.1f MiB' % (
+                report['path'], report['file_bytes'] / 1048576.0, report['pages'],
+                report['page_size'], report['wal_bytes'] / 1048576.0))
+    print('Free pages: %d (%.1f MiB, %.1f%% fragmentation)' % (
+                report['free_pages'], report['free_bytes'] / 1048576.0,
+                report['fragmentation'] * 100))
+    print('Auto vacuum: %s, journal mode: %s' % (report['auto_vacuum'], report['journal_mode']))
+
+
+def print_backup(backup):
+    if backup is None:
+        print('Skipped backup: it needs Python 3.7 or later, or SQLite %s or later.' %
+              '.'.join(str(part) for part in VACUUM_INTO_VERSION))
+        return
+    print('Backed up to %s (%.1f MiB) in %.2f s with %s, %d steps, %d restarts.' % (
+                backup['path'], backup['bytes'] / 1048576.0, backup['seconds'],
+                backup['method'], backup['steps'], backup['restarts']))
+
+
+def print_analyze(seconds):
+    if seconds is None:
+        print('Skipped analyzing: SQLite %s can not limit it; 3.32 or later is needed.' %
+              sqlite3.sqlite_version)
+    else:
+        print('Analyzed in %.3f s.' % seconds)
+
+
+def print_vacuum(vacuumed):
+    if vacuumed is None:
+        print('Incremental vacuum is not enabled; run "maintenance enable_vacuum" '
+              'once with the server stopped.')
+    else:
+        print('Released %d free pages, %d left.' % (vacuumed['released'], vacuumed['free_pages']))
+
+
+@MaintenanceCommand.command
+def report():
+    ''' Report database file size and fragmentation.'''
+
+    print_report(database_report(database_path()))
+
+
+@MaintenanceCommand.option('-o', '--output', dest='folder', default=None,
+                           help='Folder to write the backup to (default: BACKUP_FOLDER)')
+def backup(folder):
+    ''' Back up the database without stopping the server.'''
+
+    config = current_app.config
+    print_backup(backup_database(database_path(), folder or config['BACKUP_FOLDER'],
+                                 config['BACKUP_STEP_PAGES'], config['MAINTENANCE_STEP_SLEEP'],
+                                 config['BACKUP_KEEP'], config['BACKUP_MAX_RESTARTS']))
+
+
+@MaintenanceCommand.command
+def analyze():
+    ''' Refresh query planner statistics.'''
+
+    print_analyze(analyze_database(database_path(), current_app.config['ANALYSIS_LIMIT']))
+
+
+@MaintenanceCommand.command
+def vacuum():
+    ''' Return free pages to the file system in small steps.'''
+
+    config = current_app.config
+    print_vacuum(vacuum_database(database_path(), config['VACUUM_STEP_PAGES'],
+                                 config['MAINTENANCE_STEP_SLEEP'], config['VACUUM_BUDGET']))
+
+
+@MaintenanceCommand.command
+def enable_vacuum():
+    ''' Switch the database to incremental vacuum. Stop the server first.'''
+
+    path = database_path()
+    enable_incremental_vacuum(path)
+    print_report(database_report(path))
+
+
+@MaintenanceCommand.command
+def run():
+    ''' Back up, analyze and vacuum, as the scheduler does.'''
+
+    result = run_maintenance()
+    print_backup(result['backup'])
+    print_analyze(result['analyze_seconds'])
+    print_vacuum(result['vacuum'])
+    print_report(result['report'])
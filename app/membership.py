@@ -0,0 +1,212 @@
+''' Member check-ins and visit statistics.
+
+    Each Member carries its visit count and first and last visit dates so
+    member pages never have to scan member_visits. record_visit keeps them
+    up to date; the "members check" command verifies them.
+
+    Cards are often scanned several times in a row at the entrance.
+    check_in() only records a visit if the member has none in the last
+    CHECK_IN_REPEAT_WINDOW seconds; otherwise it counts a repeat on that
+    visit.'''
+
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from flask import current_app
+from flask.ext.script import Manager
+from sqlalchemy import func
+
+from app import db
+from .models import Member, MemberVisit
+from .replication import log_visit
+from .reports import member_visit_stats
+from .roster import import_members
+
+
+def record_visit(member, date):
+    ''' Log a visit by member and update its visit statistics.
+
+        Statistics are updated with SQL expressions in the caller's
+        transaction, so concurrent check-ins cannot lose an increment.
+        The visit is also added to the change log for replication.
+        Caller is responsible for committing.'''
+
+    visit = MemberVisit(member=member.id, date=date)
+    db.session.add(visit)
+    log_visit(member, date)
+    member.visit_count = Member.visit_count + 1
+    member.first_visit = func.coalesce(Member.first_visit, date)
+    member.last_visit = date
+    return visit
+
+
+class RecentCheckIns(object):
+    ''' Latest visit of recently checked in members, most recent last.
+
+        Only a hint: a member missing from it, or with an older visit, is
+        looked up in member_visits by its member and date index, since
+        another server process may have checked them in.
+
+        Also holds the locks serializing check-ins of a member, so two
+        threads scanning the same card can not both add a visit.'''
+
+    def __init__(self, max_entries=10000, member_locks=64):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # member id -> (visit id, date)
+        self._visits = OrderedDict()
+        # Members share a fixed number of locks, so none are ever created
+        self._member_locks = [threading.Lock() for i in range(member_locks)]
+        self.hits = 0
+        self.misses = 0
+        self.repeats = 0
+
+    def remember(self, member_id, visit_id, date):
+        with self._lock:
+            self._visits.pop(member_id, None)
+            self._visits[member_id] = (visit_id, date)
+            while len(self._visits) > self.max_entries:
+                self._visits.popitem(last=False)
+
+    def count_repeat(self):
+        with self._lock:
+            self.repeats += 1
+
+    def forget(self, member_id):
+        with self._lock:
+            self._visits.pop(member_id, None)
+
+    def member_lock(self, member_id):
+        ''' Return lock to hold while checking member in.'''
+
+        return self._member_locks[member_id % len(self._member_locks)]
+
+    def latest(self, member_id, since):
+        ''' Return (visit id, date) of the latest visit by member at or
+            after since, or None.'''
+
+        with self._lock:
+            cached = self._visits.get(member_id)
+            if cached is not None and cached[1] >= since:
+                self.hits += 1
+                return cached
+            self.misses += 1
+        row = db.session.query(MemberVisit.id, MemberVisit.date).filter(
+                    MemberVisit.member == member_id).filter(
+                    MemberVisit.date >= since).order_by(
+                    MemberVisit.date.desc()).first()
+        if row is None:
+            return None
+        self.remember(member_id, row[0], row[1])
+        return tuple(row)
+
+    def stats(self):
+        ''' Return counters describing the cache.'''
+
+        with self._lock:
+            return dict(members=len(self._visits),
+                        hits=self.hits,
+                        misses=self.misses,
+                        repeats=self.repeats)
+
+
+recent_check_ins = RecentCheckIns()
+
+
+def check_in(member, date):
+    ''' Check member in at date and commit.
+
+        A scan within CHECK_IN_REPEAT_WINDOW seconds of the member's
+        latest visit increments that visit's repeat counter instead of
+        adding a visit. Returns True if a visit was added.'''
+
+    window = current_app.config['CHECK_IN_REPEAT_WINDOW']
+    with recent_check_ins.member_lock(member.id):
+        if window > 0:
+            latest = recent_check_ins.latest(member.id, date - timedelta(seconds=window))
+            if latest is not None:
+                result = db.session.execute(MemberVisit.__table__.update().where(
+                            MemberVisit.id == latest[0]).values(
+                            Repeats=MemberVisit.repeats + 1))
+                if result.rowcount:
+                    db.session.commit()
+                    recent_check_ins.count_repeat()
+                    return False
+                # The visit was archived or deleted since it was cached
+                recent_check_ins.forget(member.id)
+        visit = record_visit(member, date)
+        db.session.commit()
+        recent_check_ins.remember(member.id, visit.id, date)
+        return True
+
+
+def checked_visit(stored, actual, archived):
+    ''' Return the first or last visit to store given the one found in
+        visit history. An archived visit is only known to the day, so a
+        stored time on that day is kept.'''
+
+    if archived and stored is not None and stored.date() == actual.date():
+        return stored
+    return actual
+
+
+def check_visit_stats(fix=False):
+    ''' Compare stored visit statistics against visit history.
+
+        Returns list of (member, stored, actual) tuples for members whose
+        statistics are wrong. If fix is True, they are corrected.'''
+
+    mismatches = []
+    for member in Member.query.order_by(Member.id).yield_per(500):
+        stored = (member.visit_count, member.first_visit, member.last_visit)
+        num_visits, first_visit, last_visit, first_archived, last_archived = \
+                    member_visit_stats(member.id)
+        actual = (num_visits,
+                  checked_visit(member.first_visit, first_visit, first_archived),
+                  checked_visit(member.last_visit, last_visit, last_archived))
+        if stored != actual:
+            mismatches.append((member, stored, actual))
+    if fix:
+        for member, stored, actual in mismatches:
+            member.visit_count, member.first_visit, member.last_visit = actual
+        db.session.commit()
+    return mismatches
+
+
+MemberCommand = Manager(usage='Import members and maintain their visit statistics')
+
+
+@MemberCommand.option('--fix', dest='fix', action='store_true', default=False,
+                      help='Correct statistics that do not match visit history')
+def check(fix):
+    ''' Verify denormalized visit statistics of every member.'''
+
+    mismatches = check_visit_stats(fix)
+    for member, stored, actual in mismatches:
+        print('Member %d: stored %s, actual %s' % (member.id, stored, actual))
+    if not mismatches:
+        print('All member visit statistics are consistent.')
+    elif fix:
+        print('Fixed %d members.' % len(mismatches))
+    else:
+        print('%d members inconsistent. Run with --fix to correct.' % len(mismatches))
+
+
+@MemberCommand.option('path', help='CSV file with first_name, last_name and card_number columns')
+@MemberCommand.option('-b', '--batch', dest='batch_size', type=int, default=5000,
+                      help='Members per insert batch')
+@MemberCommand.option('--dry-run', dest='dry_run', action='store_true', default=False,
+                      help='Validate the file without importing')
+def load(path, batch_size, dry_run):
+    ''' Import members from a CSV roll, skipping known card numbers.'''
+
+    with open(path, 'rb') as roll:
+        result = import_members(roll, batch_size, dry_run)
+    for line, reason in result['invalid']:
+        print('Line %d: %s' % (line, reason))
+    print('%s %d members, skipped %d duplicate and %d invalid rows '
+          'in %.2f s (%.0f rows/s).' % ('Validated' if dry_run else 'Imported',
+                                       result['added'], result['duplicates'],
+                                       len(result['invalid']), result['seconds'],
+                                       result['rate']))
@@ -1,6 +1,6 @@
 from app import db
 from flask import session
-from werkzeug.security import check_password_hash, generate_password_hash
+from .registry import game_modes
 
 class User(db.Model):
     ''' User model.'''
@@ -41,10 +41,13 @@ class User(db.Model):
         except NameError:
             return str(self.id)
 
+    # werkzeug.security is imported on demand since only admin login uses it
     def set_password(self, password):
+        from werkzeug.security import generate_password_hash
         self.password = generate_password_hash(password)
 
     def check_password(self, password):
+        from werkzeug.security import check_password_hash
         return check_password_hash(self.password, password)
 
     def __repr__(self):
@@ -66,6 +69,9 @@ class GameMode(db.Model):
     def __repr__(self):
         return self.mode
 
+# Keep in-memory game mode registry in sync with table
+game_modes.watch(GameMode)
+
 
 # A Game has many Devices and a Device can belong to many games, therefore
 # we define the following helper table for this relationship.
@@ -150,7 +156,12 @@ class Member(db.Model):
     id = db.Column('id', db.Integer, primary_key=True)
     member_first_name = db.Column('FirstName', db.String(50))
     member_last_name = db.Column('LastName', db.String(50))
-    card_number = db.Column('CardNumber', db.String(50))
+    # Looked up on every check-in and replicated change
+    card_number = db.Column('CardNumber', db.String(50), index=True)
+    # Denormalized visit statistics, maintained by app.membership.record_visit
+    visit_count = db.Column('VisitCount', db.Integer, nullable=False, default=0, server_default='0')
+    first_visit = db.Column('FirstVisit', db.DateTime)
+    last_visit = db.Column('LastVisit', db.DateTime)
     visits = db.relationship('MemberVisit', backref='member_id', lazy='dynamic')
 
     def __repr__(self):
@@ -161,7 +172,170 @@ class MemberVisit(db.Model):
     ''' Log of visits by member.'''
 
     __tablename__ = 'member_visits'
+    # Ids are never reused, as archived visits keep theirs
+    __table_args__ = (
+        db.Index('ix_member_visits_member_date', 'MemberID', 'Date'),
+        db.Index('ix_member_visits_date', 'Date'),
+        {'sqlite_autoincrement': True})
 
     id = db.Column('id', db.Integer, primary_key=True)
     member = db.Column('MemberID', db.Integer, db.ForeignKey('members.id'))
     date = db.Column('Date', db.DateTime)       
+    # Further scans of the card within CHECK_IN_REPEAT_WINDOW of the visit
+    repeats = db.Column('Repeats', db.Integer, nullable=False, default=0, server_default='0')
+
+
+class ArchivedMemberVisit(db.Model):
+    ''' Visit moved out of member_visits by the archiver.
+
+        Kept for auditing only; reports use MemberVisitRollup.'''
+
+    __tablename__ = 'member_visits_archive'
+    __table_args__ = (
+        db.Index('ix_member_visits_archive_member_date', 'MemberID', 'Date'),)
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    member = db.Column('MemberID', db.Integer, db.ForeignKey('members.id'))
+    date = db.Column('Date', db.DateTime)
+    repeats = db.Column('Repeats', db.Integer, nullable=False, default=0, server_default='0')
+
+
+class MemberVisitRollup(db.Model):
+    ''' Number of archived visits by a member on a given day.'''
+
+    __tablename__ = 'member_visit_rollups'
+    __table_args__ = (db.UniqueConstraint('MemberID', 'Day'),)
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    member = db.Column('MemberID', db.Integer, db.ForeignKey('members.id'), nullable=False)
+    day = db.Column('Day', db.Date, nullable=False, index=True)
+    visits = db.Column('Visits', db.Integer, nullable=False, default=0)
+
+
+class ScanEvent(db.Model):
+    ''' RFID tag scanned while playing a game.
+
+        Written in batches by app.scanlog, never from a request.'''
+
+    __tablename__ = 'scan_events'
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    game = db.Column('GameID', db.Integer, db.ForeignKey('games.id'), index=True)
+    question = db.Column('QuestionID', db.Integer, db.ForeignKey('questions.id'))
+    device = db.Column('DeviceID', db.Integer, db.ForeignKey('devices.id'))
+    tag = db.Column('Tag', db.String(50))
+    valid = db.Column('Valid', db.Boolean, nullable=False)
+    # First scan made for the question currently shown (challenge games)
+    first_try = db.Column('FirstTry', db.Boolean, nullable=False, default=False, server_default='0')
+    date = db.Column('Date', db.DateTime, index=True)
+
+
+class ScanRollup(db.Model):
+    ''' Scan counts per hour, game, matched device and question.
+
+        Maintained by app.analytics as scan events are written, so usage
+        reports never read scan_events.'''
+
+    __tablename__ = 'scan_hourly_rollups'
+    __table_args__ = (db.UniqueConstraint('Hour', 'GameID', 'DeviceID', 'QuestionID'),)
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    hour = db.Column('Hour', db.DateTime, nullable=False)
+    game = db.Column('GameID', db.Integer, db.ForeignKey('games.id'), index=True)
+    device = db.Column('DeviceID', db.Integer, db.ForeignKey('devices.id'))
+    question = db.Column('QuestionID', db.Integer, db.ForeignKey('questions.id'))
+    scans = db.Column('Scans', db.Integer, nullable=False, default=0)
+    valid_scans = db.Column('ValidScans', db.Integer, nullable=False, default=0)
+    first_tries = db.Column('FirstTries', db.Integer, nullable=False, default=0)
+    first_try_successes = db.Column('FirstTrySuccesses', db.Integer, nullable=False, default=0)
+
+
+class Job(db.Model):
+    ''' Slow admin task run in the background by app.jobs.'''
+
+    __tablename__ = 'jobs'
+    __table_args__ = (db.Index('ix_jobs_status_run_after', 'Status', 'RunAfter'),)
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    name = db.Column('Name', db.String(50), nullable=False)
+    # JSON encoded keyword arguments of the task
+    arguments = db.Column('Arguments', db.Text, nullable=False, default='{}')
+    # queued, running, done or failed
+    status = db.Column('Status', db.String(10), nullable=False, default='queued')
+    attempts = db.Column('Attempts', db.Integer, nullable=False, default=0, server_default='0')
+    max_attempts = db.Column('MaxAttempts', db.Integer, nullable=False, default=1, server_default='1')
+    # JSON encoded return value of the task
+    result = db.Column('Result', db.Text)
+    error = db.Column('Error', db.Text)
+    created = db.Column('Created', db.DateTime)
+    # Queued jobs wait until then, e.g. before a retry
+    run_after = db.Column('RunAfter', db.DateTime)
+    started = db.Column('Started', db.DateTime)
+    # Renewed by the worker running the job; a running job whose lease
+    # has run out was left by a process that died
+    lease_until = db.Column('LeaseUntil', db.DateTime)
+    finished = db.Column('Finished', db.DateTime)
+
+
+class Change(db.Model):
+    ''' Member or visit written on this node, in the order written.
+
+        Appended in the transaction of the write and pushed to the central
+        node by app.replication; never updated.'''
+
+    __tablename__ = 'change_log'
+    # Ids are never reused once acknowledged changes are pruned
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    # member or visit
+    entity = db.Column('Entity', db.String(10), nullable=False)
+    # insert, update or delete
+    operation = db.Column('Operation', db.String(10), nullable=False)
+    # Card the change applies to; the previous card of an update
+    card_number = db.Column('CardNumber', db.String(50), nullable=False)
+    # JSON encoded fields of the change
+    data = db.Column('Data', db.Text, nullable=False, default='{}')
+    created = db.Column('Created', db.DateTime)
+
+
+class ReplicationPeer(db.Model):
+    ''' Progress of replication with another node.
+
+        On a satellite, Sent is the last change the central node
+        acknowledged; on the central node, Received is the last change of
+        the satellite that was applied.'''
+
+    __tablename__ = 'replication_peers'
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    # Node name of a satellite, or URL of the central node
+    node = db.Column('Node', db.String(200), nullable=False, unique=True)
+    sent = db.Column('Sent', db.Integer, nullable=False, default=0, server_default='0')
+    received = db.Column('Received', db.Integer, nullable=False, default=0, server_default='0')
+    synced = db.Column('Synced', db.DateTime)
+
+
+class ReplicationConflict(db.Model):
+    ''' Change from a satellite the central node could not apply as is.'''
+
+    __tablename__ = 'replication_conflicts'
+
+    id = db.Column('id', db.Integer, primary_key=True)
+    node = db.Column('Node', db.String(200), nullable=False)
+    # Id of the change in the satellite's change log
+    sequence = db.Column('Sequence', db.Integer, nullable=False)
+    card_number = db.Column('CardNumber', db.String(50))
+    reason = db.Column('Reason', db.String(200), nullable=False)
+    # JSON encoded change as received
+    change = db.Column('Change', db.Text, nullable=False)
+    created = db.Column('Created', db.DateTime)
+
+
+class DataVersion(db.Model):
+    ''' Version of a table cached in memory, see app.versions.'''
+
+    __tablename__ = 'data_versions'
+
+    name = db.Column('Name', db.String(50), primary_key=True)
+    version = db.Column('Version', db.Integer, nullable=False, default=0, server_default='0')
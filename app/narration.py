@@ -0,0 +1,175 @@
+''' Pre-rendered narration of device descriptions.
+
+    Kiosks used to synthesize every description in the browser when a
+    device was scanned, which is slow to start and sounds different on
+    every browser. Instead, a background job renders each description
+    with an offline text-to-speech engine (NARRATION_ENGINE, off by
+    default) and compresses it (NARRATION_ENCODER) into NARRATION_FOLDER,
+    named by a hash of the text and the commands. Devices sharing a
+    description share a file, and changing the voice renders everything
+    again.
+
+    Validation responses carry the file's URL as "narration" once it
+    exists; until then pages fall back to speaking in the browser.'''
+
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from flask import current_app
+from flask.ext.script import Manager
+
+from app import db
+from .jobs import jobs
+from .models import Device
+
+
+# Narrations are encoded to files with this prefix and renamed when done
+PARTIAL_PREFIX = '.partial.'
+
+
+def narration_name(text):
+    ''' Return file name of the narration of text with the current
+        engine and encoder settings.'''
+
+    config = current_app.config
+    settings = json.dumps([config['NARRATION_ENGINE'], config['NARRATION_ENCODER']])
+    digest = hashlib.sha1(settings.encode('utf-8') + b'\0' + text.encode('utf-8')).hexdigest()
+    return '%s.%s' % (digest, config['NARRATION_FORMAT'])
+
+
+def narration_url(text):
+    ''' Return URL of the narration of text, or None if not rendered.'''
+
+    if not text or not current_app.config['NARRATION_ENGINE']:
+        return None
+    name = narration_name(text)
+    if not os.path.exists(os.path.join(current_app.config['NARRATION_FOLDER'], name)):
+        return None
+    return '/static/narration/' + name
+
+
+def run_command(template, **values):
+    ''' Run a command given as a list of arguments with {name}
+        placeholders. Raises RuntimeError if it is missing or fails, or
+        if a {text} argument could be read as an option.'''
+
+    # Descriptions may start with '-', so text must follow '--'
+    for number, argument in enumerate(template):
+        if argument == '{text}' and '--' not in template[:number]:
+            raise RuntimeError("Put '--' before {text} in %s." % ' '.join(template))
+    arguments = [argument.format(**values) for argument in template]
+    try:
+        subprocess.check_call(arguments)
+    except OSError as e:
+        raise RuntimeError('Could not run %s: %s' % (arguments[0], e))
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError('%s exited with status %d.' % (arguments[0], e.returncode))
+
+
+def render_narration(text):
+    ''' Render text to its narration file unless it exists. Returns
+        True if it was rendered.'''
+
+    config = current_app.config
+    folder = config['NARRATION_FOLDER']
+    name = narration_name(text)
+    path = os.path.join(folder, name)
+    if os.path.exists(path):
+        return False
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    handle, wav = tempfile.mkstemp(suffix='.wav')
+    os.close(handle)
+    # Encoders pick the format from the extension, so it is kept
+    partial = os.path.join(folder, PARTIAL_PREFIX + name)
+    try:
+        run_command(config['NARRATION_ENGINE'], text=text, wav=wav)
+        run_command(config['NARRATION_ENCODER'], wav=wav, output=partial)
+        os.rename(partial, path)
+    finally:
+        for leftover in (wav, partial):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return True
+
+
+def render_devices(device_ids=None):
+    ''' Render narrations of devices, or of every device, and rebuild the
+        tag table if any were rendered. Returns dict of counts.'''
+
+    from .tagtable import tag_table
+
+    query = db.session.query(Device.description).distinct()
+    if device_ids is not None:
+        query = query.filter(Device.id.in_(device_ids))
+    rendered = cached = 0
+    for (description,) in query:
+        if not description:
+            continue
+        if render_narration(description):
+            rendered += 1
+        else:
+            cached += 1
+    # Scans are answered from the tag table, which holds narration URLs
+    if rendered:
+        tag_table.rebuild()
+    return dict(rendered=rendered, cached=cached)
+
+
+def queue_narration(device_ids):
+    ''' Queue rendering of the narrations of devices, if enabled.'''
+
+    if current_app.config['NARRATION_ENGINE'] and device_ids:
+        jobs.submit('render_narration', device_ids=list(device_ids))
+
+
+@jobs.task('render_narration')
+def render_narration_job(device_ids):
+    return render_devices(device_ids)
+
+
+NarrationCommand = Manager(usage='Render narration of device descriptions')
+
+
+@NarrationCommand.command
+def render():
+    ''' Render missing narrations of every device.'''
+
+    result = render_devices()
+    print('Rendered %d narrations, %d already rendered.' % (result['rendered'], result['cached']))
+
+
+@NarrationCommand.command
+def prune():
+    ''' Delete narrations no device description uses any more, and
+        partly encoded ones not written to for NARRATION_PARTIAL_AGE.'''
+
+    folder = current_app.config['NARRATION_FOLDER']
+    used = set(narration_name(description) for (description,) in
+               db.session.query(Device.description).distinct() if description)
+    abandoned = time.time() - current_app.config['NARRATION_PARTIAL_AGE']
+    removed = 0
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name.startswith(PARTIAL_PREFIX):
+                # A render may still be encoding it
+                try:
+                    if os.stat(path).st_mtime > abandoned:
+                        continue
+                except OSError:
+                    continue
+            elif name in used:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Renamed or removed by the render meanwhile
+                continue
+            removed += 1
+    print('Deleted %d unused narrations.' % removed)
@@ -0,0 +1,58 @@
+''' Startup profiling helpers.'''
+
+import json
+import subprocess
+import sys
+
+
+# Run inside a fresh interpreter so already imported modules do not hide
+# their cost. Each first import is timed inclusively of its children.
+PROFILE_SCRIPT = '''
+import json, sys, time
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+real_import = builtins.__import__
+timings = {}
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        if name not in timings and name in sys.modules:
+            timings[name] = (time.time() - start) * 1000
+
+builtins.__import__ = timed_import
+start = time.time()
+__import__(%(module)r)
+import_ms = (time.time() - start) * 1000
+builtins.__import__ = real_import
+
+from app import create_app
+start = time.time()
+create_app()
+create_app_ms = (time.time() - start) * 1000
+
+modules = sorted(timings.items(), key=lambda item: item[1], reverse=True)
+sys.stdout.write(json.dumps({
+    'import_ms': import_ms,
+    'create_app_ms': create_app_ms,
+    'modules': modules[:%(limit)d],
+}))
+'''
+
+
+def profile_imports(module='app.commands', limit=20):
+    ''' Import module in a subprocess and return timing report.
+
+        Report contains total import time, time spent in create_app()
+        and the slowest modules as (name, milliseconds) pairs.'''
+
+    script = PROFILE_SCRIPT % {'module': module, 'limit': limit}
+    output = subprocess.check_output([sys.executable, '-c', script])
+    return json.loads(output.decode('utf-8'))
@@ -0,0 +1,119 @@
+''' In-memory registries for small reference tables.
+
+    Reference tables such as GameMode are seeded from fixtures and
+    rarely change, so they are loaded once and served from memory. Each
+    lookup checks the table's shared version (app.versions), so changes
+    made by other server processes are picked up too.'''
+
+import threading
+from collections import namedtuple
+
+from flask import abort
+from sqlalchemy import event
+
+from app import db
+
+
+# Plain rows are kept instead of ORM instances so they can be shared
+# between requests without being bound to a session.
+Mode = namedtuple('Mode', ['id', 'mode'])
+
+
+class GameModeRegistry(object):
+    ''' Game modes indexed by id and by name.
+
+        The registry is loaded before the first request. Whenever a
+        GameMode row is inserted, updated or deleted the registry is
+        marked stale and the table's version is bumped; the registry is
+        reloaded on the next lookup when stale or when the stored version
+        differs from the one loaded, as after a change by another
+        process.'''
+
+    name = 'game_modes'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modes = []
+        self._by_id = {}
+        self._by_name = {}
+        self._version = None
+        self._stale = True
+
+    def load(self):
+        ''' Load all game modes from the database.'''
+
+        from .models import GameMode
+        from .versions import current
+
+        # Read the version first, so a change committed while loading
+        # leaves it behind and is loaded again on the next lookup
+        version = current(db.session, self.name)
+        modes = [Mode(mode.id, mode.mode)
+                 for mode in GameMode.query.order_by(GameMode.id)]
+        with self._lock:
+            self._modes = modes
+            self._by_id = dict((mode.id, mode) for mode in modes)
+            self._by_name = dict((mode.mode, mode) for mode in modes)
+            self._version = version
+            self._stale = False
+
+    def invalidate(self, *args):
+        ''' Mark registry as stale so it is reloaded on next lookup.'''
+
+        self._stale = True
+
+    def _ensure_loaded(self):
+        from .versions import current
+
+        if self._stale or current(db.session, self.name) != self._version:
+            self.load()
+
+    def all(self):
+        ''' Return all game modes ordered by id.'''
+
+        self._ensure_loaded()
+        return list(self._modes)
+
+    def get(self, mode_id):
+        ''' Return game mode with given id or None.'''
+
+        self._ensure_loaded()
+        return self._by_id.get(mode_id)
+
+    def get_or_404(self, mode_id):
+        ''' Return game mode with given id or abort with 404.'''
+
+        mode = self.get(mode_id)
+        if mode is None:
+            abort(404)
+        return mode
+
+    def by_name(self, name):
+        ''' Return game mode with given name (e.g. "learning") or None.'''
+
+        self._ensure_loaded()
+        return self._by_name.get(name)
+
+    def default(self):
+        ''' Return game mode assigned to newly created games.'''
+
+        modes = self.all()
+        return modes[0] if modes else None
+
+    def changed(self, mapper, connection, target):
+        ''' Invalidate registry and bump the version of its table in the
+            transaction of the change.'''
+
+        from .versions import bump
+
+        bump(connection, self.name)
+        self.invalidate()
+
+    def watch(self, model):
+        ''' Invalidate registry whenever rows of model change.'''
+
+        for identifier in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, identifier, self.changed)
+
+
+game_modes = GameModeRegistry()
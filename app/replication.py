@@ -0,0 +1,562 @@
+''' Replication of members and visits from satellite nodes.
+
+    A second location or an outreach kit runs its own installation with
+    its own database. With REPLICATION_LOG set, every member and visit
+    written on a node is also appended to its change_log, in the same
+    transaction. `run.py replication push` sends the changes not yet
+    acknowledged to REPLICATION_CENTRAL in batches of REPLICATION_BATCH,
+    as deflate compressed JSON authenticated with REPLICATION_TOKEN:
+
+        {"node": "<REPLICATION_NODE>",
+         "changes": [{"seq": <change id>, "entity": "member" or "visit",
+                      "operation": "insert", "update" or "delete",
+                      "card": "<card number>", "data": {...}}, ...]}
+
+    The central node applies a batch in one transaction and answers with
+    the last change of the node it has applied, so a batch sent twice,
+    e.g. after a lost response, is skipped rather than applied again.
+
+    Members are identified across nodes by card number. A card registered
+    on both nodes to the same name is one member; a card that belongs to
+    someone else on the central node, or an update to a card already in
+    use there, is kept as it is and recorded in replication_conflicts for
+    an admin to resolve. Visits of cards unknown to the central node
+    create their member, and visits older than its archive cutoff go
+    straight to its archive. Repeated scans of a visit stay local.'''
+
+import json
+import time
+import zlib
+from datetime import datetime
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+from flask import current_app
+from flask.ext.script import Manager
+from sqlalchemy import bindparam, func
+
+from app import db
+from .models import Change, Member, MemberVisit, ReplicationConflict, ReplicationPeer
+from .versions import bump
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+OPERATIONS = {'member': ('insert', 'update', 'delete'), 'visit': ('insert',)}
+# Longest node name or URL, matching the Node columns
+MAX_NODE_LENGTH = 200
+# Longest card number, matching the CardNumber columns
+MAX_CARD_LENGTH = 50
+# Card numbers per lookup query, well below SQLite's parameter limit
+LOOKUP_CHUNK = 500
+
+
+def logging_changes():
+    return current_app.config['REPLICATION_LOG']
+
+
+def log_change(entity, operation, card, **data):
+    ''' Append a change of the member with card number card to the log,
+        in the caller's transaction. Members without a card can not be
+        matched on other nodes and are not logged.'''
+
+    if logging_changes() and card:
+        db.session.add(Change(entity=entity,
+                              operation=operation,
+                              card_number=card,
+                              data=json.dumps(data),
+                              created=datetime.now()))
+
+
+def log_visit(member, date):
+    log_change('visit', 'insert', member.card_number,
+               date=date.strftime(DATE_FORMAT),
+               first_name=member.member_first_name,
+               last_name=member.member_last_name)
+
+
+def log_member_inserts(rows):
+    ''' Append insert changes of members inserted with executemany, given
+        their rows, in the caller's transaction.'''
+
+    if logging_changes() and rows:
+        now = datetime.now()
+        db.session.execute(Change.__table__.insert(), [
+                    dict(Entity='member', Operation='insert', CardNumber=row['CardNumber'],
+                         Data=json.dumps(dict(first_name=row['FirstName'],
+                                              last_name=row['LastName'])),
+                         Created=now)
+                    for row in rows])
+
+
+def change_payload(change):
+    return dict(seq=change.id,
+                entity=change.entity,
+                operation=change.operation,
+                card=change.card_number,
+                data=json.loads(change.data))
+
+
+def encode_batch(node, changes):
+    ''' Return (JSON, compressed JSON) of a batch of changes.'''
+
+    body = json.dumps(dict(node=node, changes=[change_payload(change) for change in changes]),
+                      separators=(',', ':')).encode('utf-8')
+    return body, zlib.compress(body, 6)
+
+
+def decode_batch(body, encoding, limit):
+    ''' Return batch from a pushed request body at most limit bytes long,
+        also once decompressed. Raises ValueError if malformed.'''
+
+    if len(body) > limit:
+        raise ValueError('Batch larger than %d bytes.' % limit)
+    if encoding == 'deflate':
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, limit)
+        except zlib.error:
+            raise ValueError('Batch is not deflate compressed.')
+        if decompressor.unconsumed_tail:
+            raise ValueError('Batch larger than %d bytes.' % limit)
+    elif encoding:
+        raise ValueError('Unsupported content encoding %s.' % encoding)
+    try:
+        batch = json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise ValueError('Batch is not valid JSON.')
+
+    if not isinstance(batch, dict) or not isinstance(batch.get('changes'), list):
+        raise ValueError('Expected an object with a list of changes.')
+    node = batch.get('node')
+    if not node or not isinstance(node, type(u'')) or len(node) > MAX_NODE_LENGTH:
+        raise ValueError('Batch needs a node name of at most %d characters.' % MAX_NODE_LENGTH)
+    for number, change in enumerate(batch['changes'], 1):
+        if not isinstance(change, dict) or not isinstance(change.get('seq'), int):
+            raise ValueError('Change %d needs a sequence number.' % number)
+        if change.get('operation') not in OPERATIONS.get(change.get('entity'), ()):
+            raise ValueError('Change %d has an unknown entity or operation.' % number)
+        card = change.get('card')
+        if not card or not isinstance(card, type(u'')) or len(card) > MAX_CARD_LENGTH:
+            raise ValueError('Change %d needs a card number.' % number)
+        if not isinstance(change.get('data'), dict):
+            raise ValueError('Change %d needs data.' % number)
+    return batch
+
+
+def same_person(member, first_name, last_name):
+    return ((member.member_first_name or '').strip().lower() == (first_name or '').strip().lower() and
+            (member.member_last_name or '').strip().lower() == (last_name or '').strip().lower())
+
+
+def describe(member):
+    return 'Card belongs to %s %s here.' % (member.member_first_name, member.member_last_name)
+
+
+class ChangeApplier(object):
+    ''' Applies the changes of one batch, remembering the members of
+        cards it has looked up or changed.
+
+        Visits are inserted together with executemany, and each member's
+        statistics updated once, when flush_visits() is called.'''
+
+    def __init__(self):
+        # card number -> Member, or None if there is none
+        self.members = {}
+        # Whether visit counts of past days changed other than by
+        # appending visits
+        self.rewrote_history = False
+        self.visits = []
+        # member id -> [visits, first visit, last visit] of pending visits
+        self.visit_stats = {}
+
+    def load(self, card_numbers):
+        ''' Look up the members of many cards with few queries.'''
+
+        missing = sorted(set(card_numbers) - set(self.members))
+        for first in range(0, len(missing), LOOKUP_CHUNK):
+            chunk = missing[first:first + LOOKUP_CHUNK]
+            for member in Member.query.filter(Member.card_number.in_(chunk)).order_by(Member.id):
+                self.members.setdefault(member.card_number, member)
+            for card_number in chunk:
+                self.members.setdefault(card_number, None)
+
+    def member(self, card_number):
+        if card_number not in self.members:
+            self.members[card_number] = Member.query.filter(
+                        Member.card_number == card_number).first()
+        return self.members[card_number]
+
+    def add_member(self, card_number, first_name, last_name):
+        member = Member(member_first_name=first_name,
+                        member_last_name=last_name,
+                        card_number=card_number)
+        db.session.add(member)
+        db.session.flush()
+        self.members[card_number] = member
+        return member
+
+    def apply(self, change):
+        ''' Apply a change. Returns None, or the reason it conflicts.'''
+
+        handler = getattr(self, '%s_%s' % (change['entity'], change['operation']))
+        return handler(change['card'], change['data'])
+
+    def member_insert(self, card_number, data):
+        member = self.member(card_number)
+        if member is None:
+            self.add_member(card_number, data.get('first_name'), data.get('last_name'))
+        elif not same_person(member, data.get('first_name'), data.get('last_name')):
+            return describe(member)
+
+    def member_update(self, card_number, data):
+        new_card = data.get('card_number')
+        if not new_card or not isinstance(new_card, type(u'')) or len(new_card) > MAX_CARD_LENGTH:
+            return 'Update has no valid card number.'
+        first_name, last_name = data.get('previous_name') or (None, None)
+        member = self.member(card_number)
+        if member is None:
+            # Its insert conflicted or was deleted here; take it as new
+            return self.member_insert(new_card, data)
+        if not (same_person(member, first_name, last_name) or
+                same_person(member, data.get('first_name'), data.get('last_name'))):
+            return describe(member)
+        if new_card != card_number:
+            other = self.member(new_card)
+            if other is not None and other.id != member.id:
+                return 'New card %s belongs to %s %s here.' % (
+                            new_card, other.member_first_name, other.member_last_name)
+        member.member_first_name = data.get('first_name')
+        member.member_last_name = data.get('last_name')
+        member.card_number = new_card
+        self.members[card_number] = None
+        self.members[new_card] = member
+
+    def member_delete(self, card_number, data):
+        from .archive import delete_member_history
+        from .membership import recent_check_ins
+
+        member = self.member(card_number)
+        if member is None:
+            return None
+        if not same_person(member, data.get('first_name'), data.get('last_name')):
+            return describe(member)
+        self.flush_visits()
+        MemberVisit.query.filter(MemberVisit.member == member.id).delete(synchronize_session=False)
+        delete_member_history(member.id)
+        recent_check_ins.forget(member.id)
+        db.session.delete(member)
+        db.session.flush()
+        self.members[card_number] = None
+        self.rewrote_history = True
+
+    def visit_insert(self, card_number, data):
+        try:
+            date = datetime.strptime(data.get('date') or '', DATE_FORMAT)
+        except ValueError:
+            return 'Visit has no valid date.'
+        member = self.member(card_number)
+        if member is None:
+            member = self.add_member(card_number, data.get('first_name'), data.get('last_name'))
+        elif not same_person(member, data.get('first_name'), data.get('last_name')):
+            return describe(member)
+        self.visits.append(dict(MemberID=member.id, Date=date))
+        stats = self.visit_stats.get(member.id)
+        if stats is None:
+            self.visit_stats[member.id] = [1, date, date]
+        else:
+            stats[0] += 1
+            stats[1] = min(stats[1], date)
+            stats[2] = max(stats[2], date)
+
+    def flush_visits(self):
+        ''' Insert pending visits and add them to their members' visit
+            statistics, like record_visit does for one visit. Visits
+            older than the archive cutoff are archived.'''
+
+        from .archive import archive_cutoff, move_to_archive
+
+        if not self.visits:
+            return
+        # The batch holds the write lock, so later ids are its visits
+        latest = db.session.query(func.max(MemberVisit.id)).scalar() or 0
+        first = bindparam('first', type_=db.DateTime)
+        last = bindparam('last', type_=db.DateTime)
+        # Visits may arrive after later ones recorded here
+        update = Member.__table__.update().where(
+                    Member.id == bindparam('member_id')).values(
+                    VisitCount=Member.visit_count + bindparam('visits'),
+                    FirstVisit=func.min(func.coalesce(Member.first_visit, first), first),
+                    LastVisit=func.max(func.coalesce(Member.last_visit, last), last))
+        db.session.execute(MemberVisit.__table__.insert(), self.visits)
+        db.session.execute(update, [
+                    dict(member_id=member_id, visits=visits, first=first_visit, last=last_visit)
+                    for member_id, (visits, first_visit, last_visit) in self.visit_stats.items()])
+        cutoff = archive_cutoff()
+        if any(visit['Date'] < cutoff for visit in self.visits):
+            move_to_archive(MemberVisit.query.filter(
+                        MemberVisit.id > latest).filter(
+                        MemberVisit.date < cutoff))
+            self.rewrote_history = True
+        self.visits = []
+        self.visit_stats = {}
+
+
+def apply_batch(batch):
+    ''' Apply the changes of a batch not applied before and commit.
+        Returns dict of applied, skipped and conflicting changes and the
+        last change of the node applied, to acknowledge.
+
+        Changes are applied, not logged again: the central node does not
+        push on what it receives.'''
+
+    node = batch['node']
+    now = datetime.now()
+    applier = ChangeApplier()
+    counts = dict(applied=0, skipped=0, conflicts=0)
+    try:
+        # Writing first takes the database's write lock, so two pushes
+        # of a node can not both apply the same changes
+        updated = db.session.execute(ReplicationPeer.__table__.update().where(
+                    ReplicationPeer.node == node).values(Synced=now)).rowcount
+        if not updated:
+            db.session.add(ReplicationPeer(node=node, sent=0, received=0, synced=now))
+            db.session.flush()
+        peer = ReplicationPeer.query.filter(ReplicationPeer.node == node).one()
+        received = peer.received
+        changes = [change for change in batch['changes'] if change['seq'] > received]
+        cards = [change['card'] for change in changes]
+        cards.extend(change['data']['card_number'] for change in changes
+                     if isinstance(change['data'].get('card_number'), type(u'')))
+        applier.load(cards)
+        for change in sorted(batch['changes'], key=lambda change: change['seq']):
+            if change['seq'] <= received:
+                counts['skipped'] += 1
+                continue
+            reason = applier.apply(change)
+            if reason is None:
+                counts['applied'] += 1
+            else:
+                db.session.add(ReplicationConflict(node=node,
+                                                   sequence=change['seq'],
+                                                   card_number=change['card'],
+                                                   reason=reason,
+                                                   change=json.dumps(change),
+                                                   created=now))
+                counts['conflicts'] += 1
+            received = change['seq']
+        applier.flush_visits()
+        # Cached visit counts only account for appended visits
+        if applier.rewrote_history:
+            bump(db.session.connection(), MemberVisit.__tablename__)
+        peer.received = received
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    counts['acknowledged'] = received
+    return counts
+
+
+def post_batch(url, token, body, timeout):
+    ''' Post a compressed batch and return the decoded response. Raises
+        RuntimeError if the central node refuses it or can not be reached.'''
+
+    request = Request(url, data=body, headers={
+                'Authorization': 'Bearer ' + token,
+                'Content-Type': 'application/json',
+                'Content-Encoding': 'deflate'})
+    try:
+        response = urlopen(request, timeout=timeout)
+        try:
+            return json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+    except HTTPError as e:
+        raise RuntimeError('Central node refused batch: %d %s' % (e.code, e.read()[:200]))
+    except URLError as e:
+        raise RuntimeError('Could not reach central node: %s' % e.reason)
+
+
+def central_peer(central):
+    peer = ReplicationPeer.query.filter(ReplicationPeer.node == central).first()
+    if peer is None:
+        peer = ReplicationPeer(node=central, sent=0, received=0)
+        db.session.add(peer)
+        db.session.commit()
+    return peer
+
+
+def push_changes(central, token, node, batch_size, timeout=30):
+    ''' Push changes not yet acknowledged to the central node at URL
+        central. Returns dict of batches, changes, applied, skipped and
+        conflicts, and bytes before and after compression.'''
+
+    url = central.rstrip('/') + '/_replication/changes'
+    peer = central_peer(central)
+    totals = dict(batches=0, changes=0, applied=0, skipped=0, conflicts=0,
+                  json_bytes=0, sent_bytes=0)
+    while True:
+        changes = Change.query.filter(Change.id > peer.sent).order_by(
+                    Change.id).limit(batch_size).all()
+        if not changes:
+            break
+        body, compressed = encode_batch(node, changes)
+        result = post_batch(url, token, compressed, timeout)
+        if result.get('acknowledged', 0) < changes[-1].id:
+            raise RuntimeError('Central node acknowledged change %s of %d.' % (
+                        result.get('acknowledged'), changes[-1].id))
+        peer.sent = changes[-1].id
+        peer.synced = datetime.now()
+        db.session.commit()
+        totals['batches'] += 1
+        totals['changes'] += len(changes)
+        for key in ('applied', 'skipped', 'conflicts'):
+            totals[key] += result.get(key, 0)
+        totals['json_bytes'] += len(body)
+        totals['sent_bytes'] += len(compressed)
+    return totals
+
+
+def seed_changes(batch_size=5000):
+    ''' Log an insert of every member and of every visit still in
+        member_visits, e.g. before a node first pushes. Returns number of
+        changes logged.'''
+
+    insert = Change.__table__.insert()
+    now = datetime.now()
+    logged = 0
+    batch = []
+    members = db.session.query(Member.card_number, Member.member_first_name,
+                               Member.member_last_name).filter(
+                Member.card_number != None).order_by(Member.id)
+    visits = db.session.query(Member.card_number, Member.member_first_name,
+                              Member.member_last_name, MemberVisit.date).join(
+                MemberVisit, MemberVisit.member == Member.id).filter(
+                Member.card_number != None).order_by(MemberVisit.id)
+    rows = [('member', card, dict(first_name=first, last_name=last))
+            for card, first, last in members.yield_per(batch_size)]
+    rows.extend(('visit', card, dict(date=date.strftime(DATE_FORMAT), first_name=first,
+                                     last_name=last))
+                for card, first, last, date in visits.yield_per(batch_size))
+    for entity, card, data in rows:
+        batch.append(dict(Entity=entity, Operation='insert', CardNumber=card,
+                          Data=json.dumps(data), Created=now))
+        if len(batch) >= batch_size:
+            db.session.execute(insert, batch)
+            logged += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(insert, batch)
+        logged += len(batch)
+    db.session.commit()
+    return logged
+
+
+def prune_changes(central):
+    ''' Delete changes the central node has acknowledged. Returns number
+        of changes deleted.'''
+
+    peer = ReplicationPeer.query.filter(ReplicationPeer.node == central).first()
+    if peer is None or not peer.sent:
+        return 0
+    deleted = Change.query.filter(Change.id <= peer.sent).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+ReplicationCommand = Manager(usage='Replicate members and visits to a central node')
+
+
+def push_settings(central):
+    config = current_app.config
+    central = central or config['REPLICATION_CENTRAL']
+    if not central:
+        raise SystemExit('Set REPLICATION_CENTRAL or pass --central.')
+    if not config['REPLICATION_NODE']:
+        # A default such as the host name is shared by kits cloned from
+        # one image, whose changes the central node would then skip
+        raise SystemExit('Set REPLICATION_NODE to a name unique to this node.')
+    if not config['REPLICATION_TOKEN']:
+        raise SystemExit('Set REPLICATION_TOKEN to the central node\'s token.')
+    return central
+
+
+def print_push(result):
+    ratio = float(result['sent_bytes']) / result['json_bytes'] if result['json_bytes'] else 0
+    print('Pushed %d changes in %d batches: %d applied, %d already applied, %d conflicts; '
+          '%d bytes sent (%.0f%% of %d).' % (result['changes'], result['batches'],
+                                             result['applied'], result['skipped'],
+                                             result['conflicts'], result['sent_bytes'],
+                                             ratio * 100, result['json_bytes']))
+
+
+@ReplicationCommand.option('-c', '--central', dest='central', default=None,
+                           help='URL of the central node (default: REPLICATION_CENTRAL)')
+@ReplicationCommand.option('--every', dest='every', type=float, default=None,
+                           help='Keep pushing every EVERY seconds')
+def push(central, every):
+    ''' Push changes not yet acknowledged to the central node.'''
+
+    config = current_app.config
+    central = push_settings(central)
+    while True:
+        try:
+            result = push_changes(central, config['REPLICATION_TOKEN'],
+                                  config['REPLICATION_NODE'], config['REPLICATION_BATCH'])
+            if result['changes'] or every is None:
+                print_push(result)
+        except RuntimeError as e:
+            if every is None:
+                raise SystemExit(str(e))
+            # Satellites are often offline; the next attempt catches up
+            print(e)
+        if every is None:
+            break
+        db.session.remove()
+        time.sleep(every)
+
+
+@ReplicationCommand.command
+def seed():
+    ''' Log every existing member and visit, before a node first pushes.'''
+
+    print('Logged %d changes.' % seed_changes())
+
+
+@ReplicationCommand.option('-c', '--central', dest='central', default=None,
+                           help='URL of the central node (default: REPLICATION_CENTRAL)')
+def prune(central):
+    ''' Delete changes the central node has acknowledged.'''
+
+    print('Deleted %d acknowledged changes.' % prune_changes(push_settings(central)))
+
+
+@ReplicationCommand.option('-n', '--limit', dest='limit', type=int, default=20,
+                           help='Number of recent conflicts to list')
+def status(limit):
+    ''' Report replication progress of each peer and recent conflicts.'''
+
+    config = current_app.config
+    print('Node %s, logging %s, %d changes in log.' % (
+                config['REPLICATION_NODE'] or '(not set)', 'on' if config['REPLICATION_LOG'] else 'off',
+                Change.query.count()))
+    for peer in ReplicationPeer.query.order_by(ReplicationPeer.node):
+        synced = peer.synced.strftime('%Y-%m-%d %H:%M:%S') if peer.synced else 'never'
+        # Satellites are only received from, the central node only sent to
+        if peer.node == config['REPLICATION_CENTRAL']:
+            pending = Change.query.filter(Change.id > peer.sent).count()
+            print('Central %s: sent up to change %d, %d pending, last synced %s.' % (
+                        peer.node, peer.sent, pending, synced))
+        else:
+            print('Satellite %s: received up to change %d, last synced %s.' % (
+                        peer.node, peer.received, synced))
+    conflicts = ReplicationConflict.query.order_by(ReplicationConflict.id.desc()).limit(limit).all()
+    print('%d conflicts.' % ReplicationConflict.query.count())
+    for conflict in conflicts:
+        print('%s %s #%d card %s: %s' % (conflict.created.strftime('%Y-%m-%d %H:%M:%S'),
+                                         conflict.node, conflict.sequence,
+                                         conflict.card_number, conflict.reason))
@@ -0,0 +1,243 @@
+''' Visit reports.
+
+    Recent visits live in member_visits while older ones have been rolled
+    up into daily counts by app.archive. Functions here combine both, so
+    views never need to know where a visit is stored.
+
+    Daily counts of whole-day ranges are memoized by metrics_cache.
+    Visits are only ever appended, so instead of expiring, cached counts
+    are brought up to date by adding the visits inserted since they were
+    last seen; ranges that do not cover those visits are left alone.
+    Deleting visits or changing their dates bumps their shared version
+    (app.versions), which drops the cached counts in every process.
+
+    Report queries read from a snapshot (app.snapshots), so they never
+    hold up check-ins.'''
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, inspect, text
+
+from app import db
+from .archive import parse_day
+from .models import MemberVisit, MemberVisitRollup
+from .snapshots import read_session
+from .versions import bump, current
+
+
+def rollup_range(start, end):
+    ''' Return filter clauses selecting rollups of days whose midnight
+        falls in [start, end).'''
+
+    first_day, stop_day = start.date(), end.date()
+    if start.time() != datetime.min.time():
+        first_day += timedelta(days=1)
+    if end.time() != datetime.min.time():
+        stop_day += timedelta(days=1)
+    return MemberVisitRollup.day >= first_day, MemberVisitRollup.day < stop_day
+
+
+def daily_visits(start, end, max_id=None):
+    ''' Return dict of date -> number of visits for days in [start, end),
+        counting only visits with ids up to max_id if given.'''
+
+    day = func.date(MemberVisit.date)
+    counts = {}
+    hot = read_session.query(day, func.count(MemberVisit.id)).filter(
+                MemberVisit.date >= start).filter(
+                MemberVisit.date < end)
+    if max_id is not None:
+        hot = hot.filter(MemberVisit.id <= max_id)
+    hot = hot.group_by(day)
+    for visit_day, visits in hot:
+        visit_day = parse_day(visit_day)
+        counts[visit_day] = counts.get(visit_day, 0) + visits
+    archived = read_session.query(
+                MemberVisitRollup.day, func.sum(MemberVisitRollup.visits)).filter(
+                *rollup_range(start, end)).group_by(
+                MemberVisitRollup.day)
+    for visit_day, visits in archived:
+        counts[visit_day] = counts.get(visit_day, 0) + visits
+    return counts
+
+
+def visit_metrics(start, end, counts=None):
+    ''' Compute membership metrics for [start, end) from daily counts,
+        which are queried if not given.
+
+        Returns dict with total visits, average visits per day and the
+        first day with the highest attendance.'''
+
+    if counts is None:
+        counts = daily_visits(start, end)
+    total_visits = sum(counts.values())
+    # Average visits in date range
+    delta = end - start
+    try:
+        visits_per_day = total_visits / delta.days
+    except ZeroDivisionError:
+        visits_per_day = 0
+
+    # Calculate date of highest attendance
+    max_date, max_visits = start, 0
+    for visit_day in sorted(counts):
+        if counts[visit_day] > max_visits:
+            max_visits = counts[visit_day]
+            max_date = datetime.combine(visit_day, datetime.min.time())
+
+    return dict(total_visits=total_visits,
+                visits_per_day=visits_per_day,
+                max_visits=max_visits,
+                max_date=max_date)
+
+
+def whole_days(start, end):
+    ''' Return whether [start, end) starts and ends at midnight.'''
+
+    return start.time() == datetime.min.time() and end.time() == datetime.min.time()
+
+
+class MetricsCache(object):
+    ''' Least recently used daily counts of whole-day ranges, kept current
+        as visits are appended.
+
+        Archiving moves visits into daily rollups without changing the
+        daily counts of whole days, so it does not affect cached ranges.
+        Deleting or redating visits does, and bumps the member_visits
+        version, which is checked before the cache is used.'''
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Highest visit id included in every cached entry
+        self._watermark = None
+        # Version of member_visits the entries were counted at
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._watermark = None
+            self._version = None
+
+    def _catch_up(self):
+        ''' Add visits appended since the watermark to the entries whose
+            range covers them. Returns False if the caller's snapshot is
+            older than the cache, which then can not be used.'''
+
+        version = current(read_session, MemberVisit.__tablename__)
+        if self._version is not None and version < self._version:
+            return False
+        if version != self._version:
+            # Visits were deleted or redated, possibly by another process
+            self._watermark = None
+            self._version = version
+        latest = read_session.query(func.max(MemberVisit.id)).scalar() or 0
+        if self._watermark is not None and latest < self._watermark:
+            # Visit ids are never reused, so a snapshot that has issued ids
+            # past the watermark is newer and the latest visits were deleted
+            issued = read_session.execute(text(
+                        "SELECT seq FROM sqlite_sequence WHERE name = 'member_visits'")).scalar()
+            if (issued or 0) < self._watermark:
+                return False
+            self._watermark = None
+        if self._watermark is None:
+            self._entries.clear()
+        elif latest > self._watermark and self._entries:
+            new_visits = read_session.query(MemberVisit.date).filter(
+                        MemberVisit.id > self._watermark).filter(
+                        MemberVisit.id <= latest)
+            for (date,) in new_visits:
+                for (start, end), counts in self._entries.items():
+                    if start <= date < end:
+                        counts[date.date()] = counts.get(date.date(), 0) + 1
+                        self.updates += 1
+        self._watermark = latest
+        return True
+
+    def daily_visits(self, start, end):
+        ''' Return daily_visits(start, end), from the cache if possible.'''
+
+        if not whole_days(start, end):
+            return daily_visits(start, end)
+        with self._lock:
+            if not self._catch_up():
+                return daily_visits(start, end)
+            key = (start, end)
+            counts = self._entries.pop(key, None)
+            if counts is None:
+                self.misses += 1
+                # Count exactly the visits up to the watermark
+                counts = daily_visits(start, end, self._watermark)
+                if len(self._entries) >= self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self.hits += 1
+            # Most recently used entries are last
+            self._entries[key] = counts
+            return dict(counts)
+
+    def visit_metrics(self, start, end):
+        ''' Return visit_metrics(start, end) computed from cached counts.'''
+
+        return visit_metrics(start, end, self.daily_visits(start, end))
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries), hits=self.hits,
+                        misses=self.misses, updates=self.updates)
+
+
+metrics_cache = MetricsCache()
+
+
+@event.listens_for(MemberVisit, 'after_update')
+def visit_updated(mapper, connection, visit):
+    ''' Bump the member_visits version when a visit's date changes.'''
+
+    if inspect(visit).attrs.date.history.has_changes():
+        bump(connection, MemberVisit.__tablename__)
+
+
+@event.listens_for(MemberVisit, 'after_delete')
+def visit_deleted(mapper, connection, visit):
+    ''' Bump the member_visits version when a visit is deleted.'''
+
+    bump(connection, MemberVisit.__tablename__)
+
+
+def member_visit_stats(member_id):
+    ''' Compute number of visits and first and last visit of member from
+        visit history, and whether the first and last visit are archived.
+
+        Dates are None if the member has never visited. Archived days count
+        as visits at midnight, since rollups do not keep the time.'''
+
+    hot = db.session.query(
+                func.count(MemberVisit.id),
+                func.min(MemberVisit.date),
+                func.max(MemberVisit.date)).filter(
+                MemberVisit.member == member_id).one()
+    archived = db.session.query(
+                func.sum(MemberVisitRollup.visits),
+                func.min(MemberVisitRollup.day),
+                func.max(MemberVisitRollup.day)).filter(
+                MemberVisitRollup.member == member_id).one()
+
+    num_visits = hot[0] + (archived[0] or 0)
+    # Archived visits are always older than visits in member_visits
+    first_visit, last_visit = hot[1], hot[2]
+    first_archived = last_archived = False
+    if archived[1] is not None:
+        first_visit = datetime.combine(archived[1], datetime.min.time())
+        first_archived = True
+    if last_visit is None and archived[2] is not None:
+        last_visit = datetime.combine(archived[2], datetime.min.time())
+        last_archived = True
+    return num_visits, first_visit, last_visit, first_archived, last_archived
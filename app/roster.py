@@ -0,0 +1,116 @@
+''' Bulk import of member rolls exported by the front desk system.
+
+    A roll is a CSV file with first_name, last_name and card_number
+    columns (other columns are ignored). It is validated in a single
+    streaming pass; cards already on file, or repeated in the roll, are
+    skipped using a set of card numbers loaded once up front. Members are
+    inserted in large executemany batches inside one transaction, so a
+    roll is imported completely or not at all.'''
+
+import csv
+import time
+
+from app import db
+from .models import Member
+from .replication import log_member_inserts
+
+
+COLUMNS = ('first_name', 'last_name', 'card_number')
+# Longest value that fits each column
+MAX_LENGTH = 50
+
+
+def text_lines(stream):
+    ''' Yield lines of a binary file in the form the csv module of this
+        Python version reads.'''
+
+    for line in stream:
+        if str is not bytes and isinstance(line, bytes):
+            line = line.decode('utf-8')
+        yield line
+
+
+def normalize(name):
+    ''' Return header name as a column name, e.g. "First Name" -> first_name.'''
+
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    # Spreadsheets often start UTF-8 files with a byte order mark
+    return name.lstrip(u'\ufeff').strip().lower().replace(' ', '_')
+
+
+def read_roster(stream, invalid):
+    ''' Yield (line, first_name, last_name, card_number) of valid rows of
+        a roll. Invalid rows are appended to invalid as (line, reason).
+
+        Raises ValueError if the header lacks a required column.'''
+
+    reader = csv.reader(text_lines(stream))
+    header = [normalize(name) for name in next(reader, [])]
+    missing = [column for column in COLUMNS if column not in header]
+    if missing:
+        raise ValueError('Missing column(s): %s.' % ', '.join(missing))
+    indexes = [header.index(column) for column in COLUMNS]
+
+    for row in reader:
+        if not any(row):
+            continue
+        # Header is line 1
+        line = reader.line_num
+        values = []
+        for index in indexes:
+            value = row[index].strip() if index < len(row) else ''
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            values.append(value)
+        first_name, last_name, card_number = values
+        if not first_name or not last_name:
+            invalid.append((line, 'missing name'))
+        elif not card_number:
+            invalid.append((line, 'missing card number'))
+        elif max(len(value) for value in values) > MAX_LENGTH:
+            invalid.append((line, 'value longer than %d characters' % MAX_LENGTH))
+        else:
+            yield line, first_name, last_name, card_number
+
+
+def import_members(stream, batch_size=5000, dry_run=False):
+    ''' Import members from a CSV roll.
+
+        Returns dict of added, duplicates, invalid (list of (line, reason)),
+        seconds and rate (rows per second). With dry_run the roll is only
+        validated. Raises ValueError if the header is unusable.'''
+
+    start = time.time()
+    existing = set(card for (card,) in db.session.query(Member.card_number))
+    insert = Member.__table__.insert()
+    invalid = []
+    added = duplicates = 0
+    batch = []
+    try:
+        for line, first_name, last_name, card_number in read_roster(stream, invalid):
+            if card_number in existing:
+                duplicates += 1
+                continue
+            existing.add(card_number)
+            batch.append(dict(FirstName=first_name, LastName=last_name,
+                              CardNumber=card_number, VisitCount=0))
+            if len(batch) >= batch_size:
+                if not dry_run:
+                    db.session.execute(insert, batch)
+                    log_member_inserts(batch)
+                added += len(batch)
+                batch = []
+        if batch and not dry_run:
+            db.session.execute(insert, batch)
+            log_member_inserts(batch)
+        added += len(batch)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    seconds = time.time() - start
+    rows = added + duplicates + len(invalid)
+    return dict(added=added, duplicates=duplicates, invalid=invalid,
+                seconds=seconds, rate=rows / seconds if seconds else float(rows))
@@ -0,0 +1,72 @@
+''' Read-only queries for list and report pages.
+
+    These select only the columns a page renders and return named tuples
+    instead of ORM instances, skipping the identity map, attribute
+    instrumentation and dynamic relationships. Rows can not be modified
+    or used to load relationships; views that edit use the models.'''
+
+from flask import abort
+
+from app import db
+from .models import Device, Game, game_device_link, Member, Question, question_answer_link
+
+
+def game_rows(mode_id):
+    ''' Return (id, title, description) of games of a mode by title.'''
+
+    return db.session.query(Game.id, Game.title, Game.description).filter(
+                Game.game_mode == mode_id).order_by(Game.title).all()
+
+
+def game_row_or_404(game_id):
+    ''' Return (id, title, description, game_mode) of a game.'''
+
+    game = db.session.query(
+                Game.id, Game.title, Game.description, Game.game_mode).filter(
+                Game.id == game_id).first()
+    if game is None:
+        abort(404)
+    return game
+
+
+def device_rows(game_id):
+    ''' Return devices of a game as (id, name, description, file_loc,
+        rfid_tag).'''
+
+    return db.session.query(
+                Device.id, Device.name, Device.description,
+                Device.file_loc, Device.rfid_tag).join(
+                game_device_link, game_device_link.c.device_id == Device.id).filter(
+                game_device_link.c.game_id == game_id).all()
+
+
+def question_rows(game_id):
+    ''' Return (id, question) of questions of a game ordered by text.'''
+
+    return db.session.query(Question.id, Question.question).filter(
+                Question.game == game_id).order_by(Question.question).all()
+
+
+def answer_names(game_id):
+    ''' Return dict of question id -> list of (name,) rows of its answers,
+        for all questions of a game in one query.'''
+
+    answers = {}
+    rows = db.session.query(question_answer_link.c.question_id, Device.name).join(
+                Device, Device.id == question_answer_link.c.device_id).join(
+                Question, Question.id == question_answer_link.c.question_id).filter(
+                Question.game == game_id).order_by(Device.id)
+    for row in rows:
+        answers.setdefault(row.question_id, []).append(row)
+    return answers
+
+
+def member_rows(last_name):
+    ''' Return members whose last name contains last_name, ordered by
+        name, with their visit statistics.'''
+
+    return db.session.query(
+                Member.id, Member.member_first_name, Member.member_last_name,
+                Member.card_number, Member.visit_count, Member.last_visit).filter(
+                Member.member_last_name.ilike("%" + last_name + "%")).order_by(
+                Member.member_last_name, Member.member_first_name).all()
@@ -0,0 +1,157 @@
+''' Asynchronous log of RFID scans.
+
+    Validation views hand scan events to an in-process bounded queue and
+    return immediately. A background thread drains the queue and writes
+    the events to scan_events in batched inserts, updating the hourly
+    analytics rollups in the same transaction. When the queue is full
+    events are dropped and counted instead of blocking the request.'''
+
+import atexit
+import threading
+import time
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from flask import current_app
+
+from app import db
+from .analytics import update_rollups
+from .models import ScanEvent
+
+
+class ScanQueue(object):
+    ''' Bounded queue of scan events of one app with a batching writer
+        thread.'''
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config['SCAN_LOG_BATCH']
+        self.interval = app.config['SCAN_LOG_INTERVAL']
+        self.queue = queue.Queue(app.config['SCAN_LOG_QUEUE_SIZE'])
+        self.logged = 0
+        self.written = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def put(self, event):
+        self._start_writer()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+        else:
+            with self._lock:
+                self.logged += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(logged=self.logged,
+                        written=self.written,
+                        dropped=self.dropped,
+                        queued=self.queue.qsize())
+
+    def flush(self):
+        while True:
+            batch = self._take(block=False)
+            if not batch:
+                break
+            self._write(batch)
+
+    def _start_writer(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='scan-log-writer')
+                self._writer.daemon = True
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _take(self, block=True):
+        ''' Take up to batch_size events, waiting at most interval seconds
+            for the batch to fill up.'''
+
+        batch = []
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if block and timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                if batch or not block:
+                    break
+                deadline = time.time() + self.interval
+        return batch
+
+    def _write(self, batch):
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(ScanEvent.__table__.insert(), batch)
+                    update_rollups(connection, batch)
+        except Exception:
+            self.app.logger.exception('Could not write %d scan events', len(batch))
+            with self._lock:
+                self.dropped += len(batch)
+        else:
+            with self._lock:
+                self.written += len(batch)
+
+    def _run(self):
+        while True:
+            self._write(self._take())
+
+
+class ScanLog(object):
+    ''' Scan log of the current app.
+
+        Each app gets its own ScanQueue and writer thread, so events of
+        one app are never written to another app's database when a
+        process creates several (benchmarks, tests).'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['scan_log'] = ScanQueue(app)
+
+    def _queue(self):
+        return current_app.extensions['scan_log']
+
+    def log(self, game_id, tag, device_id, question_id=None, first_try=False):
+        ''' Queue a scan of tag in a game. device_id is the id of the
+            matched Device or None if the scan was not valid. first_try
+            marks the first scan made for a challenge question.'''
+
+        # Events are keyed by column name for executemany inserts
+        event = dict(GameID=game_id,
+                     QuestionID=question_id,
+                     DeviceID=device_id,
+                     Tag=tag,
+                     Valid=device_id is not None,
+                     FirstTry=first_try,
+                     Date=datetime.now())
+        self._queue().put(event)
+
+    def stats(self):
+        ''' Return counters describing the log.'''
+
+        return self._queue().stats()
+
+    def flush(self):
+        ''' Write all queued events from the calling thread.'''
+
+        self._queue().flush()
+
+
+scan_log = ScanLog()
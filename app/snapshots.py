@@ -0,0 +1,97 @@
+''' Snapshot reads for reports.
+
+    SQLite databases are switched to write-ahead logging, in which readers
+    never block writers: a long report no longer holds the lock a
+    check-in or scan needs to commit. Report, analytics and export
+    queries use read_session, whose connections come from a separate,
+    query-only pool. Each read session runs in one transaction from its
+    first query until the end of the request, so every query of a report
+    sees the same snapshot of the database, however long the report takes
+    and whatever kiosks write meanwhile.'''
+
+import sqlite3
+import threading
+
+from flask import _app_ctx_stack, current_app
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, Session
+from sqlalchemy.pool import QueuePool
+
+from app import db
+
+
+def is_file_database(url):
+    return url.drivername == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def use_journal_mode(engine, mode):
+    ''' Set the journal mode of every new SQLite connection of engine.'''
+
+    @event.listens_for(engine, 'connect')
+    def set_journal_mode(connection, record):
+        if isinstance(connection, sqlite3.Connection):
+            connection.execute('PRAGMA journal_mode = %s' % mode)
+
+
+class SnapshotReader(object):
+    ''' Query-only engines, one per database, and sessions on them.'''
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # database URI -> engine
+        self._engines = {}
+        # Sessions are scoped like Flask-SQLAlchemy's
+        self.session = scoped_session(self._create_session, scopefunc=_app_ctx_stack.__ident_func__)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        engine = db.get_engine(app)
+        if app.config['SQLITE_JOURNAL_MODE'] and is_file_database(engine.url):
+            use_journal_mode(engine, app.config['SQLITE_JOURNAL_MODE'])
+
+        @app.teardown_appcontext
+        def remove_read_session(exception):
+            self.session.remove()
+
+    def engine(self):
+        ''' Return query-only engine of the current app's database.'''
+
+        url = db.get_engine(current_app).url
+        uri = str(url)
+        engine = self._engines.get(uri)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(uri)
+                if engine is None:
+                    engine = self._create_engine(url)
+                    self._engines[uri] = engine
+        return engine
+
+    def _create_engine(self, url):
+        engine = create_engine(url, poolclass=QueuePool,
+                               pool_size=current_app.config['REPORT_POOL_SIZE'], max_overflow=0,
+                               connect_args=dict(check_same_thread=False))
+
+        @event.listens_for(engine, 'connect')
+        def query_only(connection, record):
+            # Transactions are begun below rather than by the driver,
+            # which would only begin them before writes
+            connection.isolation_level = None
+            connection.execute('PRAGMA query_only = ON')
+
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.execute('BEGIN')
+
+        return engine
+
+    def _create_session(self):
+        if not is_file_database(db.get_engine(current_app).url):
+            # An in-memory database only exists on the app's own connection
+            return db.session()
+        return Session(bind=self.engine(), autoflush=False)
+
+
+reader = SnapshotReader()
+read_session = reader.session
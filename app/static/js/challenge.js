@@ -1,37 +1,33 @@
+// Answer bundle for this game, used to validate scans without a round trip
+var bundle = null;
+var bundleLoaded = 0;
+// Scans validated with the bundle that have not been reported yet
+var pendingScans = [];
+// Whether a scan was already made for the displayed question
+var attempted = false;
+// Pages served over plain http from a LAN address have no crypto.subtle;
+// they validate every scan on the server instead
+var hashesLocally = !!(window.crypto && window.crypto.subtle && window.TextEncoder);
+
 $(document).ready(function() {
     $("#tag").focus();
     window.scrollTo(0,0);
+    if(hashesLocally) {
+        loadBundle();
+    }
 	$(document).keypress(function(e) {
 		if(e.which === 13) {
-			$.getJSON($SCRIPT_ROOT + '/_validate_challenge_tag', {
-				tag: $('input[name="tag"]').val(),
-				game_id: $('input[name="game_id"]').val(),
-                question_id: $('input[name="question_id"]').val()
-			}, function(data) {
-				if(data.valid === "true") {
-					var html = '<h1>Correct! You scanned: <b><font color=blue>' + data.device__name + '</font></b></h1>';
-                    html += '<h2>' + data.device__description + '</h2>';
-                    if(data.media === "image") {
-                        html += '<img src="' + data.file_loc + '" id="myImg"></img>';
-                    } else if(data.media === "audio") {
-                        html += '<audio controls><source src="' + data.file_loc + '" type="audio/mpeg"></audio>'
-                    } else if(data.media === "video") {
-                        html += '<video id="video" width="320" controls><source src="' + data.file_loc + '" type="video/mp4"></video>'
-                    }
-					$('#challenge-content').html(html);
-					$('#challengeModal').css('display', 'inline');
-
-                    $('.shade').css('display', 'inline');
-                    $('#tag').prop('disabled',true);
-
-					sizeModalWindow();
-                    //Text-to-Speech for description
-                    responsiveVoice.speak(data.device__description, "US English Male");
-				} //end if
-				else
-					alert("Not quite. Try again!");
-                    $('#tag').val('');
-			}); //end getJSON
+            var tag = $('input[name="tag"]').val();
+            var questionId = $('input[name="question_id"]').val();
+            if(!hashesLocally) {
+                validateOnServer(tag, questionId);
+            } else if(bundleFresh() && bundle.questions.hasOwnProperty(questionId)) {
+                validateLocally(tag, questionId);
+            } else {
+                // Bundle is missing or stale, ask server and refresh bundle
+                loadBundle();
+                validateOnServer(tag, questionId);
+            }
 			return false;
 		}
 	});//end kepyress function
@@ -41,10 +37,118 @@ $(document).ready(function() {
         $('.shade').css('display', 'none');
         $("#tag").prop('disabled',false).focus();
 	});//end click function for close button
+
+    // Report locally validated scans in the background
+    setInterval(function() { reportScans(false); }, 5000);
+    $(window).on('beforeunload', function() { reportScans(true); });
 });//end of doc ready function
 
 $(window).resize(sizeModalWindow);
 
+function loadBundle(){
+    $.getJSON($SCRIPT_ROOT + '/_challenge_bundle', {
+        game_id: $('input[name="game_id"]').val()
+    }, function(data) {
+        bundle = data;
+        bundleLoaded = Date.now();
+    }); //end getJSON
+};//end of loadBundle function
+
+function bundleFresh(){
+    return bundle !== null && Date.now() - bundleLoaded < bundle.max_age * 1000;
+};//end of bundleFresh function
+
+function sha256(text){
+    var bytes = new TextEncoder().encode(text);
+    return window.crypto.subtle.digest('SHA-256', bytes).then(function(digest) {
+        var hex = '';
+        var view = new Uint8Array(digest);
+        for(var i = 0; i < view.length; i++) {
+            hex += ('0' + view[i].toString(16)).slice(-2);
+        }
+        return hex;
+    });
+};//end of sha256 function
+
+function validateLocally(tag, questionId){
+    sha256(bundle.salt + tag).then(function(hash) {
+        var answers = bundle.questions[questionId];
+        var valid = answers.hasOwnProperty(hash);
+        var device = valid ? answers[hash] : null;
+        // The server checks the answer again before recording it
+        pendingScans.push({
+            question_id: parseInt(questionId, 10),
+            tag: tag,
+            first_try: !attempted
+        });
+        attempted = true;
+        showResult(valid ? $.extend({valid: "true"}, device) : {valid: "false"});
+    });
+};//end of validateLocally function
+
+function validateOnServer(tag, questionId){
+    $.getJSON($SCRIPT_ROOT + '/_validate_challenge_tag', {
+        tag: tag,
+        game_id: $('input[name="game_id"]').val(),
+        question_id: questionId
+    }, showResult); //end getJSON
+};//end of validateOnServer function
+
+function reportScans(leaving){
+    if(pendingScans.length === 0 || bundle === null) {
+        return;
+    }
+    var url = $SCRIPT_ROOT + '/_report_challenge_scans';
+    var body = JSON.stringify({token: bundle.token, scans: pendingScans});
+    pendingScans = [];
+    // Page is being left, hand report to the browser
+    if(leaving && navigator.sendBeacon) {
+        navigator.sendBeacon(url, body);
+        return;
+    }
+    $.ajax({
+        url: url,
+        type: 'POST',
+        contentType: 'application/json',
+        data: body,
+        success: function(data) {
+            if(data.stale) {
+                loadBundle();
+            }
+        }
+    }); //end ajax
+};//end of reportScans function
+
+function showResult(data){
+    if(data.valid === "true") {
+        var html = '<h1>Correct! You scanned: <b><font color=blue>' + data.device__name + '</font></b></h1>';
+        html += '<h2>' + data.device__description + '</h2>';
+        if(data.media === "image") {
+            html += '<img src="' + data.file_loc + '" id="myImg"></img>';
+        } else if(data.media === "audio") {
+            html += '<audio controls><source src="' + data.file_loc + '" type="audio/mpeg"></audio>'
+        } else if(data.media === "video") {
+            html += '<video id="video" width="320" controls><source src="' + data.file_loc + '" type="video/mp4"></video>'
+        }
+        $('#challenge-content').html(html);
+        $('#challengeModal').css('display', 'inline');
+
+        $('.shade').css('display', 'inline');
+        $('#tag').prop('disabled',true);
+
+        sizeModalWindow();
+        //Text-to-Speech for description, pre-rendered if available
+        if(data.narration) {
+            new Audio(data.narration).play();
+        } else {
+            responsiveVoice.speak(data.device__description, "US English Male");
+        }
+    } //end if
+    else
+        alert("Not quite. Try again!");
+    $('#tag').val('');
+};//end of showResult function
+
 function sizeModalWindow(){
     var docW = $(document).width();
     var docH = $(document).height();
@@ -24,8 +24,12 @@ $(document).ready(function() {
 					$('#tag').prop('disabled',true);
 
 					sizeModalWindow();
-                    //Text-to-Speech for description
-                    responsiveVoice.speak(data.device__description, "US English Male");
+                    //Text-to-Speech for description, pre-rendered if available
+                    if(data.narration) {
+                        new Audio(data.narration).play();
+                    } else {
+                        responsiveVoice.speak(data.device__description, "US English Male");
+                    }
 				} //end if
 				else
 					alert("The object you scanned was not a part of this game. Try again!");
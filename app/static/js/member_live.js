@@ -0,0 +1,23 @@
+$(document).ready(function() {
+    var source = new EventSource($SCRIPT_ROOT + '/members/live/stream');
+
+    source.addEventListener('counters', function(e) {
+        showCounters(JSON.parse(e.data));
+    });
+    source.addEventListener('checkin', function(e) {
+        var data = JSON.parse(e.data);
+        showCounters(data.counters);
+        //Add check-in to top of table, keeping the last 20
+        var row = $('<tr></tr>');
+        row.append($('<td></td>').text(data.time));
+        row.append($('<td></td>').text(data.name));
+        $('#checkins tr:first').after(row);
+        $('#checkins tr:gt(20)').remove();
+    });
+});//end of doc ready function
+
+function showCounters(counters){
+    $('#today').text(counters.today);
+    $('#this_hour').text(counters.this_hour);
+    $('#unique_members').text(counters.unique_members);
+};//end of showCounters function
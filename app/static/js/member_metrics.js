@@ -1,4 +1,6 @@
 $(document).ready(function() {
     $("#datepicker_start").datepicker();
     $("#datepicker_end").datepicker();
+    $("#datepicker_export_start").datepicker();
+    $("#datepicker_export_end").datepicker();
 });//end of doc ready function
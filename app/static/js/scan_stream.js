@@ -0,0 +1,39 @@
+// Relay scans posted by scanner.py into the page's tag input, as if typed
+$(document).ready(function() {
+    var input = $('#tag');
+    var token = input.data('stream-token');
+    // Without INGEST_TOKEN the server streams no scans
+    if(!input.length || !window.EventSource || !token) {
+        return;
+    }
+    // Station is given once with ?station= and remembered by the browser
+    var match = /[?&]station=([^&]*)/.exec(window.location.search);
+    if(match) {
+        localStorage.setItem('station', decodeURIComponent(match[1]));
+    }
+    var station = localStorage.getItem('station') || input.data('station');
+    var source = new EventSource($SCRIPT_ROOT + '/scans/stream?station=' +
+        encodeURIComponent(station) + '&token=' + encodeURIComponent(token));
+
+    source.addEventListener('scan', function(e) {
+        var scan = JSON.parse(e.data);
+        // Confirm the scan was taken, so the scanner can forget it
+        $.ajax({
+            url: $SCRIPT_ROOT + '/_scans/received',
+            type: 'POST',
+            contentType: 'application/json',
+            data: JSON.stringify({token: token, receipt: scan.receipt})
+        }); //end ajax
+        // Like typing, scans are ignored while a result is displayed
+        if(input.prop('disabled')) {
+            return;
+        }
+        input.val(scan.tag);
+        var enter = $.Event('keypress', {which: 13});
+        input.trigger(enter);
+        // Pages without a keypress handler submit the tag's form
+        if(!enter.isDefaultPrevented() && input.closest('form').length) {
+            input.closest('form').submit();
+        }
+    });
+});//end of doc ready function
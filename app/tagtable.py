@@ -0,0 +1,205 @@
+''' Memory-mapped table of the devices of every game by tag.
+
+    Scan validation looks devices up by (game id, tag). Instead of a
+    query, or a cache in every server process, the pairs are written to
+    one file shared by all processes:
+
+        header   magic, record count, offset of data
+        records  fixed-width records sorted by (game id, tag), each with
+                 the game id and the offset and lengths of its tag and
+                 device payload in the data; a game with several
+                 devices sharing a tag has a record for each
+        data     each record's tag in UTF-8, followed by device_payload()
+                 of its device as JSON
+
+    Every process maps the file read-only, so the operating system keeps
+    one copy of it in memory, and a lookup is a binary search over the
+    mapped records. The table is rebuilt from the database whenever the
+    devices of a game change, by writing a new file and renaming it over
+    the old one; processes notice the new file and map it on their next
+    lookup. A file written in another format is rebuilt when mapped.'''
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from flask import current_app
+from flask.ext.script import Manager
+
+from app import db
+from .models import Device, game_device_link
+from .utils import device_payload
+
+
+MAGIC = b'RFIDTAG2'
+HEADER = struct.Struct('>8sII')
+# Game id, offset of tag and payload in the data, tag length, payload length
+RECORD = struct.Struct('>IIHI')
+
+
+def table_key(game_id, tag):
+    ''' Return (game id, UTF-8 tag) key of tag in game, or None if it can
+        not be stored.'''
+
+    if isinstance(tag, bytes):
+        tag = tag.decode('utf-8')
+    tag = (u'%s' % tag).encode('utf-8')
+    if len(tag) >= 2 ** 16 or not 0 <= game_id < 2 ** 32:
+        return None
+    return game_id, tag
+
+
+def build_table(rows):
+    ''' Return table file contents for (game id, device) pairs. Devices
+        sharing a key keep the order of rows.'''
+
+    entries = []
+    for game_id, device in rows:
+        key = table_key(game_id, device.rfid_tag or '')
+        if key is not None:
+            entries.append((key, json.dumps(device_payload(device)).encode('utf-8')))
+
+    # Sorting is stable, so the first device of a key stays first
+    entries.sort(key=lambda entry: entry[0])
+    data_start = HEADER.size + RECORD.size * len(entries)
+    records = []
+    data = []
+    offset = data_start
+    for (game_id, tag), payload in entries:
+        records.append(RECORD.pack(game_id, offset, len(tag), len(payload)))
+        data.extend((tag, payload))
+        offset += len(tag) + len(payload)
+    return HEADER.pack(MAGIC, len(entries), data_start) + b''.join(records) + b''.join(data)
+
+
+def read_record(mapping, number):
+    ''' Return key, payload offset and payload length of a record.'''
+
+    game_id, offset, tag_length, length = RECORD.unpack_from(
+                mapping, HEADER.size + number * RECORD.size)
+    tag = mapping[offset:offset + tag_length]
+    return (game_id, tag), offset + tag_length, length
+
+
+class TagTable(object):
+    ''' Lookups in, and rebuilds of, the table file of the current app.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> (inode, modification time, size, mapping, record count)
+        self._maps = {}
+
+    def path(self):
+        return current_app.config['TAG_TABLE_PATH']
+
+    def rebuild(self):
+        ''' Write the table from the database and atomically replace the
+            table file.'''
+
+        rows = db.session.query(game_device_link.c.game_id, Device).join(
+                    Device, Device.id == game_device_link.c.device_id).order_by(
+                    game_device_link.c.game_id, Device.id)
+        content = build_table(rows)
+
+        path = self.path()
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, partial = tempfile.mkstemp(dir=directory, prefix='.tag_table.')
+        try:
+            with os.fdopen(handle, 'wb') as table:
+                table.write(content)
+                table.flush()
+                os.fsync(table.fileno())
+            os.rename(partial, path)
+        except Exception:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+    def _mapping(self):
+        ''' Return (mapping, record count) of the current table file,
+            mapping it again if it was replaced. Builds it if missing.'''
+
+        path = self.path()
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.rebuild()
+            stat = os.stat(path)
+        version = (stat.st_ino, stat.st_mtime, stat.st_size)
+        mapped = self._maps.get(path)
+        if mapped is None or mapped[:3] != version:
+            with self._lock:
+                mapped = self._maps.get(path)
+                if mapped is None or mapped[:3] != version:
+                    mapped = self._map(path, version)
+            if mapped is None:
+                # Written in another format, e.g. by an older version
+                self.rebuild()
+                return self._mapping()
+        return mapped[3], mapped[4]
+
+    def _map(self, path, version):
+        ''' Map the table file and remember the mapping. Returns None if
+            the file is not in the current format.'''
+
+        with open(path, 'rb') as table:
+            mapping = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapping) < HEADER.size:
+            mapping.close()
+            return None
+        magic, count, data_start = HEADER.unpack_from(mapping, 0)
+        if magic != MAGIC:
+            mapping.close()
+            return None
+        # Replaced mappings are unmapped once no lookup uses them
+        mapped = version + (mapping, count)
+        self._maps[path] = mapped
+        return mapped
+
+    def lookup_all(self, game_id, tag):
+        ''' Return device_payload() dicts of every device of a game with
+            tag, first device first.'''
+
+        key = table_key(game_id, tag)
+        if key is None:
+            return []
+        mapping, count = self._mapping()
+        # Find the first record with the key
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if read_record(mapping, middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        devices = []
+        for number in range(low, count):
+            record_key, offset, length = read_record(mapping, number)
+            if record_key != key:
+                break
+            devices.append(json.loads(mapping[offset:offset + length].decode('utf-8')))
+        return devices
+
+    def lookup(self, game_id, tag):
+        ''' Return device_payload() dict of the first device of a game
+            with tag, or None.'''
+
+        devices = self.lookup_all(game_id, tag)
+        return devices[0] if devices else None
+
+
+tag_table = TagTable()
+
+
+TagTableCommand = Manager(usage='Maintain the tag lookup table')
+
+
+@TagTableCommand.command
+def rebuild():
+    ''' Rebuild the tag table, e.g. after editing games outside the app.'''
+
+    tag_table.rebuild()
+    print('Wrote %s.' % current_app.config['TAG_TABLE_PATH'])
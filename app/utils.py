@@ -2,6 +2,8 @@
 
 import config, sys
 
+from .narration import narration_url
+
 def read_rfid():
     ''' Read RFID tag from serial port.'''
     
@@ -24,3 +26,14 @@ def media_type(extension):
         media = "video"
 
     return media
+
+
+def device_payload(device):
+    ''' Return JSON fields describing a scanned device.'''
+
+    return dict(device__id=device.id,
+                device__name=device.name,
+                device__description=device.description,
+                file_loc="/static/media/" + device.file_loc,
+                media=media_type(device.file_loc.split('.')[-1]),
+                narration=narration_url(device.description))
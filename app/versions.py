@@ -0,0 +1,28 @@
+''' Shared versions of tables cached in memory.
+
+    Every server process keeps its own in-memory copies of some tables
+    (app.registry, app.reports). A write that makes such copies wrong
+    bumps the table's version in the data_versions table, in the same
+    transaction, and the caches compare the version they hold with the
+    stored one, so they also notice changes made by other processes.'''
+
+from .models import DataVersion
+
+
+def bump(connection, name):
+    ''' Increase the version of name within the transaction of
+        connection.'''
+
+    versions = DataVersion.__table__
+    bumped = connection.execute(versions.update().where(
+                versions.c.Name == name).values(
+                Version=versions.c.Version + 1)).rowcount
+    if not bumped:
+        connection.execute(versions.insert().values(Name=name, Version=1))
+
+
+def current(session, name):
+    ''' Return the version of name as seen by session.'''
+
+    return session.query(DataVersion.version).filter(
+                DataVersion.name == name).scalar() or 0
@@ -1,36 +1,86 @@
+import json
+import mimetypes
 import os
-from app import app, db, login_manager
+import tempfile
+from app import db, login_manager
 from datetime import datetime, timedelta
-from flask import flash, g, jsonify, redirect, render_template, request, session, url_for
+from flask import abort, Blueprint, current_app, flash, g, jsonify, redirect, render_template, request, Response, send_from_directory, session, stream_with_context, url_for
 from flask.ext.login import login_user, logout_user, current_user, login_required
 from sqlalchemy import text
-from werkzeug import secure_filename
-
-from .forms import LoginForm
-from .models import Device, Game, game_device_link, GameMode, Member, MemberVisit, Question, question_answer_link, User
-from .utils import allowed_file, media_type
-
-
-@app.before_request
+from werkzeug.utils import secure_filename
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from .analytics import busiest_hours, device_scan_counts, question_success_rates
+from .archive import delete_member_history
+from .bundles import answer_cache, build_bundle, read_token
+from .export import export_stream, report_range
+from .history import decode_cursor, iter_visits, visit_page
+from .ingest import authorized, parse_events, scan_hub, stream_authorized, stream_token
+from .jobs import job_status, jobs
+from .live import check_ins
+from .membership import check_in, recent_check_ins, record_visit
+from .narration import queue_narration
+from .models import Device, Game, game_device_link, Job, Member, MemberVisit, Question, question_answer_link, User
+from .registry import game_modes
+from .replication import apply_batch, decode_batch, log_change
+from .reports import metrics_cache
+from .roster import import_members
+from .rows import answer_names, device_rows, game_row_or_404, game_rows, member_rows, question_rows
+from .scanlog import scan_log
+from .tagtable import tag_table
+from .utils import allowed_file
+
+
+main = Blueprint('main', __name__)
+
+
+@main.before_app_request
 def before_request():
     g.user = current_user
 
 
-@app.route('/')
-@app.route('/home')
+@main.route('/')
+@main.route('/home')
 def home():
     ''' Home page for application.'''
 
     return render_template('home.html')
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/assets/<filename>')
+def asset(filename):
+    ''' Serve a bundle built by `run.py assets build`, gzip compressed if
+        the browser accepts it. Bundle names change with their content,
+        so they are cached for good.'''
+
+    folder = current_app.config['ASSET_FOLDER']
+    mimetype = mimetypes.guess_type(filename)[0]
+    compressed = 'gzip' in request.headers.get('Accept-Encoding', '')
+    if compressed and os.path.isfile(os.path.join(folder, filename + '.gz')):
+        response = send_from_directory(folder, filename + '.gz', mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(folder, filename, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % (
+                current_app.config['ASSET_MAX_AGE'])
+    return response
+
+
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     ''' User login page.'''
 
     # make sure that user is not already logged in
     if g.user is not None and g.user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
+
+    # forms are only needed by admins, so load them on demand
+    from .forms import LoginForm
 
     # instantiate LoginForm
     form = LoginForm()
@@ -42,11 +92,11 @@ def login():
         # check if user has access to next url
         next = request.args.get('next')
 
-        return redirect(next or url_for('home'))
+        return redirect(next or url_for('.home'))
     return render_template('login.html', form=form)
 
 
-@app.route('/logout')
+@main.route('/logout')
 def logout():
     ''' User logout page.'''
     
@@ -55,7 +105,7 @@ def logout():
     session.pop('user_id', None)
     session.pop('authenticated', None)
     flash(u'Successfully logged out.', 'success')
-    return redirect(url_for('home'))
+    return redirect(url_for('.home'))
 
 
 @login_manager.user_loader
@@ -64,7 +114,7 @@ def load_user(user_id):
 
 
 # AJAX
-@app.route('/_validate_learning_tag')
+@main.route('/_validate_learning_tag')
 def validate_learning_tag():
     ''' JSON view to check if scanned RFID tag is valid
         tag for learning mode game.'''
@@ -74,24 +124,19 @@ def validate_learning_tag():
     game_id = request.args.get('game_id', 0, type=int)
 
     # Check if RFID tag is associated with game
-    device = Device.query.join(Game.devices).filter(
-                    Game.id == game_id).filter(
-                    Device.rfid_tag == tag).first()
+    device = tag_table.lookup(game_id, tag)
+    scan_log.log(game_id, tag, device['device__id'] if device else None)
 
     # If device exists, return JSON
     if device:
-        return jsonify(valid="true",
-                       device__name=device.name,
-                       device__description=device.description,
-                       file_loc="/static/media/" + device.file_loc,
-                       media=media_type(device.file_loc.split('.')[-1]))
+        return jsonify(valid="true", **device)
     # Otherwise, return None
     else:
         return jsonify(valid="false")
 
 
 #AJAX
-@app.route('/_validate_challenge_tag')
+@main.route('/_validate_challenge_tag')
 def validate_challenge_tag():
     ''' JSON view to check if scanned RFID tag answers question
         to challenge mode game.'''
@@ -105,24 +150,174 @@ def validate_challenge_tag():
     if Question.query.get(question_id).game != game_id:
         return jsonify(valid="false")
 
-    # Check if RFID tag answers question
-    device = Device.query.join(Question.answers).filter(
-                Question.id == question_id).filter(
-                Device.rfid_tag == tag).first()
+    # Check if RFID tag belongs to game and one of its devices with the
+    # tag answers question
+    device = None
+    devices = dict((device['device__id'], device) for device in tag_table.lookup_all(game_id, tag))
+    if devices:
+        answer = db.session.query(question_answer_link.c.device_id).filter(
+                    question_answer_link.c.question_id == question_id).filter(
+                    question_answer_link.c.device_id.in_(list(devices))).order_by(
+                    question_answer_link.c.device_id).first()
+        if answer is not None:
+            device = devices[answer[0]]
+    # First scan since the question was shown counts as first try
+    first_try = session.get('attempted') != question_id
+    session['attempted'] = question_id
+    scan_log.log(game_id, tag, device['device__id'] if device else None, question_id, first_try)
    
     # If device exists, return JSON
     if device:
-        return jsonify(valid="true",
-                       device__name=device.name,
-                       device__description=device.description,
-                       file_loc="/static/media/" + device.file_loc,
-                       media=media_type(device.file_loc.split('.')[-1]))
+        return jsonify(valid="true", **device)
     # Otherwise, return None
     else:
         return jsonify(valid="false")
 
+
+#AJAX
+@main.route('/_challenge_bundle')
+def challenge_bundle():
+    ''' JSON view of hashed answers to every question of a challenge
+        game, used by the kiosk to validate scans locally.'''
+
+    game_id = request.args.get('game_id', 0, type=int)
+    Game.query.get_or_404(game_id)
+    return jsonify(**build_bundle(game_id))
+
+
+#AJAX
+@main.route('/_report_challenge_scans', methods=['POST'])
+def report_challenge_scans():
+    ''' Record scans that the kiosk validated with an answer bundle.
+
+        Scans are checked against the game's answers again, so a report
+        can not record answers the kiosk made up. Reports whether the
+        bundle used is stale so the kiosk can fetch a new one.'''
+
+    report = request.get_json(force=True, silent=True) or {}
+    if not isinstance(report, dict):
+        return jsonify(accepted=0, stale=True), 400
+    signed = read_token(report.get('token', ''))
+    if signed is None:
+        return jsonify(accepted=0, stale=True), 400
+    game_id, version = signed
+    scans = report.get('scans', [])
+    if not isinstance(scans, list) or not all(isinstance(scan, dict) for scan in scans):
+        return jsonify(accepted=0, stale=True), 400
+
+    answers = answer_cache.answers(game_id)
+    # Bound work done for a single report
+    scans = scans[:current_app.config['CHALLENGE_REPORT_LIMIT']]
+    for scan in scans:
+        tag = str(scan.get('tag', ''))[:50]
+        question_id = scan.get('question_id')
+        # Scans of questions of other games are recorded without one
+        if not isinstance(question_id, int) or question_id not in answers['questions']:
+            question_id = None
+        device_id = answers['questions'].get(question_id, {}).get(tag)
+        scan_log.log(game_id, tag, device_id, question_id, bool(scan.get('first_try')))
+
+    return jsonify(accepted=len(scans), stale=version != answers['version'])
+
+
+#AJAX
+def check_local_request():
+    ''' Refuse scan ingest and streams from other machines, unless
+        INGEST_LOCAL_ONLY is off.'''
+
+    if current_app.config['INGEST_LOCAL_ONLY'] and request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+
+
+@main.app_context_processor
+def inject_scan_stream_token():
+    ''' Let kiosk pages open the scan stream.'''
+
+    return dict(scan_stream_token=lambda: stream_token(current_app.config['INGEST_TOKEN']))
+
+
+@main.route('/_ingest_scans', methods=['POST'])
+def ingest_scans():
+    ''' Accept one or a batch of scan events posted by scanner.py.'''
+
+    check_local_request()
+    if not authorized(request.headers.get('Authorization', ''), current_app.config['INGEST_TOKEN']):
+        abort(401)
+    try:
+        events = parse_events(request.get_json(force=True, silent=True),
+                              current_app.config['INGEST_BATCH_LIMIT'])
+    except ValueError as e:
+        return jsonify(accepted=0, error=str(e)), 400
+
+    config = current_app.config
+    result = scan_hub.publish(events, config['INGEST_DELIVERY_TIMEOUT'], config['INGEST_MAX_AGE'])
+    return jsonify(**result)
+
+
+#AJAX
+@main.route('/_replication/changes', methods=['POST'])
+def receive_changes():
+    ''' Apply a compressed batch of member and visit changes pushed by a
+        satellite node with `run.py replication push`.'''
+
+    if not authorized(request.headers.get('Authorization', ''), current_app.config['REPLICATION_TOKEN']):
+        abort(401)
+    limit = current_app.config['REPLICATION_MAX_BYTES']
+    if (request.content_length or 0) > limit:
+        abort(413)
+    try:
+        batch = decode_batch(request.get_data(), request.headers.get('Content-Encoding', ''), limit)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(**apply_batch(batch))
+
+
+#AJAX
+@main.route('/_scans/received', methods=['POST'])
+def scan_received():
+    ''' Confirmation from a kiosk page that it took a streamed scan, which
+        lets the ingest request acknowledge it to scanner.py.'''
+
+    check_local_request()
+    report = request.get_json(force=True, silent=True)
+    if not isinstance(report, dict):
+        return jsonify(confirmed=False), 400
+    if not stream_authorized(u'%s' % report.get('token', ''), current_app.config['INGEST_TOKEN']):
+        abort(401)
+    return jsonify(confirmed=scan_hub.confirm(u'%s' % report.get('receipt', '')))
+
+
+@main.route('/scans/stream')
+def scan_stream():
+    ''' Server-sent event stream of scans of a station for kiosk pages,
+        opened with the page's scan_stream_token().'''
+
+    check_local_request()
+    if not stream_authorized(request.args.get('token', ''), current_app.config['INGEST_TOKEN']):
+        abort(401)
+    station = request.args.get('station') or current_app.config['SCANNER_STATION']
+    interval = current_app.config['LIVE_KEEPALIVE_INTERVAL']
+    subscriber = scan_hub.subscribe(station)
+
+    def stream():
+        try:
+            while True:
+                try:
+                    event, receipt_id = subscriber.get(timeout=interval)
+                except Empty:
+                    # Comment line keeps the connection open
+                    yield ': keepalive\n\n'
+                    continue
+                # The page posts the receipt back once it took the scan
+                yield 'event: scan\ndata: %s\n\n' % json.dumps(dict(event, receipt=receipt_id))
+        finally:
+            scan_hub.unsubscribe(station, subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
     
-@app.route('/games/learn/<int:game_id>')
+@main.route('/games/learn/<int:game_id>')
 def learning_game(game_id):
     ''' Format for learning games.'''
 
@@ -130,14 +325,14 @@ def learning_game(game_id):
     game = Game.query.get_or_404(game_id)
 
     # If game is of incorrect mode, return to games page
-    if GameMode.query.get(game.game_mode).mode != "learning":
+    if game_modes.get(game.game_mode).mode != "learning":
         flash(u'%s is not a learning mode game.' % game.title, 'error')
-        return redirect(url_for('games'))
+        return redirect(url_for('.games'))
     
     return render_template('learning_game.html', game=game)
 
 
-@app.route('/games/challenge/<int:game_id>', methods=['GET', 'POST'])
+@main.route('/games/challenge/<int:game_id>', methods=['GET', 'POST'])
 def challenge_game(game_id):
     ''' Format for challenge games.'''
 
@@ -149,21 +344,24 @@ def challenge_game(game_id):
         # Increment question id
         if "next_question" in request.form:
             session['question'] += 1
-            return redirect(url_for('challenge_game', game_id=game_id))
+            return redirect(url_for('.challenge_game', game_id=game_id))
         # Decrement question id
         elif "previous_question" in request.form:
             session['question'] -= 1
-            return redirect(url_for('challenge_game', game_id=game_id))
+            return redirect(url_for('.challenge_game', game_id=game_id))
         # If they are finished, remove session variables
         elif "finish" in request.form:
             session.pop('challenge_id', None)
             session.pop('question', None)
-            return redirect(url_for('games'))
+            return redirect(url_for('.games'))
     else:
         # If game is of incorrect mode, return to games page
-        if GameMode.query.get(game.game_mode).mode != "challenge":
+        if game_modes.get(game.game_mode).mode != "challenge":
             flash(u'%s is not a challenge mode game.' % game.title, 'error')
-            return redirect(url_for('games'))
+            return redirect(url_for('.games'))
+
+        # Next scan is a first try at the displayed question
+        session.pop('attempted', None)
 
         # Check that session variable corresponds to correct challenge game
         game_check = 'challenge_id' in session and game_id == session['challenge_id']
@@ -195,7 +393,16 @@ def challenge_game(game_id):
                     max_id=questions[-1].id)
 
 
-@app.route('/games', methods=['GET', 'POST'])
+def games_for_mode(name):
+    ''' Return games of given mode ordered by title.'''
+
+    mode = game_modes.by_name(name)
+    if mode is None:
+        return []
+    return game_rows(mode.id)
+
+
+@main.route('/games', methods=['GET', 'POST'])
 def games():
     ''' List of games. Admins can edit or delete games.'''
     
@@ -208,19 +415,17 @@ def games():
             title = game.title
             # Delete all devices associated with game
             devices = Device.query.join(Game.devices).filter(Game.id == game_id)
+            filenames = []
             for device in devices:
                 # Check if file is used by another device
                 if Device.query.filter(Device.file_loc == device.file_loc).count() == 1:
-                    # Get file location to delete
-                    filename = os.path.join(app.config['UPLOAD_FOLDER'], device.file_loc)
-                    # Try to delete file
-                    try:
-                        os.remove(filename)
-                    except OSError:
-                        flash(u'File %s does not exist.' % device.file_loc, 'error')
+                    filenames.append(device.file_loc)
                 # Delete rfid
                 db.session.delete(device)
             db.session.commit()
+            # Files are deleted in the background
+            if filenames:
+                jobs.submit('remove_media', filenames=filenames)
 
             # Delete all questions associated with game
             questions = Question.query.filter(Question.game == game_id)
@@ -230,31 +435,30 @@ def games():
             # Delete associated game
             db.session.delete(game)
             db.session.commit()
+            tag_table.rebuild()
             # report that game was deleted and reload page
             flash(u'Successfully deleted %s.' % title, 'success')
-            return redirect(url_for('games'))
+            return redirect(url_for('.games'))
         # if a game is to be created, make a new game and redirect to its page
         elif "create" in request.form:
             # default to first game mode
-            game_mode = GameMode.query.all()[0].id
+            game_mode = game_modes.default().id
             game = Game(title="Default", description="default", game_mode=game_mode)
             db.session.add(game)
             db.session.commit()
             # redirect to game's edit page
-            return redirect(url_for('edit_game', game_id=game.id))
+            return redirect(url_for('.edit_game', game_id=game.id))
     # otherwise, get data for template
     else:
         # list all learning games first
-        learning_games = Game.query.join(GameMode).filter(
-                GameMode.mode == "learning").order_by('title')
-        challenge_games = Game.query.join(GameMode).filter(
-                GameMode.mode == "challenge").order_by('title')
+        learning_games = games_for_mode("learning")
+        challenge_games = games_for_mode("challenge")
         return render_template('games.html',
                 learning_games=learning_games,
                 challenge_games=challenge_games)
 
 
-@app.route('/games/manage/<int:game_id>', methods=['GET', 'POST'])
+@main.route('/games/manage/<int:game_id>', methods=['GET', 'POST'])
 @login_required
 def edit_game(game_id):
     ''' Interface for admin to create or edit games.'''
@@ -263,7 +467,7 @@ def edit_game(game_id):
     if request.method == "POST":
         # Get game it exists
         game = Game.query.get_or_404(game_id)
-        game_mode = GameMode.query.get_or_404(game.game_mode)
+        game_mode = game_modes.get_or_404(game.game_mode)
         # Check if game attribtues need to be changed
         if "edit_game" in request.form:
             edit = True
@@ -287,7 +491,7 @@ def edit_game(game_id):
             if edit:
                 game.title = title
                 game.description = description
-                game_mode = GameMode.query.get(mode)
+                game_mode = game_modes.get_or_404(mode)
                 game.game_mode = game_mode.id
                 db.session.commit()
 
@@ -297,26 +501,26 @@ def edit_game(game_id):
             name = request.form.get('device_name', type=str)
             if not name:
                 flash(u'Invalid device name.', 'error')
-                return redirect(url_for('edit_game', game_id=game_id))
+                return redirect(url_for('.edit_game', game_id=game_id))
             # Make sure a valid description is entered
             description = request.form.get('device_description', type=str)
             if not description:
                 flash(u'Invalid device description.', 'error')
-                return redirect(url_for('edit_game', game_id=game_id))
+                return redirect(url_for('.edit_game', game_id=game_id))
             # Make sure valid RFID tag is entered
             tag = request.form.get('device_tag', type=str)
             if not tag:
                 flash(u'Invalid rfid tag.', 'error')
-                return redirect(url_for('edit_game', game_id=game_id))
+                return redirect(url_for('.edit_game', game_id=game_id))
             # Get file to upload
             file = request.files['file']
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
-                file_loc = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                file_loc = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
                 file.save(file_loc)
             else:
                 flash(u'Invalid file.', 'error')
-                return redirect(url_for('edit_game', game_id=game_id))
+                return redirect(url_for('.edit_game', game_id=game_id))
             # Now that everything is good, create Device and link it
             device = Device(name=name, description=description, rfid_tag=tag, file_loc=filename)
             db.session.add(device)
@@ -325,6 +529,27 @@ def edit_game(game_id):
             device_link = game_device_link.insert().values(game_id=game_id, device_id=device.id)
             db.session.execute(device_link)
             db.session.commit()
+            tag_table.rebuild()
+            queue_narration([device.id])
+
+        # Handle adding devices and questions from a zip archive
+        elif "import_game" in request.form:
+            archive = request.files.get('archive')
+            if not archive or not archive.filename.lower().endswith('.zip'):
+                flash(u'You must select a zip archive.', 'error')
+                return redirect(url_for('.edit_game', game_id=game_id))
+            # The upload is only readable during the request, so it is saved
+            # here and built in the background, which deletes it when done
+            handle, path = tempfile.mkstemp(suffix='.zip')
+            os.close(handle)
+            try:
+                archive.save(path)
+            except Exception:
+                os.remove(path)
+                raise
+            # A bad archive fails the same way every time, so it is not retried
+            job = jobs.submit('build_game', max_attempts=1, game_id=game_id, path=path)
+            flash(u'Importing %s as job %d.' % (archive.filename, job.id), 'success')
 
         # Handle deleting RFID and associated media
         elif "the_device" in request.form:
@@ -333,17 +558,16 @@ def edit_game(game_id):
             device = Device.query.get(device_id)
             device_name = device.name
             # Check if file is used by other devices
+            filenames = []
             if Device.query.filter(Device.file_loc == device.file_loc).count() == 1:
-                # Get file location to delete
-                filename = os.path.join(app.config['UPLOAD_FOLDER'], device.file_loc)
-                # Try to delete file
-                try:
-                    os.remove(filename)
-                except OSError:
-                    flash(u'File %s does not exist.' % device.file_loc, 'error')
+                filenames.append(device.file_loc)
             # Delete rfid
             db.session.delete(device)
             db.session.commit()
+            # File is deleted in the background
+            if filenames:
+                jobs.submit('remove_media', filenames=filenames)
+            tag_table.rebuild()
             flash(u'Successfully deleted %s.' % device_name, 'success')
 
         # Handle adding new Question and associated answers
@@ -357,7 +581,7 @@ def edit_game(game_id):
             # Return an error if no answers are selected
             if not answers:
                 flash(u'Question must have at least one answer.' 'error')
-                return redirect(url_for('edit_game', game_id=game_id))
+                return redirect(url_for('.edit_game', game_id=game_id))
             # Otherwise, create question and link answers
             else:
                 db.session.commit()
@@ -378,40 +602,56 @@ def edit_game(game_id):
             flash(u'Successfully deleted %s.' % question_name, 'success')
 
         # if we get here, render GET request
-        return redirect(url_for('edit_game', game_id=game_id))
+        return redirect(url_for('.edit_game', game_id=game_id))
 
     # otherwise, GET data for template
     else:
         # Get Game and GameMode
-        game = Game.query.get(game_id)
-        current_mode = GameMode.query.get(game.game_mode)
+        game = game_row_or_404(game_id)
+        current_mode = game_modes.get(game.game_mode)
         # Get all game modes
-        game_modes = GameMode.query.order_by('mode').all()
+        modes = sorted(game_modes.all(), key=lambda mode: mode.mode)
         # Get all RFIDs associated with game
-        devices = Device.query.join(Game.devices).filter(
-                    Game.id == game_id).all()
+        devices = device_rows(game_id)
         # if game is of type challenge, get questions and answers
         questions = None
         answers = []
         if current_mode.mode == "challenge":
             # Get all Questions associated with game
-            questions = Question.query.join(Game).filter(
-                    Game.id == game_id).order_by('question')
+            questions = question_rows(game_id)
             # Get answers for each question
-            for question in questions:
-                answers.append(Device.query.join(Question.answers).filter(
-                                    Question.id == question.id).all())
+            names = answer_names(game_id)
+            answers = [names.get(question.id, []) for question in questions]
         # Render template with attributes
         return render_template('edit_games.html',
                     game=game,
                     current_mode=current_mode,
-                    game_modes=game_modes,
+                    game_modes=modes,
                     devices=devices,
                     questions=questions,
                     answers=answers)
 
 
-@app.route('/members', methods=['GET', 'POST'])
+@main.route('/games/analytics/<int:game_id>')
+@login_required
+def game_analytics(game_id):
+    ''' Admin report of how a game is being played.'''
+
+    game = Game.query.get_or_404(game_id)
+    current_mode = game_modes.get(game.game_mode)
+    # Question success rates only apply to challenge games
+    questions = None
+    if current_mode.mode == "challenge":
+        questions = question_success_rates(game_id)
+
+    return render_template('game_analytics.html',
+                game=game,
+                devices=device_scan_counts(game_id),
+                questions=questions,
+                hours=busiest_hours(game_id))
+
+
+@main.route('/members', methods=['GET', 'POST'])
 def members():
     ''' Track member visits to Discovery Space.'''
 
@@ -424,17 +664,17 @@ def members():
                         Member.card_number == member_tag).first()
             # If active member, increment visits and redirect to member page
             if member:
-                visit = MemberVisit(member=member.id, date=datetime.now())
-                # Commit visit
-                db.session.add(visit)
-                db.session.commit()
+                now = datetime.now()
+                # Repeated scans of a card only count towards the visit
+                if check_in(member, now):
+                    check_ins.record(member, now)
                 flash(u'Thank you for visiting!', 'success')
-                return redirect(url_for('home'))
+                return redirect(url_for('.home'))
             # Otherwise, report that tag does not belong to active member
             else:
                 flash(u'Card does not correspond to active member. Select "Add \
                     Member" to add a new member.', 'error')
-                return redirect(url_for('members'))
+                return redirect(url_for('.members'))
         # Create new member
         elif "new_member" in request.form:
             # Get form data
@@ -445,13 +685,13 @@ def members():
             # Validate form data
             if not first_name:
                 flash(u'You must enter a valid first name.', 'error')
-                return redirect(url_for('members'))
+                return redirect(url_for('.members'))
             elif not last_name:
                 flash(u'You must enter a valid last name.', 'error')
-                return redirect(url_for('members'))
+                return redirect(url_for('.members'))
             elif not card_number:
                 flash(u'You must scan a valid membership card.', 'error')
-                return redirect(url_for('members'))
+                return redirect(url_for('.members'))
 
             # Create new member
             member = Member(
@@ -459,21 +699,61 @@ def members():
                         member_last_name=last_name,
                         card_number=card_number)
             db.session.add(member)
+            db.session.flush()
+            log_change('member', 'insert', card_number,
+                       first_name=first_name, last_name=last_name)
+            # Mark first visit and commit together with member
+            now = datetime.now()
+            visit = record_visit(member, now)
             db.session.commit()
-            # Mark first visit
-            visit = MemberVisit(member=member.id, date=datetime.now())
-            db.session.add(visit)
-            db.session.commit()
+            recent_check_ins.remember(member.id, visit.id, now)
+            check_ins.record(member, now)
 
             # Display success
             flash(u'Successfully added %s %s as a member! Welcome!' % (first_name, last_name), 'success')
-            return redirect(url_for('members'))
+            return redirect(url_for('.members'))
     # Render template on GET request
     else:
         return render_template('members.html')
 
 
-@app.route('/members/<int:member_id>', methods=['GET', 'POST'])
+@main.route('/members/live')
+@login_required
+def member_live():
+    ''' Admin dashboard of today's check-ins, updated as they happen.'''
+
+    return render_template('member_live.html', counters=check_ins.snapshot())
+
+
+@main.route('/members/live/stream')
+@login_required
+def member_live_stream():
+    ''' Server-sent event stream of check-ins for the live dashboard.'''
+
+    interval = current_app.config['LIVE_KEEPALIVE_INTERVAL']
+    # Counters are seeded from the database here, while in app context
+    counters = check_ins.snapshot()
+    subscriber = check_ins.subscribe()
+
+    def stream():
+        try:
+            yield 'event: counters\ndata: %s\n\n' % json.dumps(counters)
+            while True:
+                try:
+                    event = subscriber.get(timeout=interval)
+                except Empty:
+                    # Keep connection open and counters current across hours
+                    yield 'event: counters\ndata: %s\n\n' % json.dumps(check_ins.snapshot())
+                    continue
+                yield 'event: checkin\ndata: %s\n\n' % json.dumps(event)
+        finally:
+            check_ins.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@main.route('/members/<int:member_id>', methods=['GET', 'POST'])
 def member_info(member_id):
     ''' View and edit member information.'''
 
@@ -485,17 +765,21 @@ def member_info(member_id):
         if "the_member" in request.form:
             first_name = member.member_first_name
             last_name = member.member_last_name
-            # Delete all member visits
+            # Delete all member visits, including archived ones
             visits = MemberVisit.query.filter(MemberVisit.member == member.id)
             for visit in visits:
                 db.session.delete(visit)
+            delete_member_history(member.id)
             db.session.commit()
+            recent_check_ins.forget(member.id)
             # Delete member
+            log_change('member', 'delete', member.card_number,
+                       first_name=first_name, last_name=last_name)
             db.session.delete(member)
             db.session.commit()
             flash(u'Successfully deleted %s %s.' % (first_name, last_name), 'success')
             # Redirect to member page
-            return redirect(url_for('members'))
+            return redirect(url_for('.members'))
         elif "update_member" in request.form:
             # Get form data
             first_name = request.form.get('first_name', type=str)
@@ -505,37 +789,82 @@ def member_info(member_id):
             # Validate form data
             if not first_name:
                 flash(u'You must enter a valid first name.', 'error')
-                return redirect(url_for('member_info', member_id=member_id))
+                return redirect(url_for('.member_info', member_id=member_id))
             elif not last_name:
                 flash(u'You must enter a valid last name.', 'error')
-                return redirect(url_for('member_info', member_id=member_id))
+                return redirect(url_for('.member_info', member_id=member_id))
             elif not card_number:
                 flash(u'You must scan a valid membership card.', 'error')
-                return redirect(url_for('member_info', member_id=member_id))
+                return redirect(url_for('.member_info', member_id=member_id))
 
             # Update member information
+            log_change('member', 'update', member.card_number,
+                       first_name=first_name, last_name=last_name, card_number=card_number,
+                       previous_name=[member.member_first_name, member.member_last_name])
             member.member_first_name = first_name
             member.member_last_name = last_name
             member.card_number = card_number
             db.session.commit()
             # Reload page
             flash(u'Successfully updated member information.', 'success')
-            return redirect(url_for('member_info', member_id=member_id))
+            return redirect(url_for('.member_info', member_id=member_id))
     else:
-        visits = MemberVisit.query.filter(
-                        MemberVisit.member == member.id).order_by(
-                        MemberVisit.date.desc())
-        # Get total number of visits and date of last visit
-        num_visits = visits.count()
-        last_visit = visits.first().date
+        return render_template('member_info.html', member=member)
+
 
-        return render_template('member_info.html',
-                    member=member,
-                    num_visits=num_visits,
-                    last_visit=last_visit)
+@main.route('/members/<int:member_id>/visits')
+def member_visits(member_id):
+    ''' Page through a member's visits, newest first.'''
 
+    member = Member.query.get_or_404(member_id)
+    try:
+        visits, next_cursor = visit_page(member.id,
+                    request.args.get('after'),
+                    current_app.config['VISIT_HISTORY_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
+
+    return render_template('member_visits.html',
+                member=member,
+                visits=visits,
+                next_cursor=next_cursor)
+
+
+# AJAX
+@main.route('/members/<int:member_id>/visits.json')
+def member_visits_json(member_id):
+    ''' JSON view of a member's visits, newest first.
+
+        Returns one page continuing after the "after" cursor, or with
+        stream=1 every remaining visit as a streamed JSON document.'''
 
-@app.route('/manage_members', methods=['GET', 'POST'])
+    member = Member.query.get_or_404(member_id)
+    cursor = request.args.get('after')
+    try:
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+    if request.args.get('stream', 0, type=int):
+        def stream():
+            yield '{"member_id": %d, "visits": [' % member_id
+            separator = ''
+            for visit in iter_visits(member_id, cursor):
+                yield separator + json.dumps(dict(id=visit.id, date=visit.date.isoformat()))
+                separator = ', '
+            yield ']}'
+
+        return Response(stream_with_context(stream()), mimetype='application/json')
+
+    limit = request.args.get('limit', current_app.config['VISIT_HISTORY_PAGE_SIZE'], type=int)
+    visits, next_cursor = visit_page(member_id, cursor, max(1, min(limit, 500)))
+    return jsonify(member_id=member.id,
+                   visits=[dict(id=visit.id, date=visit.date.isoformat()) for visit in visits],
+                   next=next_cursor)
+
+
+@main.route('/manage_members', methods=['GET', 'POST'])
 @login_required
 def manage_members():
     ''' Admin interface for searching and editing members.'''
@@ -547,41 +876,49 @@ def manage_members():
         # Make sure valid query is submitted
         if not query or len(query) < 2:
             flash(u'Search query must be longer than two characters.', 'error')
-            return redirect(url_for('manage_members'))
+            return redirect(url_for('.manage_members'))
 
         # Get members matching query
-        members = Member.query.filter(
-                    Member.member_last_name.ilike("%" + query + "%")).order_by(
-                    Member.member_last_name, Member.member_first_name)
+        members = member_rows(query)
 
         # If no members match search query, reload page with message
-        if members.count() == 0:
+        if not members:
             flash(u'Your search query did not match any members. Try again.', 'error')
-            return redirect(url_for('manage_members'))
-
-        # Calculate visit information for each member
-        visit_info = []
-        for member in members:
-            visits = MemberVisit.query.filter(
-                            MemberVisit.member == member.id).order_by(
-                            MemberVisit.date.desc())
-            # Get total number of visits and date of last visit
-            num_visits = visits.count()
-            last_visit = visits.first().date
-            # append visit information to list
-            visit_info.append((num_visits, last_visit))
+            return redirect(url_for('.manage_members'))
 
         # Render template with list of members and their visit information
-        return render_template('member_search_results.html',
-                            members=members,
-                            visit_info=visit_info)
+        return render_template('member_search_results.html', members=members)
 
     # GET request displays table of members and search feature
     else:
         return render_template('manage_members.html')
 
 
-@app.route('/members/metrics', methods=['GET', 'POST'])
+@main.route('/manage_members/import', methods=['POST'])
+@login_required
+def import_roster():
+    ''' Import members from an uploaded CSV roll.'''
+
+    roll = request.files.get('roll')
+    if not roll or not roll.filename.lower().endswith('.csv'):
+        flash(u'You must select a CSV file.', 'error')
+        return redirect(url_for('.manage_members'))
+    try:
+        result = import_members(roll.stream)
+    except ValueError as e:
+        flash(u'Could not import %s: %s' % (roll.filename, e), 'error')
+        return redirect(url_for('.manage_members'))
+
+    flash(u'Imported %d members in %.1f seconds. Skipped %d already on file.' % (
+                result['added'], result['seconds'], result['duplicates']), 'success')
+    if result['invalid']:
+        # Only the first few, a bad export could fail on every line
+        lines = ', '.join('%d (%s)' % invalid for invalid in result['invalid'][:10])
+        flash(u'Skipped %d invalid rows, lines %s.' % (len(result['invalid']), lines), 'error')
+    return redirect(url_for('.manage_members'))
+
+
+@main.route('/members/metrics', methods=['GET', 'POST'])
 @login_required
 def member_metrics():
     ''' Admin interface for viewing and running membership reports.'''
@@ -594,95 +931,85 @@ def member_metrics():
             start_date = request.form.get('start_date', type=str)
             # If no start date is given, go since deployment date
             if not start_date:
-                start_date = datetime.strptime(app.config['DEPLOY_DATE'], '%m/%d/%Y')
+                start_date = datetime.strptime(current_app.config['DEPLOY_DATE'], '%m/%d/%Y')
             else:
                 start_date = datetime.strptime(start_date, '%m/%d/%Y')
             # Make sure they do not enter a start date past today
             if start_date > datetime.now():
                 flash(u'Invalid start date. Start date must be earlier than today.', 'error')
-                return redirect(url_for('member_metrics'))
+                return redirect(url_for('.member_metrics'))
 
             # Get end_date and cast to datetime objects
             end_date = request.form.get('end_date', type=str)
-            # If no end date is given, go with today
+            # If no end date is given, go with all of today
             if not end_date:
-                end_date = datetime.now()
+                end_date = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(days=1)
             else:
                 end_date = datetime.strptime(end_date, '%m/%d/%Y') + timedelta(days=1)
             # Make sure end date is not less than start date
             if end_date < start_date:
                 flash(u'Invalid end date. End date must be earlier than start date.', 'error')
-                return redirect(url_for('member_metrics'))
-
-            # Visits in date range
-            total_visits = MemberVisit.query.filter(
-                    MemberVisit.date > start_date).filter(
-                    MemberVisit.date < end_date).count()
-            # Average visits in date range
-            delta = end_date - start_date
-            try:
-                visits_per_day = total_visits / delta.days
-            except ZeroDivisionError:
-                visits_per_day = 0
-
-            # Calculate date of highest attendance
-            date = start_date
-            max_date, max_visits = date, 0
-            while date < end_date:
-                # Calculate number of visits for that day
-                num_visits = MemberVisit.query.filter(
-                        MemberVisit.date > date).filter(
-                        MemberVisit.date < date + timedelta(days=1)).count()
-                # If new max, update max values
-                if num_visits > max_visits:
-                    max_visits = num_visits
-                    max_date = date
-                # Increment date
-                date += timedelta(days=1)
+                return redirect(url_for('.member_metrics'))
 
             # Render template with calculated values
             return render_template('member_metrics.html',
                 start_date=start_date,
                 end_date=end_date,
-                total_visits=total_visits,
-                visits_per_day=visits_per_day,
-                max_visits=max_visits,
-                max_date=max_date)
+                **metrics_cache.visit_metrics(start_date, end_date))
     # GET request renders template
     else:
         # Render template with default values
-        start_date = datetime.strptime(app.config['DEPLOY_DATE'], '%m/%d/%Y')
+        start_date = datetime.strptime(current_app.config['DEPLOY_DATE'], '%m/%d/%Y')
         end_date = datetime.now()
-        delta = end_date + timedelta(days=1) - start_date
-        total_visits = MemberVisit.query.filter(
-                            MemberVisit.date > start_date).filter(
-                            MemberVisit.date < end_date + timedelta(days=1)).count()
-        # Calculate average number of visits per day
-        try:
-            visits_per_day = total_visits / delta.days
-        except ZeroDivisionError:
-            visits_per_day = 0
-
-        # Calculate date of highest attendance
-        date = start_date
-        now = datetime.now()
-        max_date, max_visits = date, 0
-        while date < now:
-            # Calculate number of visits for that day
-            num_visits = MemberVisit.query.filter(
-                    MemberVisit.date > date).filter(
-                    MemberVisit.date < date + timedelta(days=1)).count()
-            # If new max, update max values
-            if num_visits > max_visits:
-                max_visits = num_visits
-                max_date = date
-            # Increment date
-            date += timedelta(days=1)
+        # Include all of today in report; whole days can be served from cache
+        today = datetime.combine(end_date.date(), datetime.min.time())
+        metrics = metrics_cache.visit_metrics(start_date, today + timedelta(days=1))
 
         return render_template('member_metrics.html',
                 start_date=start_date,
-                end_date=now,
-                total_visits=total_visits,
-                visits_per_day=visits_per_day,
-                max_visits=max_visits,
-                max_date=max_date)
+                end_date=end_date,
+                **metrics)
+
+
+@main.route('/members/metrics/export')
+@login_required
+def export_report():
+    ''' Download visits or daily visit totals for a date range as CSV,
+        optionally gzip compressed.'''
+
+    report = request.args.get('report', 'visits', type=str)
+    compress = bool(request.args.get('gzip', 0, type=int))
+    try:
+        start_date, end_date = report_range(request.args.get('start_date', type=str),
+                                            request.args.get('end_date', type=str))
+        stream = export_stream(report, start_date, end_date, compress)
+    except ValueError as e:
+        flash(u'Invalid export: %s' % e, 'error')
+        return redirect(url_for('.member_metrics'))
+
+    filename = '%s_%s_%s.csv' % (report, start_date.strftime('%Y%m%d'),
+                                 (end_date - timedelta(days=1)).strftime('%Y%m%d'))
+    mimetype = 'text/csv'
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(stream_with_context(stream), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+
+@main.route('/jobs')
+@login_required
+def job_list():
+    ''' Status of the most recent background jobs.'''
+
+    recent = Job.query.order_by(Job.id.desc()).limit(50)
+    return render_template('jobs.html', jobs=[job_status(job) for job in recent])
+
+
+#AJAX
+@main.route('/jobs/<int:job_id>')
+@login_required
+def job_detail(job_id):
+    ''' JSON status of a background job, for polling until it is done.'''
+
+    return jsonify(**job_status(Job.query.get_or_404(job_id)))
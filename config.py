@@ -4,9 +4,137 @@ import os
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'JPG', 'jpeg', 'gif', 'mp3', 'mp4'])
+BLUEPRINTS = ['app.views:main']
 DEPLOY_DATE = "04/20/2016"
 SECRET_KEY = os.getenv("SECRET_KEY", "local-key")
 SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(basedir, "discovery_rfid.db")
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 UPLOAD_FOLDER = basedir + '/app/static/media/'
 WTF_CSRF_ENABLED = True
+
+# Visits older than this many days are rolled up and archived
+VISIT_ARCHIVE_DAYS = 365
+# Number of visits moved per archive transaction
+VISIT_ARCHIVE_BATCH = 5000
+
+# Scan events waiting to be written; further scans are dropped and counted
+SCAN_LOG_QUEUE_SIZE = 1000
+# Maximum number of scan events written per insert
+SCAN_LOG_BATCH = 100
+# Seconds to wait for a full batch before writing a partial one
+SCAN_LOG_INTERVAL = 1.0
+
+# Seconds a kiosk may validate challenge scans with a downloaded bundle
+CHALLENGE_BUNDLE_MAX_AGE = 300
+# Maximum number of scans accepted in one challenge scan report
+CHALLENGE_REPORT_LIMIT = 100
+# Seconds a server process checks reported scans against cached answers
+CHALLENGE_ANSWER_CACHE_SECONDS = 10
+
+# Seconds between counter updates sent to idle live dashboards
+LIVE_KEEPALIVE_INTERVAL = 15
+
+# Visits per page of a member's visit history
+VISIT_HISTORY_PAGE_SIZE = 50
+
+# Threads extracting media when a game is built from a zip archive
+GAME_IMPORT_WORKERS = 4
+
+# Shared secret scanner.py sends with scans; ingest is refused if empty
+INGEST_TOKEN = os.getenv("INGEST_TOKEN", "")
+# Only accept scans posted from this machine
+INGEST_LOCAL_ONLY = True
+# Maximum number of scan events accepted in one ingest request
+INGEST_BATCH_LIMIT = 100
+# Seconds an ingest request waits for pages of the station to receive
+# its scans, e.g. while a page loads; the rest are posted again
+INGEST_DELIVERY_TIMEOUT = 2
+# Scans older than this many seconds are acknowledged without relaying
+INGEST_MAX_AGE = 30
+# Station of kiosk pages not opened with ?station=
+SCANNER_STATION = 'kiosk'
+
+# Memory-mapped table of game devices by tag, shared by server processes
+TAG_TABLE_PATH = os.path.join(basedir, 'tag_table.bin')
+
+# Threads running background jobs such as media deletion and game imports
+JOB_WORKERS = 2
+# Submitted jobs waiting to wake a worker; others wait for the next poll
+JOB_QUEUE_SIZE = 100
+# Attempts made at a job that keeps failing
+JOB_MAX_ATTEMPTS = 3
+# Seconds before the first retry of a failed job, doubled for each retry
+JOB_RETRY_DELAY = 5
+# Seconds between worker checks for retries and jobs of other processes
+JOB_POLL_INTERVAL = 5
+# Seconds a running job's lease lasts; its worker renews the lease while
+# the job runs, so a job whose lease ran out was lost and is run again
+JOB_LEASE = 60
+
+# Bundled, content-hashed static assets written by `run.py assets build`
+ASSET_FOLDER = os.path.join(basedir, 'app', 'static', 'dist')
+# Seconds browsers may cache a bundle without revalidating it
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+# Seconds after a check-in during which scans of the same card count as
+# repeats of that visit rather than new visits; 0 records every scan
+CHECK_IN_REPEAT_WINDOW = 300
+
+# Folder of online database backups and how many of them to keep
+BACKUP_FOLDER = os.path.join(basedir, 'backups')
+BACKUP_KEEP = 7
+# Database pages copied per backup step; each step briefly holds a read lock
+BACKUP_STEP_PAGES = 64
+# Times writes may restart a backup before it gives up
+BACKUP_MAX_RESTARTS = 20
+# Free pages released per incremental vacuum transaction
+VACUUM_STEP_PAGES = 64
+# Seconds to pause between backup and vacuum steps, letting kiosks write
+MAINTENANCE_STEP_SLEEP = 0.005
+# Most seconds one maintenance run spends vacuuming
+VACUUM_BUDGET = 60
+# Rows per index read when refreshing query planner statistics
+ANALYSIS_LIMIT = 1000
+# Queue a daily backup, analyze and vacuum from the server in quiet hours
+MAINTENANCE_SCHEDULE = False
+# Hours of the day, from start up to end, in which maintenance may run
+MAINTENANCE_HOURS = (2, 5)
+# Seconds between checks whether maintenance is due
+MAINTENANCE_CHECK_INTERVAL = 600
+
+# Journal mode of SQLite databases; in WAL mode reports never block writes
+SQLITE_JOURNAL_MODE = 'WAL'
+# Query-only connections shared by report, analytics and export requests
+REPORT_POOL_SIZE = 4
+
+# Offline text-to-speech command writing {text} to the WAV file {wav},
+# e.g. ['espeak-ng', '-v', 'en-us', '-s', '150', '-w', '{wav}', '--', '{text}'];
+# keep '--' before {text} so descriptions starting with '-' are not read as
+# options. Empty speaks descriptions in the browser, as builds without
+# espeak-ng and ffmpeg (e.g. the macOS app) must
+NARRATION_ENGINE = []
+# Command compressing {wav} into {output}, and the resulting format
+NARRATION_ENCODER = ['ffmpeg', '-loglevel', 'error', '-y', '-i', '{wav}',
+                     '-codec:a', 'libmp3lame', '-q:a', '6', '{output}']
+NARRATION_FORMAT = 'mp3'
+# Rendered narrations, named by a hash of their text and the commands above
+NARRATION_FOLDER = basedir + '/app/static/narration/'
+# Seconds since last written after which pruning deletes a partly encoded
+# narration, left by a render that died; younger ones may still be written
+NARRATION_PARTIAL_AGE = 3600
+
+# Name of this node in the changes it pushes, unique per installation;
+# satellites do not push until it is set
+REPLICATION_NODE = os.getenv("REPLICATION_NODE", "")
+# URL of the central node satellites push member and visit changes to;
+# empty on the central node itself
+REPLICATION_CENTRAL = os.getenv("REPLICATION_CENTRAL", "")
+# Token shared by satellites and the central node; changes are refused
+# while it is empty
+REPLICATION_TOKEN = os.getenv("REPLICATION_TOKEN", "")
+# Log member and visit writes for pushing to the central node
+REPLICATION_LOG = bool(REPLICATION_CENTRAL)
+# Changes per pushed batch
+REPLICATION_BATCH = 500
+# Largest batch the central node accepts, compressed or not
+REPLICATION_MAX_BYTES = 8 * 1024 * 1024
@@ -1,5 +1,7 @@
 #!/bin/bash
 cd ~/discovery_space_rfid
+# Scanner and app share a token for posting scans, new on every boot
+export INGEST_TOKEN=${INGEST_TOKEN:-$(python -c 'import binascii, os; print(binascii.hexlify(os.urandom(16)).decode())')}
 python scanner.py &
 python run.py runserver &
 firefox -private-window localhost:5000
@@ -0,0 +1,22 @@
+"""index archived visits by member and date
+
+Revision ID: 2e7d5c19ab08
+Revises: f1d83b6a4e52
+Create Date: 2026-10-19 17:05:32.448911
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e7d5c19ab08'
+down_revision = 'f1d83b6a4e52'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_member_visits_archive_member_date', 'member_visits_archive', ['MemberID', 'Date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_member_visits_archive_member_date', table_name='member_visits_archive')
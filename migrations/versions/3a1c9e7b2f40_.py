@@ -0,0 +1,44 @@
+"""archive old member visits into daily rollups
+
+Revision ID: 3a1c9e7b2f40
+Revises: de9bc00947ea
+Create Date: 2026-10-19 09:12:41.203518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1c9e7b2f40'
+down_revision = 'de9bc00947ea'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('member_visits_archive',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('MemberID', sa.Integer(), nullable=True),
+    sa.Column('Date', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['MemberID'], ['members.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('member_visit_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('MemberID', sa.Integer(), nullable=False),
+    sa.Column('Day', sa.Date(), nullable=False),
+    sa.Column('Visits', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['MemberID'], ['members.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('MemberID', 'Day')
+    )
+    op.create_index('ix_member_visit_rollups_Day', 'member_visit_rollups', ['Day'], unique=False)
+    op.create_index('ix_member_visits_member_date', 'member_visits', ['MemberID', 'Date'], unique=False)
+    op.create_index('ix_member_visits_date', 'member_visits', ['Date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_member_visits_date', table_name='member_visits')
+    op.drop_index('ix_member_visits_member_date', table_name='member_visits')
+    op.drop_index('ix_member_visit_rollups_Day', table_name='member_visit_rollups')
+    op.drop_table('member_visit_rollups')
+    op.drop_table('member_visits_archive')
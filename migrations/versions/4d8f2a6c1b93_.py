@@ -0,0 +1,26 @@
+"""count repeated check-ins
+
+Revision ID: 4d8f2a6c1b93
+Revises: 7c0e4b92d1f6
+Create Date: 2026-10-19 19:02:44.618302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d8f2a6c1b93'
+down_revision = '7c0e4b92d1f6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('member_visits', sa.Column('Repeats', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('member_visits_archive', sa.Column('Repeats', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('member_visits_archive') as batch_op:
+        batch_op.drop_column('Repeats')
+    with op.batch_alter_table('member_visits') as batch_op:
+        batch_op.drop_column('Repeats')
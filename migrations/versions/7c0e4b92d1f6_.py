@@ -0,0 +1,38 @@
+"""add background jobs
+
+Revision ID: 7c0e4b92d1f6
+Revises: 2e7d5c19ab08
+Create Date: 2026-10-19 18:21:07.315208
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c0e4b92d1f6'
+down_revision = '2e7d5c19ab08'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('Name', sa.String(length=50), nullable=False),
+    sa.Column('Arguments', sa.Text(), nullable=False),
+    sa.Column('Status', sa.String(length=10), nullable=False),
+    sa.Column('Attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('MaxAttempts', sa.Integer(), server_default='1', nullable=False),
+    sa.Column('Result', sa.Text(), nullable=True),
+    sa.Column('Error', sa.Text(), nullable=True),
+    sa.Column('Created', sa.DateTime(), nullable=True),
+    sa.Column('RunAfter', sa.DateTime(), nullable=True),
+    sa.Column('Started', sa.DateTime(), nullable=True),
+    sa.Column('Finished', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_jobs_status_run_after', 'jobs', ['Status', 'RunAfter'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_jobs_status_run_after', table_name='jobs')
+    op.drop_table('jobs')
@@ -0,0 +1,59 @@
+"""denormalized visit statistics on members
+
+Revision ID: 8b4e21d0c7a3
+Revises: 3a1c9e7b2f40
+Create Date: 2026-10-19 11:02:17.584230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8b4e21d0c7a3'
+down_revision = '3a1c9e7b2f40'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# Number of members backfilled per statement
+BATCH_SIZE = 1000
+
+# Visit counts combine hot visits with archived daily rollups. Rollup days
+# are converted to datetimes so both sources compare as text in SQLite.
+BACKFILL = sa.text('''
+    UPDATE members SET
+        VisitCount =
+            (SELECT COUNT(*) FROM member_visits
+                WHERE member_visits.MemberID = members.id) +
+            COALESCE((SELECT SUM(Visits) FROM member_visit_rollups
+                WHERE member_visit_rollups.MemberID = members.id), 0),
+        FirstVisit = COALESCE(
+            (SELECT datetime(MIN(Day)) FROM member_visit_rollups
+                WHERE member_visit_rollups.MemberID = members.id),
+            (SELECT MIN(Date) FROM member_visits
+                WHERE member_visits.MemberID = members.id)),
+        LastVisit = COALESCE(
+            (SELECT MAX(Date) FROM member_visits
+                WHERE member_visits.MemberID = members.id),
+            (SELECT datetime(MAX(Day)) FROM member_visit_rollups
+                WHERE member_visit_rollups.MemberID = members.id))
+    WHERE members.id > :low AND members.id <= :high
+''')
+
+
+def upgrade():
+    op.add_column('members', sa.Column('VisitCount', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('members', sa.Column('FirstVisit', sa.DateTime(), nullable=True))
+    op.add_column('members', sa.Column('LastVisit', sa.DateTime(), nullable=True))
+
+    # Backfill statistics in batches of member ids
+    connection = op.get_bind()
+    max_id = connection.execute(sa.text('SELECT MAX(id) FROM members')).scalar() or 0
+    for low in range(0, max_id, BATCH_SIZE):
+        connection.execute(BACKFILL, low=low, high=low + BATCH_SIZE)
+
+
+def downgrade():
+    with op.batch_alter_table('members') as batch_op:
+        batch_op.drop_column('LastVisit')
+        batch_op.drop_column('FirstVisit')
+        batch_op.drop_column('VisitCount')
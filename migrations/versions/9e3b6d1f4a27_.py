@@ -0,0 +1,61 @@
+"""add replication change log
+
+Revision ID: 9e3b6d1f4a27
+Revises: 4d8f2a6c1b93
+Create Date: 2026-10-19 21:37:52.904617
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e3b6d1f4a27'
+down_revision = '4d8f2a6c1b93'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('Entity', sa.String(length=10), nullable=False),
+    sa.Column('Operation', sa.String(length=10), nullable=False),
+    sa.Column('CardNumber', sa.String(length=50), nullable=False),
+    sa.Column('Data', sa.Text(), nullable=False),
+    sa.Column('Created', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=True
+    )
+    op.create_table('replication_peers',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('Node', sa.String(length=200), nullable=False),
+    sa.Column('Sent', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('Received', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('Synced', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('Node')
+    )
+    op.create_table('replication_conflicts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('Node', sa.String(length=200), nullable=False),
+    sa.Column('Sequence', sa.Integer(), nullable=False),
+    sa.Column('CardNumber', sa.String(length=50), nullable=True),
+    sa.Column('Reason', sa.String(length=200), nullable=False),
+    sa.Column('Change', sa.Text(), nullable=False),
+    sa.Column('Created', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_members_CardNumber', 'members', ['CardNumber'], unique=False)
+    # Replicated visits older than the archive cutoff are archived right
+    # away, so ids of deleted visits must not be handed out again
+    with op.batch_alter_table('member_visits', recreate='always',
+                              table_kwargs=dict(sqlite_autoincrement=True)):
+        pass
+
+
+def downgrade():
+    with op.batch_alter_table('member_visits', recreate='always'):
+        pass
+    op.drop_index('ix_members_CardNumber', table_name='members')
+    op.drop_table('replication_conflicts')
+    op.drop_table('replication_peers')
+    op.drop_table('change_log')
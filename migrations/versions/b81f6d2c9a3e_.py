@@ -0,0 +1,23 @@
+"""add job leases
+
+Revision ID: b81f6d2c9a3e
+Revises: 9e3b6d1f4a27
+Create Date: 2026-10-19 21:14:05.302117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b81f6d2c9a3e'
+down_revision = '9e3b6d1f4a27'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('jobs', sa.Column('LeaseUntil', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.drop_column('LeaseUntil')
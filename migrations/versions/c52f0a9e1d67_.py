@@ -0,0 +1,38 @@
+"""scan event log
+
+Revision ID: c52f0a9e1d67
+Revises: 8b4e21d0c7a3
+Create Date: 2026-10-19 13:40:55.117902
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c52f0a9e1d67'
+down_revision = '8b4e21d0c7a3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('scan_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('GameID', sa.Integer(), nullable=True),
+    sa.Column('QuestionID', sa.Integer(), nullable=True),
+    sa.Column('DeviceID', sa.Integer(), nullable=True),
+    sa.Column('Tag', sa.String(length=50), nullable=True),
+    sa.Column('Valid', sa.Boolean(), nullable=False),
+    sa.Column('Date', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['DeviceID'], ['devices.id'], ),
+    sa.ForeignKeyConstraint(['GameID'], ['games.id'], ),
+    sa.ForeignKeyConstraint(['QuestionID'], ['questions.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_scan_events_GameID', 'scan_events', ['GameID'], unique=False)
+    op.create_index('ix_scan_events_Date', 'scan_events', ['Date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_scan_events_Date', table_name='scan_events')
+    op.drop_index('ix_scan_events_GameID', table_name='scan_events')
+    op.drop_table('scan_events')
@@ -0,0 +1,26 @@
+"""add data versions
+
+Revision ID: c5e2a7f04d18
+Revises: b81f6d2c9a3e
+Create Date: 2026-10-19 22:03:41.518230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5e2a7f04d18'
+down_revision = 'b81f6d2c9a3e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('data_versions',
+    sa.Column('Name', sa.String(length=50), nullable=False),
+    sa.Column('Version', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('Name')
+    )
+
+
+def downgrade():
+    op.drop_table('data_versions')
@@ -0,0 +1,42 @@
+"""hourly scan rollups for usage analytics
+
+Revision ID: f1d83b6a4e52
+Revises: c52f0a9e1d67
+Create Date: 2026-10-19 15:21:08.730164
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f1d83b6a4e52'
+down_revision = 'c52f0a9e1d67'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('scan_events', sa.Column('FirstTry', sa.Boolean(), server_default='0', nullable=False))
+    op.create_table('scan_hourly_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('Hour', sa.DateTime(), nullable=False),
+    sa.Column('GameID', sa.Integer(), nullable=True),
+    sa.Column('DeviceID', sa.Integer(), nullable=True),
+    sa.Column('QuestionID', sa.Integer(), nullable=True),
+    sa.Column('Scans', sa.Integer(), nullable=False),
+    sa.Column('ValidScans', sa.Integer(), nullable=False),
+    sa.Column('FirstTries', sa.Integer(), nullable=False),
+    sa.Column('FirstTrySuccesses', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['DeviceID'], ['devices.id'], ),
+    sa.ForeignKeyConstraint(['GameID'], ['games.id'], ),
+    sa.ForeignKeyConstraint(['QuestionID'], ['questions.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('Hour', 'GameID', 'DeviceID', 'QuestionID')
+    )
+    op.create_index('ix_scan_hourly_rollups_GameID', 'scan_hourly_rollups', ['GameID'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_scan_hourly_rollups_GameID', table_name='scan_hourly_rollups')
+    op.drop_table('scan_hourly_rollups')
+    with op.batch_alter_table('scan_events') as batch_op:
+        batch_op.drop_column('FirstTry')
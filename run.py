@@ -1,3 +1,3 @@
 #!flask/bin/python
-from app import manager
+from app.commands import manager
 manager.run()
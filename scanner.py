@@ -2,22 +2,350 @@
 
 #Basic imports
 from ctypes import *
+import argparse
+import itertools
+import json
+import os
 import sys
+import threading
+import time
+from collections import deque
+try:
+    from httplib import HTTPConnection, HTTPException
+    from urllib2 import urlopen, HTTPError
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPConnection, HTTPException
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+    from urllib.parse import urlparse
 #Phidget specific imports
 from Phidgets.PhidgetException import PhidgetErrorCodes, PhidgetException
 from Phidgets.Events.Events import AttachEventArgs, DetachEventArgs, ErrorEventArgs, OutputChangeEventArgs, TagEventArgs
 from Phidgets.Devices.RFID import RFID, RFIDTagProtocol
 from Phidgets.Phidget import PhidgetLogLevel
 
-import pyautogui
-import time
+
+class ScanJournal(object):
+    ''' Bounded on-disk journal of scans not yet delivered.
+
+        Every scan is appended to the journal file before it is handed to
+        the consumer, so scans made while the web app is down or
+        restarting survive and are replayed in order. Deliveries append
+        an acknowledgement marker rather than rewriting the file, which
+        is compacted to the waiting scans once most of its lines are
+        delivered or dropped. When max_events are waiting the oldest scan
+        is dropped and counted.'''
+
+    def __init__(self, path, max_events, compact_lines=1000):
+        self.path = path
+        self.max_events = max_events
+        self.compact_lines = compact_lines
+        self.dropped = 0
+        self.condition = threading.Condition()
+        events, self.lines = self._load()
+        self.events = deque(events)
+        self.seq = self.events[-1]['seq'] if self.events else 0
+        self.journal = open(self.path, 'a')
+        self._compact_if_due()
+
+    def _load(self):
+        ''' Return scans left waiting in the journal by a previous run,
+            and the number of lines in it.'''
+
+        events = []
+        acked = 0
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path) as journal:
+                for line in journal:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        #Torn write of the last line before a crash
+                        continue
+                    if 'ack' in entry:
+                        acked = max(acked, entry['ack'])
+                    else:
+                        events.append(entry)
+        events = [event for event in events if event['seq'] > acked]
+        return events[-self.max_events:], lines
+
+    def _write(self, entry, sync):
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        if sync:
+            os.fsync(self.journal.fileno())
+        self.lines += 1
+
+    def _compact_if_due(self):
+        ''' Replace journal file with the waiting scans once at most half
+            its lines are waiting scans.'''
+
+        if self.lines < max(self.compact_lines, 2 * len(self.events)):
+            return
+        partial = self.path + '.tmp'
+        with open(partial, 'w') as journal:
+            for event in self.events:
+                journal.write(json.dumps(event) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journal.close()
+        os.rename(partial, self.path)
+        self.journal = open(self.path, 'a')
+        self.lines = len(self.events)
+
+    def append(self, tag):
+        ''' Durably record a scan of tag.'''
+
+        with self.condition:
+            if len(self.events) >= self.max_events:
+                #Left in the file until compacted; loading keeps the newest
+                self.events.popleft()
+                self.dropped += 1
+            self.seq += 1
+            event = dict(seq=self.seq, tag=tag, time=time.time())
+            self.events.append(event)
+            self._write(event, True)
+            self._compact_if_due()
+            self.condition.notify()
+        return event
+
+    def peek(self, limit, timeout):
+        ''' Return up to limit oldest waiting scans, waiting up to timeout
+            seconds for one to arrive.'''
+
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            return list(itertools.islice(self.events, 0, limit))
+
+    def ack(self, seq):
+        ''' Remove scans up to and including seq once delivered.'''
+
+        with self.condition:
+            while self.events and self.events[0]['seq'] <= seq:
+                self.events.popleft()
+            #A lost marker only means scans are delivered again
+            self._write(dict(ack=seq), False)
+            self._compact_if_due()
+
+    def depth(self):
+        with self.condition:
+            return len(self.events)
+
+
+class ScannerHealth(object):
+    ''' Counters describing the reader and scan delivery.'''
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.attached = False
+        self.detached_at = time.time()
+        self.counters = dict(attaches=0, detaches=0, attach_failures=0, scans=0,
+                             delivered=0, delivery_failures=0, rejected=0, expired=0,
+                             undelivered=0)
+        self.last_scan = None
+        self.last_error = None
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def set_attached(self, attached):
+        with self.lock:
+            self.attached = attached
+            if attached:
+                self.counters['attaches'] += 1
+            else:
+                self.counters['detaches'] += 1
+                self.detached_at = time.time()
+
+    def error(self, message):
+        with self.lock:
+            self.last_error = '%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), message)
+
+    def snapshot(self):
+        ''' Return dict of all counters and the journal's queue depth.'''
+
+        with self.lock:
+            health = dict(self.counters)
+            health.update(attached=self.attached, last_scan=self.last_scan,
+                          last_error=self.last_error)
+        health.update(queue_depth=self.journal.depth(), dropped=self.journal.dropped,
+                      updated=time.time())
+        return health
+
+    def write(self, path):
+        ''' Atomically write snapshot to path as JSON.'''
+
+        partial = path + '.tmp'
+        with open(partial, 'w') as health:
+            json.dump(self.snapshot(), health, indent=2, sort_keys=True)
+        os.rename(partial, path)
+
+
+class RejectedBatch(Exception):
+    ''' The web app refused a batch of scans as malformed; retrying would
+        fail again.'''
+
+
+class IngestConsumer(object):
+    ''' Deliver scans by posting batches to the web app's ingest endpoint
+        over one kept-alive HTTP connection.'''
+
+    def __init__(self, server_url, token, station):
+        url = urlparse(server_url)
+        self.host = url.netloc
+        self.path = url.path.rstrip('/') + '/_ingest_scans'
+        self.headers = {'Content-Type': 'application/json',
+                        'Authorization': 'Bearer %s' % token}
+        self.station = station
+        self.connection = HTTPConnection(self.host, timeout=5)
+
+    def post(self, body):
+        ''' Post body and return response status and content.'''
+
+        self.connection.request('POST', self.path, body, self.headers)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+    def deliver(self, events):
+        ''' Post events and return (accepted, expired): the number of
+            leading events the app relayed to a page or found expired,
+            and of those expired.'''
+
+        body = json.dumps(dict(events=[
+                    dict(station=self.station, tag=event['tag'], timestamp=event['time'])
+                    for event in events]))
+        try:
+            status, content = self.post(body)
+        except (HTTPException, IOError):
+            #The server may have closed the idle connection; reconnect once
+            self.connection.close()
+            status, content = self.post(body)
+        if status == 400:
+            raise RejectedBatch(content)
+        if status != 200:
+            raise IOError('Ingest returned HTTP %d' % status)
+        result = json.loads(content.decode('utf-8'))
+        return result['accepted'], result.get('expired', 0)
+
+
+class KeystrokeConsumer(object):
+    ''' Deliver scans by typing them into the focused browser window.
+
+        Scans are only typed while the web app answers at server_url, so
+        a restarting app leaves them in the journal.'''
+
+    def __init__(self, server_url):
+        #Needs a display, so only imported when typing scans
+        import pyautogui
+        self.keyboard = pyautogui
+        self.server_url = server_url
+
+    def deliver(self, events):
+        try:
+            urlopen(self.server_url, timeout=2).close()
+        except HTTPError:
+            #Any HTTP response means the app is up
+            pass
+        for event in events:
+            #Fake keyboard input as RFID tag
+            self.keyboard.typewrite('%s\r' % event['tag'])
+        return len(events), 0
+
+
+class Dispatcher(threading.Thread):
+    ''' Hand journaled scans to the consumer in order, backing off
+        exponentially while delivery fails.'''
+
+    def __init__(self, journal, consumer, health, batch_size=20, max_backoff=60,
+                 retry_interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.journal = journal
+        self.consumer = consumer
+        self.health = health
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        #Wait before posting scans no page received yet
+        self.retry_interval = retry_interval
+
+    def run(self):
+        backoff = 1
+        while True:
+            events = self.journal.peek(self.batch_size, 1.0)
+            if not events:
+                continue
+            try:
+                accepted, expired = self.consumer.deliver(events)
+            except RejectedBatch as e:
+                #Drop the batch rather than block the scans behind it
+                self.health.count('rejected', len(events))
+                self.health.error('Batch rejected: %s' % e)
+                self.journal.ack(events[-1]['seq'])
+                continue
+            except Exception as e:
+                self.health.count('delivery_failures')
+                self.health.error('Delivery failed: %s' % e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = 1
+            if accepted:
+                self.journal.ack(events[accepted - 1]['seq'])
+                self.health.count('delivered', accepted - expired)
+                self.health.count('expired', expired)
+            if accepted < len(events):
+                #The app is up but no page of the station took the scans
+                self.health.count('undelivered', len(events) - accepted)
+                time.sleep(self.retry_interval)
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Read RFID tags and deliver them to the web app.')
+    parser.add_argument('--journal', default='scanner.journal',
+                        help='File of scans waiting for delivery')
+    parser.add_argument('--journal-size', dest='journal_size', type=int, default=100000,
+                        help='Maximum scans kept while the web app is unreachable')
+    parser.add_argument('--health', default='scanner_health.json',
+                        help='File the health counters are written to')
+    parser.add_argument('--health-interval', dest='health_interval', type=float, default=5.0,
+                        help='Seconds between health file updates')
+    parser.add_argument('--server', default='http://localhost:5000/',
+                        help='URL of the web app')
+    parser.add_argument('--transport', choices=['ingest', 'keys'], default=None,
+                        help='Post scans to the web app, or type them into the browser '
+                             '(default: ingest if a token is set, else keys)')
+    parser.add_argument('--station', default='kiosk',
+                        help='Station name of kiosk pages showing this reader\'s scans')
+    parser.add_argument('--token', default=os.getenv('INGEST_TOKEN'),
+                        help='INGEST_TOKEN of the web app (default: $INGEST_TOKEN)')
+    parser.add_argument('--max-backoff', dest='max_backoff', type=float, default=60.0,
+                        help='Longest wait in seconds between attach or delivery attempts')
+    options = parser.parse_args()
+    if options.transport is None:
+        options.transport = 'ingest' if options.token else 'keys'
+        if not options.token:
+            sys.stderr.write('INGEST_TOKEN is not set, typing scans into the browser.\n')
+    elif options.transport == 'ingest' and not options.token:
+        parser.error('Set INGEST_TOKEN or pass --token to post scans.')
+    return options
+
+
+options = parseArguments()
+journal = ScanJournal(options.journal, options.journal_size)
+health = ScannerHealth(journal)
 
 #Create an RFID object
 try:
     rfid = RFID()
 except RuntimeError as e:
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Runtime Exception: %s" % e.details)
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Exiting....")
+    sys.stderr.write("Runtime Exception: %s\n" % e)
+    sys.stderr.write("Exiting....\n")
     exit(1)
 
 
@@ -35,16 +363,24 @@ def displayDeviceInfo():
 def rfidAttached(e):
     attached = e.device
     rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "RFID %i Attached!" % (attached.getSerialNum()))
+    health.set_attached(True)
+    #The antenna is off again after the reader reattaches
+    try:
+        rfid.setAntennaOn(True)
+    except PhidgetException as e:
+        rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
 
 
 def rfidDetached(e):
     detached = e.device
     rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "RFID %i Detached!" % (detached.getSerialNum()))
+    health.set_attached(False)
 
 def rfidError(e):
     try:
         source = e.device
         rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "RFID %i: Phidget Error %i: %s" % (source.getSerialNum(), e.eCode, e.description))
+        health.error("Phidget Error %i: %s" % (e.eCode, e.description))
     except PhidgetException as e:
         rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
 
@@ -58,8 +394,10 @@ def rfidTagGained(e):
     source = e.device
     rfid.setLEDOn(1)
     rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "RFID %i: Tag Read: %s" % (source.getSerialNum(), e.tag))
-    #Fake keyboard input as RFID tag
-    pyautogui.typewrite('%s\r' % (str(e.tag)))
+    #Journal the scan; the dispatcher delivers it
+    journal.append(str(e.tag))
+    health.count('scans')
+    health.last_scan = time.time()
 
 
 def rfidTagLost(e):
@@ -68,6 +406,48 @@ def rfidTagLost(e):
     rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "RFID %i: Tag Lost: %s" % (source.getSerialNum(), e.tag))
 
 
+def attachReader():
+    ''' Open the reader and wait for it to attach, retrying with
+        exponential backoff until it does.'''
+
+    backoff = 1
+    while True:
+        rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Opening phidget object....")
+        try:
+            rfid.openPhidget()
+            rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Waiting for attach....")
+            rfid.waitForAttach(10000)
+        except PhidgetException as e:
+            rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
+            health.count('attach_failures')
+            health.error("Attach failed: %s" % e.details)
+            try:
+                rfid.closePhidget()
+            except PhidgetException as e:
+                rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
+            rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Retrying in %i seconds...." % backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, options.max_backoff)
+        else:
+            break
+
+    displayDeviceInfo()
+    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Turning on the RFID antenna....")
+    rfid.setAntennaOn(True)
+
+
+def publishHealth():
+    ''' Write the health file every --health-interval seconds, from its
+        own thread so it stays current while the reader is retried.'''
+
+    while True:
+        try:
+            health.write(options.health)
+        except (IOError, OSError) as e:
+            rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Could not write health: %s" % e)
+        time.sleep(options.health_interval)
+
+
 #Main Program Code
 try:
     rfid.enableLogging(PhidgetLogLevel.PHIDGET_LOG_VERBOSE, "phidgetlog.log")
@@ -82,58 +462,27 @@ except PhidgetException as e:
     rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Exiting....")
     exit(1)
 
-rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Opening phidget object....")
-
-try:
-    rfid.openPhidget()
-except PhidgetException as e:
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Exiting....")
-    exit(1)
-
-rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Waiting for attach....")
-
-try:
-    rfid.waitForAttach(10000)
-except PhidgetException as e:
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
-    try:
-        rfid.closePhidget()
-    except PhidgetException as e:
-        rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
-        rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Exiting....")
-        exit(1)
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Exiting....")
-    exit(1)
+#Deliver scans left from a previous run while the reader attaches
+if options.transport == 'ingest':
+    consumer = IngestConsumer(options.server, options.token, options.station)
 else:
-    displayDeviceInfo()
+    consumer = KeystrokeConsumer(options.server)
+Dispatcher(journal, consumer, health, max_backoff=options.max_backoff).start()
+healthWriter = threading.Thread(target=publishHealth, name='health-writer')
+healthWriter.daemon = True
+healthWriter.start()
 
-rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Turning on the RFID antenna....")
-rfid.setAntennaOn(True)
+attachReader()
 
-#Loop indefinitely - sleep has low overhead
+#Supervise the reader
 while True:
-    time.sleep(sys.maxint)
-
-'''
-rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Press Enter to quit....")
-
-chr = sys.stdin.read(1)
-try:
-    lastTag = rfid.getLastTag()
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Last Tag: %s" % (lastTag))
-except PhidgetException as e:
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
-
-rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Closing...")
-
-try:
-    rfid.closePhidget()
-except PhidgetException as e:
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
-    rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Exiting....")
-    exit(1)
-
-rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Done.")
-exit(0)
-'''
+    time.sleep(options.health_interval)
+    #The Phidget library reattaches a replugged reader by itself; reopen
+    #it only if that has not happened for a while
+    if not health.attached and time.time() - health.detached_at > options.max_backoff:
+        rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Reader still detached, reopening....")
+        try:
+            rfid.closePhidget()
+        except PhidgetException as e:
+            rfid.log(PhidgetLogLevel.PHIDGET_LOG_INFO, None, "Phidget Exception %i: %s" % (e.code, e.details))
+        attachReader()
@@ -0,0 +1,57 @@
+''' Reports read from query-only snapshots, so check-ins commit while a
+    report is open.'''
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+import config
+from app import create_app, db
+from app.benchmarks import populate, scratch_app
+from app.membership import record_visit
+from app.models import Member, MemberVisit
+from app.snapshots import read_session, reader
+
+
+@pytest.fixture
+def app():
+    settings = dict((name, getattr(config, name)) for name in dir(config) if name.isupper())
+    settings.update(SQLALCHEMY_DATABASE_URI='sqlite://', TESTING=True)
+    app = create_app(type('TestConfig', (object,), settings))
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def scratch(app):
+    with scratch_app(SQLITE_JOURNAL_MODE='WAL') as scratch:
+        populate(10, 1, 1)
+        db.session.remove()
+        yield scratch
+        read_session.remove()
+
+
+def visits(session):
+    return session.query(func.count(MemberVisit.id)).scalar()
+
+
+def test_reads_use_query_only_pool(scratch):
+    assert read_session.get_bind() is reader.engine()
+    assert read_session.get_bind() is not db.engine
+    assert read_session.query(func.count(Member.id)).scalar() == 10
+    with pytest.raises(OperationalError):
+        read_session.execute(Member.__table__.delete())
+
+
+def test_check_in_commits_during_report(scratch):
+    # The report's transaction stays open on its snapshot
+    before = visits(read_session)
+    record_visit(Member.query.get(1), datetime.now())
+    db.session.commit()
+
+    assert visits(db.session) == before + 1
+    assert visits(read_session) == before
+    read_session.remove()
+    assert visits(read_session) == before + 1